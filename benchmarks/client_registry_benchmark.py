@@ -0,0 +1,78 @@
+"""lambda-jobs のクライアント作成コスト（コールドスタート・ウォーム呼び出し）を、共有レジストリ導入前後で比較するベンチマーク
+
+実行例: PYTHONPATH=layer/python python benchmarks/client_registry_benchmark.py
+ネットワークには接続しない（クライアントの作成のみを計測する）。
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "ap-northeast-1")
+
+BEDROCK_CONFIG = {"read_timeout": 1000, "max_pool_connections": 10}
+
+def invocation_before():
+    """導入前の few.py と同じく、呼び出しごとにクライアントを作成する"""
+    import boto3
+    from botocore.config import Config
+    s3 = boto3.client('s3')
+    bedrock = boto3.client(service_name='bedrock-runtime', region_name='ap-northeast-1', config=Config(**BEDROCK_CONFIG))
+    return s3, bedrock
+
+def invocation_after():
+    """共有レジストリから作成済みのクライアントを取得する"""
+    from matching_common.aws_clients import get_client
+    s3 = get_client('s3')
+    bedrock = get_client('bedrock-runtime', region_name='ap-northeast-1', **BEDROCK_CONFIG)
+    return s3, bedrock
+
+VARIANTS = {"before": invocation_before, "after": invocation_after}
+
+def measure_warm(variant, invocations):
+    """同じプロセス内で invocations 回呼び出し、2回目以降の1回あたりの時間（ミリ秒）を返す"""
+    func = VARIANTS[variant]
+    func()  # 1回目（コールド）は除く
+    timings = []
+    for _ in range(invocations):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+def measure_cold(variant, runs):
+    """新しいインタープリターで import から1回目の呼び出しまでの時間（ミリ秒）を計測する"""
+    code = (
+        "import time; started = time.perf_counter(); "
+        "import client_registry_benchmark as bench; bench.VARIANTS[%r](); "
+        "print((time.perf_counter() - started) * 1000)" % variant
+    )
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)), env.get("PYTHONPATH")]))
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", code], env=env, check=True, capture_output=True, text=True).stdout
+        timings.append(float(output.strip().splitlines()[-1]))
+    return timings
+
+def summarize(label, timings):
+    print(f"{label:<14} median {statistics.median(timings):9.3f} ms   min {min(timings):9.3f} ms   max {max(timings):9.3f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--cold-runs", type=int, default=5)
+    parser.add_argument("--warm-invocations", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"# コールドスタート（import + 1回目の呼び出し、{args.cold_runs}回）")
+    for variant in VARIANTS:
+        summarize(variant, measure_cold(variant, args.cold_runs))
+
+    print(f"\n# ウォーム呼び出し（2回目以降、{args.warm_invocations}回）")
+    for variant in VARIANTS:
+        summarize(variant, measure_warm(variant, args.warm_invocations))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""matching スクリプトのクラスタリングを、従来の KMeans とミニバッチ KMeans（前回の重心なし・あり）で比較するベンチマーク
+
+実行例: PYTHONPATH=layer/python python benchmarks/clustering_benchmark.py --rows 200000 --clusters 5
+正規化した1024次元の埋め込みを生成し、翌日分として一部の行を入れ替えたデータで前回の重心から開始した場合を計測する。
+従来の KMeans は float64 で全データを使うため、行数が多い場合は --skip-full で省略できる。
+"""
+import argparse
+
+import numpy as np
+
+from matching_common.clustering import KMeansEngine, MiniBatchKMeansEngine
+
+class MemoryCentroidStore:
+    """S3CentroidStore の代わりに重心をメモリに保持する"""
+
+    def __init__(self):
+        self.centroids = None
+
+    def load(self, n_clusters, dimension):
+        if self.centroids is None or self.centroids.shape != (n_clusters, dimension):
+            return None
+        return self.centroids
+
+    def save(self, centroids):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+
+def generate_embeddings(rng, centers, rows):
+    """centers のいずれかの近くに分布する、正規化した埋め込みを生成する"""
+    labels = rng.integers(len(centers), size=rows)
+    embeddings = centers[labels] + rng.standard_normal((rows, centers.shape[1]), dtype=np.float32) * 0.03
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings
+
+def report(label, result):
+    summary = result.summary()
+    print(
+        f"{label:<28} {summary['seconds']:>8.3f} s  inertia {summary['inertia']:>12.2f}"
+        f"  n_iter {summary['n_iter']:>3}  n_steps {summary['n_steps'] if summary['n_steps'] is not None else '-':>5}"
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--dimension", type=int, default=1024)
+    parser.add_argument("--clusters", type=int, default=5)
+    parser.add_argument("--changed-ratio", type=float, default=0.05, help="翌日分のデータで入れ替える行の割合")
+    parser.add_argument("--skip-full", action="store_true", help="従来の KMeans を計測しない")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((args.clusters, args.dimension), dtype=np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    day1 = generate_embeddings(rng, centers, args.rows)
+    day2 = day1.copy()
+    changed = rng.choice(args.rows, size=int(args.rows * args.changed_ratio), replace=False)
+    day2[changed] = generate_embeddings(rng, centers, len(changed))
+
+    print(f"# {args.rows} rows x {args.dimension} dims, k={args.clusters}")
+    if not args.skip_full:
+        report("kmeans (float64)", KMeansEngine().fit(day2.astype(np.float64), args.clusters))
+
+    report("minibatch (no centroids)", MiniBatchKMeansEngine().fit(day2, args.clusters))
+
+    store = MemoryCentroidStore()
+    MiniBatchKMeansEngine(store).fit(day1, args.clusters)
+    report("minibatch (warm start)", MiniBatchKMeansEngine(store).fit(day2, args.clusters))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""ナレッジベースの embedding の読み込みを、ast.literal_eval による従来の方法と COPY のバイナリ形式で比較するベンチマーク
+
+実行例: PYTHONPATH=layer/python python benchmarks/embedding_loader_benchmark.py --rows 2000,20000,200000
+データベースには接続しない。pgvector が返す形式のデータ（従来の方法はテキスト表現、バイナリ形式は COPY の出力）を
+生成し、受け取ったデータから float の配列を作るまでの時間を計測する。
+バイナリ形式は psycopg2 の copy_expert と同じく1行ずつ write する。
+従来の方法は時間がかかるため、--legacy-max-rows を超える行数では先頭の行のみ計測して行数に比例させた推定値を表示する。
+"""
+import argparse
+import ast
+import struct
+import time
+import uuid
+
+import numpy as np
+
+from matching_common.embedding_loader import COPY_BINARY_SIGNATURE, CopyBinaryEmbeddingParser
+
+def generate_vectors(rows, dimension, seed):
+    rng = np.random.default_rng(seed)
+    return rng.standard_normal((rows, dimension), dtype=np.float32) * 0.05
+
+def vector_text(vector):
+    """pgvector の vector 型のテキスト表現（例: [0.012345679,-0.03125,...]）"""
+    return "[" + ",".join(f"{value:.9g}" for value in vector.tolist()) + "]"
+
+def copy_binary_messages(ids, vectors):
+    """COPY ... TO STDOUT (FORMAT binary) の出力を1行ずつ返す（先頭にヘッダー、最後に終端）"""
+    dimension = vectors.shape[1]
+    yield COPY_BINARY_SIGNATURE + struct.pack(">ii", 0, 0)
+    vector_header = struct.pack(">ihh", 4 + 4 * dimension, dimension, 0)
+    big_endian = vectors.astype(">f4")
+    for row_id, vector in zip(ids, big_endian):
+        encoded_id = row_id.encode("utf-8")
+        yield struct.pack(">hi", 2, len(encoded_id)) + encoded_id + vector_header + vector.tobytes()
+    yield struct.pack(">h", -1)
+
+def measure_legacy(ids, vectors, rows):
+    """従来の方法（fetchall の結果を ast.literal_eval で解析）"""
+    users = [(row_id, vector_text(vector), "") for row_id, vector in zip(ids[:rows], vectors[:rows])]
+    started = time.perf_counter()
+    embeddings = np.array([ast.literal_eval(user[1]) for user in users])
+    return time.perf_counter() - started, embeddings
+
+def measure_binary(ids, vectors):
+    """COPY のバイナリ形式を CopyBinaryEmbeddingParser で解析"""
+    messages = list(copy_binary_messages(ids, vectors))
+    started = time.perf_counter()
+    parser = CopyBinaryEmbeddingParser(len(ids))
+    for message in messages:
+        parser.write(message)
+    parsed_ids, embeddings = parser.result()
+    elapsed = time.perf_counter() - started
+    assert parsed_ids == ids
+    return elapsed, embeddings
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", default="2000,20000,200000", help="計測する行数（カンマ区切り）")
+    parser.add_argument("--dimension", type=int, default=1024, help="embedding の次元数（Titan Text Embeddings V2 は1024）")
+    parser.add_argument("--legacy-max-rows", type=int, default=2000, help="従来の方法を全行で計測する最大の行数")
+    args = parser.parse_args()
+
+    print(f"{'rows':>8}  {'legacy (literal_eval)':>24}  {'binary (COPY)':>14}  {'speedup':>8}  {'float32 MB':>10}")
+    for rows in (int(value) for value in args.rows.split(",")):
+        ids = [str(uuid.UUID(int=i)) for i in range(rows)]
+        vectors = generate_vectors(rows, args.dimension, seed=rows)
+
+        binary_seconds, binary_embeddings = measure_binary(ids, vectors)
+
+        legacy_rows = min(rows, args.legacy_max_rows)
+        legacy_seconds, legacy_embeddings = measure_legacy(ids, vectors, legacy_rows)
+        # 従来の方法は float64 の配列になるため、float32 に丸めた値で一致を確認する
+        assert np.array_equal(legacy_embeddings.astype(np.float32), binary_embeddings[:legacy_rows])
+        del legacy_embeddings
+        legacy_label = f"{legacy_seconds:.3f} s"
+        if legacy_rows < rows:
+            legacy_seconds *= rows / legacy_rows
+            legacy_label = f"{legacy_seconds:.3f} s (推定)"
+
+        print(
+            f"{rows:>8}  {legacy_label:>24}  {binary_seconds:>12.3f} s  {legacy_seconds / binary_seconds:>7.1f}x"
+            f"  {binary_embeddings.nbytes / 1024 / 1024:>10.1f}"
+        )
+
+if __name__ == "__main__":
+    main()
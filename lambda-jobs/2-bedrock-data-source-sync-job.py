@@ -1,6 +1,7 @@
 import boto3
 import json
 import logging
+from matching_common.metrics import instrument_handler
 
 # ログ設定
 logger = logging.getLogger()
@@ -9,6 +10,7 @@ logger.setLevel(logging.INFO)
 # Bedrock Agentクライアントの初期化
 client = boto3.client('bedrock-agent')
 
+@instrument_handler("bedrock-data-source-sync-job")
 def lambda_handler(event, context):
     try:
         # Knowledge Base IDとData Source IDを指定
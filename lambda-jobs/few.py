@@ -1,36 +1,195 @@
 import json
 import random
-import boto3
 import os
 import logging
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
-from botocore.config import Config
-
-# Lambdaクライアントの設定
-LAMBDA_CLIENT = boto3.client('lambda')
-CHECK_HOLIDAY_LAMBDA_NAME = os.environ.get("CHECK_HOLIDAY_LAMBDA_NAME")
+from matching_common.aws_clients import get_client, pool_size_for, read_s3_json, write_s3_json
+from matching_common.holiday import is_today_holiday
+from matching_common.metrics import instrument_handler, metrics
+from matching_common.response_cache import build_response_cache_from_env, converse_with_cache
+from matching_common.roster import RosterReadStats, stream_s3_jsonl
+from matching_common.chunk_planner import estimate_tokens, plan_chunks
+from matching_common.compact_encoding import decode_member_ids, encode_compact_table, make_compact_cost_functions
+from matching_common.bedrock_stream import converse_stream_groups
+from matching_common.group_merge import ChunkOrderedMerger, GroupMerger
+from matching_common.group_model import GroupSet
+from matching_common.result_writer import DEFAULT_PART_SIZE, EncodedJSON, upload_json_documents
+from matching_common.checkpoint import ChunkCheckpointStore, default_run_id
+from matching_common.rate_limiter import LIMITER_SDK_RETRIES, build_rate_limiter_from_env
+from matching_common.hobby_grouping import MIXED_GROUP_KEY, name_groups, solve_hobby_groups
+from matching_common.batch_inference import (
+    DEFAULT_MIN_RECORDS, FAILED_STATUSES, SUCCEEDED_STATUSES, BatchJobFailedError, BedrockBatchExecutor, LocalBatchExecutor,
+    build_batch_record
+)
+
+# グルーピングに使用するモデルと推論パラメータ
+MODEL_ID = 'anthropic.claude-3-5-sonnet-20240620-v1:0'
+INFERENCE_CONFIG = {
+    "temperature": 0,
+    "maxTokens": 8192
+}
+
+# グループ名・理由の生成（GROUPING_ENGINE=local）に使用する推論パラメータ
+NAMING_INFERENCE_CONFIG = {
+    "temperature": 0,
+    "maxTokens": 300
+}
+
+# グルーピングの方式（"llm": チャンクごとにClaudeがメンバーを決める / "local": 趣味でローカルに割り当て、Claudeはグループ名と理由のみ生成）
+GROUPING_ENGINE = os.environ.get("GROUPING_ENGINE", "llm")
+
+# Bedrockへの同時リクエスト数（1の場合は従来どおりチャンクを逐次処理する）
+BEDROCK_MAX_WORKERS = max(1, int(os.environ.get("BEDROCK_MAX_WORKERS", "1")))
+
+# チャンク分割のトークン予算（1チャンクあたりの入力トークン上限・社員数上限）
+CHUNK_MAX_INPUT_TOKENS = int(os.environ.get("CHUNK_MAX_INPUT_TOKENS", "100000"))
+CHUNK_MAX_EMPLOYEES = int(os.environ.get("CHUNK_MAX_EMPLOYEES", "0")) or None  # 0 の場合は上限なし
+
+# プロンプトの社員データ形式（"json": 全項目をJSONで送信 / "compact": 趣味のみの表と連番IDで送信し、回答の連番IDを employee_id に戻す）
+PROMPT_ENCODING = os.environ.get("PROMPT_ENCODING", "json")
+
+# converse_stream で回答を受信し、完成したグループから順に解析する（"true" の場合）
+BEDROCK_STREAMING = os.environ.get("BEDROCK_STREAMING", "false").lower() == "true"
+
+# バッチ推論モード（"true" の場合、全チャンクを1つのバッチ推論ジョブとして投入する。夜間の定期実行向け）
+# BATCH_WAIT_SECONDS 以内に完了しない場合は 202 を返し、{"batch_job_name": ...} を指定した再実行で結果を取り込む
+BEDROCK_BATCH_MODE = os.environ.get("BEDROCK_BATCH_MODE", "false").lower() == "true"
+BATCH_S3_PREFIX = os.environ.get("BATCH_S3_PREFIX", "bedrock-batch/")
+BATCH_ROLE_ARN = os.environ.get("BATCH_ROLE_ARN")
+BATCH_WAIT_SECONDS = int(os.environ.get("BATCH_WAIT_SECONDS", "780"))
+BATCH_MIN_RECORDS = int(os.environ.get("BATCH_MIN_RECORDS", DEFAULT_MIN_RECORDS))
+# バッチ推論ジョブの実行方法（"bedrock": Bedrockのバッチ推論ジョブ / "local": /tmp に同じ形式のJSONLを書き出し、通常の呼び出しで回答する確認用）
+BATCH_EXECUTOR = os.environ.get("BATCH_EXECUTOR", "bedrock").lower()
+
+# チェックポイント（完了したチャンクをS3に保存し、タイムアウトやエラー後の再実行では未完了のチャンクのみ処理する）
+# "true" の場合、またはイベントに {"run_id": ...} を指定した場合のみ有効（同じ run_id の再実行で再利用する）
+# 実行IDのデフォルトは CHECKPOINT_RUN_ID、未指定の場合は日本時間の日付。結果ファイルの出力に成功したらチェックポイントは削除する
+CHECKPOINT_ENABLED = os.environ.get("CHECKPOINT_ENABLED", "false").lower() == "true"
+CHECKPOINT_S3_PREFIX = os.environ.get("CHECKPOINT_S3_PREFIX", "grouping-checkpoints/")
+
+# 結果ファイルをインデントなしのJSONで出力する（"true" の場合）
+RESULT_JSON_COMPACT = os.environ.get("RESULT_JSON_COMPACT", "false").lower() == "true"
+# 結果ファイルのマルチパートアップロードのパートサイズ（バイト）
+RESULT_UPLOAD_PART_SIZE = int(os.environ.get("RESULT_UPLOAD_PART_SIZE", DEFAULT_PART_SIZE))
+
+# Bedrockレスポンスのキャッシュ（RESPONSE_CACHE_ENABLED=true の場合のみ有効、ウォームコンテナ間で共有）
+# 有効な場合、名簿は ETag をシードにシャッフルするため、同じ名簿の再実行では同じチャンクのプロンプトが再利用される
+RESPONSE_CACHE = build_response_cache_from_env()
+
+# Bedrock呼び出しの流量制限とスロットリング時の再試行（BEDROCK_RATE_LIMIT_ENABLED=false で無効）
+# 同時実行数の上限は BEDROCK_MAX_CONCURRENCY（未指定の場合は BEDROCK_MAX_WORKERS）
+BEDROCK_LIMITER = build_rate_limiter_from_env(max_concurrency=BEDROCK_MAX_WORKERS)
+
+# Bedrockクライアントの Config の設定
+BEDROCK_CLIENT_CONFIG = {"read_timeout": 1000, "max_pool_connections": pool_size_for(BEDROCK_MAX_WORKERS)}
+if BEDROCK_LIMITER:
+    BEDROCK_CLIENT_CONFIG["retries"] = LIMITER_SDK_RETRIES
 
 # ロガーの設定
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def lambda_handler(event, context):
-    # S3クライアントの設定
-    s3 = boto3.client('s3')
+def create_clients():
+    """S3クライアントとBedrockクライアントを返す関数（ウォームコンテナでは作成済みのクライアントを再利用する）"""
+    # チェックポイントの保存が並列に行われるため、プールサイズを同時実行数に合わせる
+    s3 = get_client('s3', max_pool_connections=pool_size_for(BEDROCK_MAX_WORKERS))
 
+    # Bedrockクライアントの設定
     # クライアントの読み取りタイムアウト値を増やす
-    config = Config(read_timeout=1000)
+    # 並列実行時にコネクションが不足しないようプールサイズを同時実行数に合わせる
+    # リミッター使用時は再試行をリミッターに任せる（botocore 側の再試行ではスロットリングを検知できないため）
+    bedrock = get_client('bedrock-runtime', region_name='ap-northeast-1', **BEDROCK_CLIENT_CONFIG)
+    return s3, bedrock
+
+class S3ResultSink:
+    """グルーピング結果（全体ファイルとサマリーファイル）をS3に書き込むクラス"""
+
+    def __init__(self, s3, bucket_name, output_key, summary_output_key):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.output_key = output_key
+        self.summary_output_key = summary_output_key
+        self.output_location = f's3://{bucket_name}/{output_key}'
+        self.summary_location = f's3://{bucket_name}/{summary_output_key}'
+
+    def write_empty(self, result):
+        """空の結果（祝日・データなし・エラー）を両方のファイルに書き込む"""
+        write_s3_json(self.s3, self.bucket_name, self.output_key, result)
+        write_s3_json(self.s3, self.bucket_name, self.summary_output_key, result)
+
+    def write_results(self, processing_info, chunk_results, group_set):
+        """グループ情報のJSONエンコードは1回だけ行い、2つのファイルで共有して並行してストリーミングでアップロードする"""
+        indent = None if RESULT_JSON_COMPACT else 2
+        groups_json = EncodedJSON(group_set.to_json(), indent=indent)
+        summary = group_set.summary()
+        documents = {
+            self.output_key: [
+                ("processing_info", processing_info),
+                ("chunk_details", chunk_results),
+                ("groups", groups_json),
+                ("summary", summary)
+            ],
+            self.summary_output_key: [
+                ("groups", groups_json),
+                ("summary", summary)
+            ]
+        }
+        upload_json_documents(self.s3, self.bucket_name, documents, indent=indent, part_size=RESULT_UPLOAD_PART_SIZE)
+
+class MemoryResultSink:
+    """グルーピング結果（全体ファイルの内容）をメモリに保持するクラス（パイプライン実行用）
+
+    materialize_to に S3ResultSink を指定した場合は、デバッグ用にS3にも同じファイルを書き込む。
+    """
+
+    def __init__(self, materialize_to=None):
+        self.materialize_to = materialize_to
+        self.written = False
+        self.group_set = None
+        self._empty_result = None
+        self._results = None
+        self.output_location = materialize_to.output_location if materialize_to else 'memory'
+        self.summary_location = materialize_to.summary_location if materialize_to else 'memory'
+
+    def write_empty(self, result):
+        self.written = True
+        self.group_set = GroupSet(())
+        self._empty_result = result
+        if self.materialize_to:
+            self.materialize_to.write_empty(result)
+
+    def write_results(self, processing_info, chunk_results, group_set):
+        self.written = True
+        self.group_set = group_set
+        self._results = (processing_info, chunk_results)
+        if self.materialize_to:
+            self.materialize_to.write_results(processing_info, chunk_results, group_set)
+
+    @property
+    def document(self):
+        """全体ファイルと同じ形式の辞書（後段は group_set を直接使うため、必要な場合のみ作成する）"""
+        if self._results is None:
+            return self._empty_result
+        processing_info, chunk_results = self._results
+        return {
+            "processing_info": processing_info,
+            "chunk_details": chunk_results,
+            "groups": self.group_set.to_json(),
+            "summary": self.group_set.summary()
+        }
 
-    # Bedrockクライアントの設定
-    bedrock = boto3.client(service_name='bedrock-runtime', region_name='ap-northeast-1', config=config)
+@instrument_handler("few")
+def lambda_handler(event, context):
+    s3, bedrock = create_clients()
 
     # S3バケットとオブジェクト情報の取得
     bucket_name = os.environ.get('S3_BUCKET_NAME')
     input_bucket_name = os.environ.get('INPUT_S3_BUCKET_NAME')
     file_key = os.environ.get('S3_FILE_KEY')
-    output_key = os.environ.get('S3_OUTPUT_KEY')
-    summary_output_key = os.environ.get('S3_SUMMARY_OUTPUT_KEY')
+    sink = S3ResultSink(s3, bucket_name, os.environ.get('S3_OUTPUT_KEY'), os.environ.get('S3_SUMMARY_OUTPUT_KEY'))
 
     if is_today_holiday():
         logger.info("今日は祝日です。処理をスキップします。")
@@ -42,39 +201,37 @@ def lambda_handler(event, context):
         }
         
         # 空の結果をS3にJSONでアップロード
-        s3.put_object(
-            Bucket=bucket_name,
-            Key=output_key,
-            Body=json.dumps(empty_result, ensure_ascii=False, indent=2),
-            ContentType='application/json'
-        )
-        
-        s3.put_object(
-            Bucket=bucket_name,
-            Key=summary_output_key,
-            Body=json.dumps(empty_result, ensure_ascii=False, indent=2),
-            ContentType='application/json'
-        )
+        sink.write_empty(empty_result)
         
         return {
             'statusCode': 200,
             'body': json.dumps({'message': '今日は祝日なので処理をスキップしました'})
         }
-        
+
+    return run_grouping(event, s3, bedrock, sink, bucket_name, input_bucket_name, file_key)
+
+def run_grouping(event, s3, bedrock, sink, bucket_name, input_bucket_name, file_key):
+    """社員データを読み込んでグルーピングし、結果を sink に書き込む関数（祝日判定は呼び出し側で行う）
+
+    bucket_name はチェックポイントとバッチ推論の保存先のデフォルトのバケット。
+    """
+    checkpoint_store = None
     try:
-        # S3からJSONLデータを取得
-        response = s3.get_object(Bucket=input_bucket_name, Key=file_key)
-        file_content = response['Body'].read().decode('utf-8')
-
-        # JSONLデータを解析（各行が独立したJSONオブジェクト）
-        employees = []
-        for line in file_content.strip().split('\n'):
-            if line.strip():
-                try:
-                    employee = json.loads(line)
-                    employees.append(employee)
-                except json.JSONDecodeError:
-                    continue
+        if BEDROCK_BATCH_MODE and (event or {}).get("batch_job_name"):
+            # 投入済みのバッチ推論ジョブの結果を取り込む（前回の実行で完了待ちが時間切れになった場合）
+            batch_executor = create_batch_executor(s3, bedrock, bucket_name)
+            manifest = load_batch_manifest(s3, bucket_name, event["batch_job_name"])
+            chunks = [[{"employee_id": employee_id} for employee_id in chunk_ids] for chunk_ids in manifest["chunk_employee_ids"]]
+            return collect_batch_and_upload(batch_executor, manifest["job"], chunks, manifest["processing_info"], sink)
+
+        # S3からJSONLデータをストリーミングで取得・解析（各行が独立したJSONオブジェクト）
+        # ファイル全体の文字列や行リストは保持せず、解析済みのレコードのみを保持する
+        roster_stats = RosterReadStats()
+        with metrics.stage("read_roster"):
+            employees = list(stream_s3_jsonl(s3, input_bucket_name, file_key, stats=roster_stats))
+        metrics.count("EmployeesRead", len(employees))
+        if roster_stats.skipped_lines:
+            logger.warning(f"解析できなかった行をスキップしました: {roster_stats.skipped_lines}行")
 
         # データが空の場合は空の結果ファイルを生成
         if not employees:
@@ -86,131 +243,110 @@ def lambda_handler(event, context):
             }
             
             # 空の結果をS3にJSONでアップロード
-            s3.put_object(
-                Bucket=bucket_name,
-                Key=output_key,
-                Body=json.dumps(empty_result, ensure_ascii=False, indent=2),
-                ContentType='application/json'
-            )
-            
-            s3.put_object(
-                Bucket=bucket_name,
-                Key=summary_output_key,
-                Body=json.dumps(empty_result, ensure_ascii=False, indent=2),
-                ContentType='application/json'
-            )
+            sink.write_empty(empty_result)
             
             return {
                 'statusCode': 200,
                 'body': json.dumps({
                     'message': 'No employee data found, empty result files created',
-                    'output_location': f's3://{bucket_name}/{output_key}',
-                    'summary_location': f's3://{bucket_name}/{summary_output_key}',
+                    'output_location': sink.output_location,
+                    'summary_location': sink.summary_location,
                     'group_count': 0
                 })
             }
 
-        # データをランダムにシャッフル
-        random.shuffle(employees)
-
-        # データを複数のチャンクに分割（Claudeの入力制限を考慮）
-        chunk_size = min(100, len(employees))
-        chunks = [employees[i:i + chunk_size] for i in range(0, len(employees), chunk_size)]
-
-        # 各チャンクをClaudeに送信してグルーピング
-        all_groups = {}
-        chunk_results = []
-
-        for i, chunk in enumerate(chunks):
-            print(f"Processing chunk {i+1}/{len(chunks)} with {len(chunk)} employees")
-
-            # Claudeへのプロンプト作成
-            prompt = create_prompt(chunk)
-
-            # Claudeに送信
-            response = bedrock.converse(
-                modelId='anthropic.claude-3-5-sonnet-20240620-v1:0',
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "text": prompt
-                            }
-                        ]
-                    }
-                ],
-                inferenceConfig={
-                    "temperature": 0,
-                    "maxTokens": 8192
-                }
-            )
-
-            # レスポンスから回答を取得
-            result = response['output']['message']['content'][0]['text']
-
-            # チャンク結果を保存
-            chunk_results.append({
-                "chunk_id": i + 1,
-                "employees_count": len(chunk),
-                "claude_response": result
-            })
-
-            # グループ情報を解析して統合
-            chunk_groups = parse_groups_from_json(result)
-            all_groups = merge_groups(all_groups, chunk_groups)
-
-        # 最終結果をJSON形式で構成
-        final_result = {
-            "processing_info": {
+        if GROUPING_ENGINE == "local":
+            # 趣味の転置インデックスからローカルでメンバーを割り当て、グループごとに名前と理由のみClaudeで生成する
+            with metrics.stage("solve_hobby_groups"):
+                hobby_groups = solve_hobby_groups(employees)
+            with metrics.stage("name_groups"):
+                all_groups = name_groups(hobby_groups, lambda group: name_hobby_group(bedrock, group), max_workers=BEDROCK_MAX_WORKERS)
+            processing_info = {
                 "total_employees": len(employees),
-                "chunks_processed": len(chunks),
+                "skipped_lines": roster_stats.skipped_lines,
+                "grouping_engine": GROUPING_ENGINE,
+                "naming_calls": len(hobby_groups),
                 "processing_date": None  # 必要に応じて日付を追加
-            },
-            "chunk_details": chunk_results,
-            "groups": format_groups_for_output(all_groups),
-            "summary": {
-                "total_groups": len(all_groups),
-                "total_members_grouped": sum(len(group['members']) for group in all_groups.values())
-            }
-        }
-
-        # サマリー用のデータ（グループ情報のみ）
-        summary_result = {
-            "groups": format_groups_for_output(all_groups),
-            "summary": {
-                "total_groups": len(all_groups),
-                "total_members_grouped": sum(len(group['members']) for group in all_groups.values())
             }
-        }
-
-        # 結果をS3にJSONファイルとしてアップロード（全体ファイル）
-        s3.put_object(
-            Bucket=bucket_name,
-            Key=output_key,
-            Body=json.dumps(final_result, ensure_ascii=False, indent=2),
-            ContentType='application/json'
-        )
-
-        # サマリーファイルをアップロード
-        s3.put_object(
-            Bucket=bucket_name,
-            Key=summary_output_key,
-            Body=json.dumps(summary_result, ensure_ascii=False, indent=2),
-            ContentType='application/json'
-        )
+            return write_grouping_results(all_groups, [], processing_info, sink)
+
+        if CHECKPOINT_ENABLED or (event or {}).get("run_id"):
+            checkpoint_store = ChunkCheckpointStore(
+                s3,
+                os.environ.get("CHECKPOINT_S3_BUCKET", bucket_name),
+                CHECKPOINT_S3_PREFIX,
+                (event or {}).get("run_id") or os.environ.get("CHECKPOINT_RUN_ID") or default_run_id(),
+                roster_stats.etag
+            )
 
-        return {
-            'statusCode': 200,
-            'body': json.dumps({
-                'message': 'Employee grouping completed successfully',
-                'output_location': f's3://{bucket_name}/{output_key}',
-                'summary_location': f's3://{bucket_name}/{summary_output_key}',
-                'group_count': len(all_groups)
-            })
+        # データをランダムにシャッフル
+        # チェックポイント利用時は、再実行で同じチャンク構成になるよう実行IDと名簿のETagをシードにする
+        # レスポンスキャッシュ利用時は、同じ名簿から同じプロンプトが作られるよう名簿のETagをシードにする
+        if checkpoint_store:
+            random.Random(checkpoint_store.seed).shuffle(employees)
+        elif RESPONSE_CACHE:
+            random.Random(roster_stats.etag or "").shuffle(employees)
+        else:
+            random.shuffle(employees)
+
+        # データを複数のチャンクに分割（入力トークン予算と出力上限8192トークンに収まる最少のチャンク数）
+        if PROMPT_ENCODING == "compact":
+            input_cost, output_cost = make_compact_cost_functions()
+            chunk_plan = plan_chunks(
+                employees,
+                prompt_overhead_tokens=estimate_tokens(create_compact_prompt([])),
+                max_input_tokens=CHUNK_MAX_INPUT_TOKENS,
+                max_output_tokens=INFERENCE_CONFIG["maxTokens"],
+                max_chunk_size=CHUNK_MAX_EMPLOYEES,
+                input_cost=input_cost,
+                output_cost=output_cost
+            )
+        else:
+            chunk_plan = plan_chunks(
+                employees,
+                prompt_overhead_tokens=estimate_tokens(create_prompt([])),
+                max_input_tokens=CHUNK_MAX_INPUT_TOKENS,
+                max_output_tokens=INFERENCE_CONFIG["maxTokens"],
+                max_chunk_size=CHUNK_MAX_EMPLOYEES
+            )
+        chunks = chunk_plan.chunks
+        logger.info(f"チャンク分割計画: {json.dumps(chunk_plan.to_dict(), ensure_ascii=False)}")
+
+        processing_info = {
+            "total_employees": len(employees),
+            "skipped_lines": roster_stats.skipped_lines,
+            "chunks_processed": len(chunks),
+            "prompt_encoding": PROMPT_ENCODING,
+            "chunk_plan": chunk_plan.to_dict(),
+            "processing_date": None  # 必要に応じて日付を追加
         }
 
-    except ClientError as e:
+        if BEDROCK_BATCH_MODE and len(chunks) >= BATCH_MIN_RECORDS:
+            # 全チャンクを1つのバッチ推論ジョブとして投入し、完了を待って結果を取り込む
+            batch_executor = create_batch_executor(s3, bedrock, bucket_name)
+            batch_job = submit_batch_chunks(batch_executor, s3, bucket_name, chunks, processing_info)
+            return collect_batch_and_upload(batch_executor, batch_job, chunks, processing_info, sink)
+
+        if BEDROCK_BATCH_MODE:
+            logger.info(f"チャンク数が {BATCH_MIN_RECORDS} 件未満のため、バッチ推論ではなく通常の呼び出しで処理します")
+
+        # 各チャンクをClaudeに送信してグルーピング（BEDROCK_MAX_WORKERS > 1 の場合は並列実行）
+        # グループは受信したチャンクから（ストリーミング時は完成したグループから）チャンク順に統合する
+        merger = ChunkOrderedMerger(GroupMerger(exclusive_members=True), len(chunks))
+        with metrics.stage("invoke_chunks"):
+            chunk_responses = process_chunks(bedrock, chunks, BEDROCK_MAX_WORKERS, checkpoint_store=checkpoint_store, merger=merger)
+        metrics.count("ChunksProcessed", len(chunks))
+        if checkpoint_store:
+            processing_info["checkpoint"] = checkpoint_store.stats()
+
+        response = upload_grouping_results(chunks, chunk_responses, processing_info, sink, merger=merger.merger)
+        if checkpoint_store:
+            # 結果ファイルを出力できたため、この実行のチェックポイントは不要
+            checkpoint_store.delete_run()
+            logger.info(f"チェックポイントを削除しました: {checkpoint_store.deleted_count}件")
+        return response
+
+    except (ClientError, BatchJobFailedError) as e:
         print(f"Error: {e}")
         # エラーが発生した場合も空の結果ファイルを生成
         try:
@@ -220,21 +356,17 @@ def lambda_handler(event, context):
                 "total_groups": 0,
                 "total_members": 0
             }
+            if isinstance(e, BatchJobFailedError):
+                error_result["batch_job_arn"] = e.job_arn
+                error_result["batch_job_status"] = e.status
+            if checkpoint_store:
+                # 完了済みのチャンクはチェックポイントに保存されているため、再実行すると残りのチャンクのみ処理する
+                error_result["checkpoint"] = checkpoint_store.stats()
+            if BEDROCK_LIMITER:
+                error_result["rate_limiter"] = BEDROCK_LIMITER.stats()
             
             # エラー結果をS3にJSONでアップロード
-            s3.put_object(
-                Bucket=bucket_name,
-                Key=output_key,
-                Body=json.dumps(error_result, ensure_ascii=False, indent=2),
-                ContentType='application/json'
-            )
-            
-            s3.put_object(
-                Bucket=bucket_name,
-                Key=summary_output_key,
-                Body=json.dumps(error_result, ensure_ascii=False, indent=2),
-                ContentType='application/json'
-            )
+            sink.write_empty(error_result)
         except Exception as upload_error:
             print(f"Error uploading empty result files: {upload_error}")
             
@@ -243,6 +375,301 @@ def lambda_handler(event, context):
             'body': json.dumps(f'Error processing the request: {str(e)}')
         }
 
+def upload_grouping_results(chunks, chunk_responses, processing_info, sink, merger=None):
+    """チャンクごとの回答を統合し、全体ファイルとサマリーファイルをS3にアップロードする関数
+
+    merger を指定した場合は、チャンクの受信中に統合済みの GroupMerger として使用する。
+    """
+    # 並列実行時も結果が決定的になるよう、チャンク順に統合する
+    # グループ名は表記ゆれ（括弧・全角半角・末尾の「グループ」）を正規化して統合し、メンバーIDの重複を除く
+    merged = merger is not None
+    if not merged:
+        merger = GroupMerger(exclusive_members=True)
+    chunk_results = []
+
+    for i, (chunk, (result, chunk_groups)) in enumerate(zip(chunks, chunk_responses)):
+        # チャンク結果を保存
+        chunk_results.append({
+            "chunk_id": i + 1,
+            "employees_count": len(chunk),
+            "claude_response": result
+        })
+
+        # グループ情報を統合
+        if not merged:
+            merger.add_groups(chunk_groups)
+
+    merge_report = merger.report()
+    if merge_report["duplicate_member_count"] or merge_report["conflict_member_count"]:
+        logger.warning(
+            f"重複したメンバーIDを除外しました: グループ内 {merge_report['duplicate_member_count']}件, "
+            f"グループ間 {merge_report['conflict_member_count']}件"
+        )
+
+    return write_grouping_results(merger.to_groups(), chunk_results, dict(processing_info, merge_report=merge_report), sink)
+
+def write_grouping_results(all_groups, chunk_results, processing_info, sink):
+    """統合済みのグループ情報から全体ファイルとサマリーファイルの内容を作成し、sink に書き込む関数
+
+    グループ情報の整形（メンバー数の多い順）は1回だけ行い、両方のファイルで共有する。
+    """
+    group_set = GroupSet.from_merged(all_groups)
+
+    # 最終結果（全体ファイル）とサマリー用のデータ（グループ情報のみ）
+    processing_info = dict(
+        processing_info,
+        response_cache=RESPONSE_CACHE.stats() if RESPONSE_CACHE else None,
+        rate_limiter=BEDROCK_LIMITER.stats() if BEDROCK_LIMITER else None
+    )
+
+    # 結果をS3にJSONファイルとしてアップロード（全体ファイルとサマリーファイル）
+    with metrics.stage("write_results"):
+        sink.write_results(processing_info, chunk_results, group_set)
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'message': 'Employee grouping completed successfully',
+            'output_location': sink.output_location,
+            'summary_location': sink.summary_location,
+            'group_count': len(all_groups)
+        })
+    }
+
+def create_batch_executor(s3, bedrock, bucket_name):
+    """バッチ推論ジョブの実行クラスを作成する関数
+
+    BATCH_EXECUTOR=local の場合は、バッチ推論ジョブを作成せずに各レコードを通常の呼び出しで処理する LocalBatchExecutor を使う
+    （バッチ推論のロールがない環境で、レコードの作成から結果の取り込みまでを確認する用途）。
+    """
+    if BATCH_EXECUTOR == "local":
+        def respond(model_input):
+            prompt = model_input["messages"][0]["content"][0]["text"]
+            return converse_with_cache(bedrock, MODEL_ID, prompt, INFERENCE_CONFIG, cache=RESPONSE_CACHE, limiter=BEDROCK_LIMITER)
+        return LocalBatchExecutor(respond)
+
+    bedrock_control = get_client('bedrock', region_name='ap-northeast-1')
+    return BedrockBatchExecutor(
+        bedrock_control,
+        s3,
+        os.environ.get("BATCH_S3_BUCKET", bucket_name),
+        BATCH_S3_PREFIX,
+        BATCH_ROLE_ARN,
+        MODEL_ID
+    )
+
+def batch_manifest_key(job_name):
+    return f"{BATCH_S3_PREFIX.rstrip('/')}/{job_name}/manifest.json"
+
+def load_batch_manifest(s3, bucket_name, job_name):
+    """バッチ推論ジョブの投入時に保存したマニフェストを読み込む関数"""
+    return read_s3_json(s3, os.environ.get("BATCH_S3_BUCKET", bucket_name), batch_manifest_key(job_name))
+
+def submit_batch_chunks(batch_executor, s3, bucket_name, chunks, processing_info):
+    """全チャンクのプロンプトを1つのバッチ推論ジョブとして投入し、結果の取り込みに必要な情報をマニフェストとして保存する関数"""
+    records = [
+        build_batch_record(f"CHUNK{i + 1:07d}", build_chunk_prompt(chunk), INFERENCE_CONFIG)
+        for i, chunk in enumerate(chunks)
+    ]
+    job_name = f"employee-grouping-{int(time.time())}"
+    batch_job = batch_executor.submit(records, job_name)
+
+    # 再実行時に同じチャンク構成で結果を取り込めるよう、チャンクごとの社員IDを保存する
+    manifest = {
+        "job": batch_job,
+        "chunk_employee_ids": [[employee.get("employee_id") for employee in chunk] for chunk in chunks],
+        "processing_info": processing_info
+    }
+    write_s3_json(s3, os.environ.get("BATCH_S3_BUCKET", bucket_name), batch_manifest_key(job_name), manifest, indent=None)
+    return batch_job
+
+def collect_batch_and_upload(batch_executor, batch_job, chunks, processing_info, sink):
+    """バッチ推論ジョブの完了を待って結果を取り込み、既存の解析・統合処理で結果ファイルを作成する関数"""
+    with metrics.stage("batch_inference_wait"):
+        status = batch_executor.wait(batch_job, BATCH_WAIT_SECONDS)
+
+    if status in FAILED_STATUSES:
+        raise BatchJobFailedError(batch_job, status)
+
+    if status not in SUCCEEDED_STATUSES:
+        logger.info(f"バッチ推論ジョブが実行中のため、後続の実行で結果を取り込みます: {batch_job['job_name']} ({status})")
+        return {
+            'statusCode': 202,
+            'body': json.dumps({
+                'message': 'Batch inference job is still running',
+                'batch_job_name': batch_job['job_name'],
+                'batch_job_arn': batch_job['job_arn'],
+                'status': status
+            })
+        }
+
+    batch_results = batch_executor.fetch_results(batch_job)
+    chunk_responses = []
+    failed_records = []
+    for i, chunk in enumerate(chunks):
+        result = batch_results.get(f"CHUNK{i + 1:07d}")
+        if not result:
+            # 出力がない・エラーになったレコードのチャンクの社員は、どのグループにも含まれない
+            failed_records.append(i + 1)
+            result = ""
+        chunk_responses.append((result, parse_chunk_response(result, chunk)))
+
+    if failed_records:
+        logger.warning(
+            f"バッチ推論の回答を取得できなかったチャンクがあります: {failed_records} "
+            f"（社員 {sum(len(chunks[chunk_id - 1]) for chunk_id in failed_records)}人がグループに含まれません）"
+        )
+        metrics.count("BatchFailedRecords", len(failed_records))
+
+    processing_info = dict(processing_info, batch_job_arn=batch_job['job_arn'], failed_batch_records=failed_records)
+    return upload_grouping_results(chunks, chunk_responses, processing_info, sink)
+
+def build_chunk_prompt(chunk):
+    """PROMPT_ENCODING に応じてチャンクのプロンプトを作成する関数"""
+    if PROMPT_ENCODING == "compact":
+        return create_compact_prompt(chunk)
+    return create_prompt(chunk)
+
+def parse_chunk_response(result, chunk):
+    """チャンクの回答テキストからグループ情報を解析する関数"""
+    chunk_groups = parse_groups_from_json(result)
+    if PROMPT_ENCODING == "compact":
+        # 連番IDをチャンク内の並び順から employee_id に戻す
+        chunk_groups = decode_member_ids(chunk_groups, chunk)
+    return chunk_groups
+
+def invoke_chunk(bedrock, chunk_id, total_chunks, chunk, on_groups=None):
+    """1チャンク分の社員データをClaudeに送信し、回答テキスト・解析済みのグループ情報・stopReason を返す関数
+
+    on_groups を指定した場合、解析したグループ（グループ名 -> {"members", "reason"}）を渡して呼び出す。
+    ストリーミング時は完成したグループごとに、それ以外は回答の解析後にまとめて1回呼び出す。
+    """
+    print(f"Processing chunk {chunk_id}/{total_chunks} with {len(chunk)} employees")
+
+    # Claudeへのプロンプト作成
+    prompt = build_chunk_prompt(chunk)
+
+    if BEDROCK_STREAMING:
+        # 回答の受信中に、閉じ括弧が届いたグループから順に解析・IDの変換を行う
+        chunk_groups = {}
+
+        def on_group(group):
+            parsed_group = {}
+            add_group_from_json(parsed_group, group)
+            if PROMPT_ENCODING == "compact":
+                parsed_group = decode_member_ids(parsed_group, chunk)
+            for group_name, group_info in parsed_group.items():
+                add_parsed_group(chunk_groups, group_name, group_info['members'], group_info['reason'])
+            if on_groups is not None:
+                on_groups(parsed_group)
+
+        result, stop_reason = converse_stream_groups(
+            bedrock, MODEL_ID, prompt, INFERENCE_CONFIG, on_group=on_group, cache=RESPONSE_CACHE, limiter=BEDROCK_LIMITER, return_stop_reason=True
+        )
+        if chunk_groups:
+            return result, chunk_groups, stop_reason
+    else:
+        # Claudeに送信（同一プロンプトの再実行時はキャッシュから回答を取得）
+        result, stop_reason = converse_with_cache(
+            bedrock, MODEL_ID, prompt, INFERENCE_CONFIG, cache=RESPONSE_CACHE, limiter=BEDROCK_LIMITER, return_stop_reason=True
+        )
+
+    # グループ情報を解析
+    chunk_groups = parse_chunk_response(result, chunk)
+    if on_groups is not None:
+        on_groups(chunk_groups)
+    return result, chunk_groups, stop_reason
+
+def run_chunk(bedrock, chunk_id, total_chunks, chunk, checkpoint_store=None, merger=None):
+    """チェックポイントがあれば再利用し、なければClaudeに送信して結果をチェックポイントに保存する関数
+
+    merger（ChunkOrderedMerger）を指定した場合、グループを解析した時点で統合し、最後にチャンクの完了を記録する。
+    """
+    on_groups = (lambda groups: merger.add_groups(chunk_id - 1, groups)) if merger is not None else None
+
+    if checkpoint_store:
+        restored = checkpoint_store.load(chunk_id, chunk)
+        if restored is not None:
+            print(f"Restored chunk {chunk_id}/{total_chunks} from checkpoint")
+            metrics.count("CheckpointRestoredChunks")
+            if merger is not None:
+                on_groups(restored[1])
+                merger.complete(chunk_id - 1)
+            return restored
+
+    result, chunk_groups, stop_reason = invoke_chunk(bedrock, chunk_id, total_chunks, chunk, on_groups=on_groups)
+    if merger is not None:
+        merger.complete(chunk_id - 1)
+
+    if checkpoint_store:
+        if chunk_groups and stop_reason != "max_tokens":
+            checkpoint_store.save(chunk_id, chunk, result, chunk_groups)
+        else:
+            # 解析できなかった・打ち切られた回答は保存せず、再実行時にもう一度送信する
+            logger.warning(f"チャンク {chunk_id} は完了しなかったためチェックポイントに保存しません（stopReason: {stop_reason}）")
+            metrics.count("CheckpointSkippedChunks")
+    return result, chunk_groups
+
+def process_chunks(bedrock, chunks, max_workers=1, checkpoint_store=None, merger=None):
+    """全チャンクをClaudeに送信し、(回答テキスト, グループ情報) をチャンク順のリストで返す関数
+
+    max_workers が2以上の場合はスレッドプールで並列に送信する。
+    同時に実行中のリクエストは max_workers 件までに制限される。
+    いずれかのチャンクで例外が発生した場合、未着手のチャンクはキャンセルして例外を送出する。
+    checkpoint_store を指定した場合、完了済みのチャンクは送信せずに保存済みの結果を使う。
+    merger（ChunkOrderedMerger）を指定した場合、各チャンクのグループは他のチャンクの受信中に統合する。
+    """
+    total_chunks = len(chunks)
+
+    if max_workers <= 1 or total_chunks <= 1:
+        return [run_chunk(bedrock, i + 1, total_chunks, chunk, checkpoint_store, merger) for i, chunk in enumerate(chunks)]
+
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, total_chunks))
+    try:
+        futures = [
+            executor.submit(run_chunk, bedrock, i + 1, total_chunks, chunk, checkpoint_store, merger)
+            for i, chunk in enumerate(chunks)
+        ]
+        # 完了順ではなく投入順に結果を取り出し、チャンク順を保つ
+        return [future.result() for future in futures]
+    except Exception:
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    finally:
+        executor.shutdown(wait=True)
+
+def name_hobby_group(bedrock, group):
+    """趣味で割り当てたグループのグループ名と理由をClaudeで生成する関数"""
+    response_text = converse_with_cache(bedrock, MODEL_ID, create_naming_prompt(group), NAMING_INFERENCE_CONFIG, cache=RESPONSE_CACHE, limiter=BEDROCK_LIMITER)
+    json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
+    naming = json.loads(json_match.group(0) if json_match else response_text)
+    return naming.get('グループ名'), naming.get('理由', '')
+
+def create_naming_prompt(group):
+    """グループ名と理由を生成するためのプロンプトを作成する関数"""
+    if group.hobby is MIXED_GROUP_KEY:
+        theme = "さまざまな趣味を持つメンバーが集まった（共通の趣味はない）"
+    elif group.extra_members:
+        theme = f"メンバーの多くが「{group.hobby}」を趣味としている"
+    else:
+        theme = f"メンバー全員が「{group.hobby}」を趣味としている"
+
+    prompt = f"""
+あなたはデータ分析の専門家です。
+{theme}{len(group.members)}人のグループに、グループ名とグルーピング理由を付けてください。
+
+ルール：
+・グループ名には必ず「」をつける。
+・グループ名は通販番組の商品紹介のように興味をひくものにする。
+・出力するグループ名は必ず最後に「グループ」をつける。
+・グルーピング理由を説明する１文を追加する。
+
+**重要**: 回答は必ず以下のJSON形式のみで出力してください。
+
+{{"グループ名": "「アウトドア愛好家グループ」", "理由": "メンバー全員がアウトドア活動を趣味としているため"}}
+"""
+    return prompt
+
 def create_prompt(employees):
     """Claudeへのプロンプトを作成する関数"""
     employees_json = json.dumps(employees, ensure_ascii=False)
@@ -296,6 +723,54 @@ def create_prompt(employees):
 """
     return prompt
 
+def create_compact_prompt(employees):
+    """Claudeへのプロンプトを作成する関数（趣味のみの表と連番IDによるコンパクト形式）"""
+    employees_table = encode_compact_table(employees)
+
+    prompt = f"""
+あなたはデータ分析の専門家です。
+全社員のデータを閲覧しグループ分けできる権限を持っています。
+社員全員を下記ルールでグループ分けしてください。
+出力形式は以下の例に厳密に従ってください。句読点や括弧の形式も正確に守ってください。
+
+**重要**: 回答は必ずJSON形式で出力してください。
+
+出力形式:
+```json
+[
+  {{
+    "グループ名": "「アウトドア愛好家グループ」",
+    "理由": "メンバー全員がアウトドア活動を趣味としているため",
+    "メンバーID": [1, 5, 12]
+  }},
+  {{
+    "グループ名": "「読書クラブグループ」",
+    "理由": "読書が共通の趣味であるため",
+    "メンバーID": [2, 3, 8]
+  }}
+]
+```
+
+グループ分けのルール：
+・「趣味」でグルーピングする。
+・各グループの人数は8人以上100人以下とする。
+・1人1つだけのグループに所属する。
+・グループ名は直感的にわかりやすくする。
+
+出力形式：
+・各グループのグループ名を表示する。
+・グループ名には必ず「」をつける。
+・グループ名は通販番組の商品紹介のように興味をひくものにする。
+・出力するグループ名は必ず最後に「グループ」をつける。
+・各グループのメンバー全員のIDを、社員データの「ID」列の数値のリスト形式で表示する。
+・グルーピング理由を説明する１文を追加する。
+・回答は必ずJSON配列形式で出力する。
+
+社員データ（1行目は列名、各行は「ID|趣味」で趣味はカンマ区切り）:
+{employees_table}
+"""
+    return prompt
+
 def parse_groups_from_json(result):
     """ClaudeのJSON回答からグループ情報を抽出する関数"""
     groups = {}
@@ -320,12 +795,7 @@ def parse_groups_from_json(result):
         # リスト形式の場合
         if isinstance(group_list, list):
             for group in group_list:
-                if isinstance(group, dict) and 'グループ名' in group:
-                    group_name = group['グループ名']
-                    groups[group_name] = {
-                        'members': group.get('メンバーID', []),
-                        'reason': group.get('理由', '')
-                    }
+                add_group_from_json(groups, group)
         # オブジェクト形式の場合
         elif isinstance(group_list, dict):
             for key, value in group_list.items():
@@ -346,6 +816,28 @@ def parse_groups_from_json(result):
     
     return groups
 
+def add_group_from_json(groups, group):
+    """JSON配列の要素1件（グループ名・理由・メンバーID）をグループ情報に追加する関数"""
+    if isinstance(group, dict) and 'グループ名' in group:
+        add_parsed_group(groups, group['グループ名'], group.get('メンバーID', []), group.get('理由', ''))
+
+def add_parsed_group(groups, group_name, members, reason):
+    """解析したグループをグループ情報に追加する関数
+
+    1つの回答で同じグループ名が繰り返された場合は、GroupMerger と同じく統合する（メンバーは連結、理由は最初の空でないもの）。
+    そのため、ストリーミング中に両方を統合した結果と、チェックポイントや非ストリーミングの結果が一致する。
+    """
+    existing = groups.get(group_name)
+    if existing is None:
+        groups[group_name] = {
+            'members': members,
+            'reason': reason
+        }
+        return
+    existing['members'] = list(existing['members']) + list(members)
+    if not existing['reason'] and reason:
+        existing['reason'] = reason
+
 def parse_groups_from_text_fallback(result):
     """JSON解析に失敗した場合のテキスト解析フォールバック"""
     groups = {}
@@ -378,58 +870,3 @@ def parse_groups_from_text_fallback(result):
             groups[current_group]["reason"] = line.strip()
 
     return groups
-
-def merge_groups(all_groups, new_groups):
-    """複数のチャンクから得られたグループ情報を統合する関数"""
-    for group_name, group_info in new_groups.items():
-        if group_name in all_groups:
-            # 既存のグループにメンバーを追加
-            all_groups[group_name]["members"].extend(group_info["members"])
-            # 理由が空の場合は新しい理由を使用
-            if not all_groups[group_name]["reason"] and group_info["reason"]:
-                all_groups[group_name]["reason"] = group_info["reason"]
-        else:
-            # 新しいグループを追加
-            all_groups[group_name] = group_info
-
-    return all_groups
-
-def format_groups_for_output(all_groups):
-    """グループ情報を出力用の形式に整形する関数"""
-    formatted_groups = []
-    
-    for group_name, group_info in all_groups.items():
-        formatted_group = {
-            "group_name": group_name,
-            "reason": group_info["reason"],
-            "member_count": len(group_info["members"]),
-            "member_ids": group_info["members"]
-        }
-        formatted_groups.append(formatted_group)
-    
-    # メンバー数の多い順にソート
-    formatted_groups.sort(key=lambda x: x["member_count"], reverse=True)
-    
-    return formatted_groups
-
-def is_today_holiday():
-    """祝日判定Lambdaを呼び出す"""
-    try:
-        response = LAMBDA_CLIENT.invoke(
-            FunctionName=CHECK_HOLIDAY_LAMBDA_NAME,
-            InvocationType='RequestResponse',
-        )
-        payload_str = response['Payload'].read().decode('utf-8')
-        logger.info(f"祝日Lambda応答: {payload_str}")
-        payload = json.loads(payload_str)
-
-        if response['StatusCode'] != 200:
-            logger.info(f"祝日判定Lambdaのステータスコード: {response['StatusCode']}")
-            return True  # 念のため、祝日とみなして処理スキップ
-
-        body = json.loads(payload.get("body", "{}"))
-        return body.get("is_holiday", True)  # デフォルト True = 安全優先でスキップ
-
-    except Exception as e:
-        logger.error(f"祝日判定Lambdaの呼び出しに失敗: {str(e)}", exc_info=True)
-        return True  # エラー時は祝日扱いにしてスキップ
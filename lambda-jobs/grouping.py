@@ -1,19 +1,15 @@
-import boto3
 import json
 import random
-import re
 import logging
 import os
+from matching_common.aws_clients import get_client, read_s3_json, write_s3_json
+from matching_common.holiday import is_today_holiday
+from matching_common.metrics import instrument_handler, metrics
+from matching_common.group_model import DISCARDED_THEME, GroupSet, Theme, is_uuid, themes_to_json
+from matching_common.user_snapshot import load_user_snapshot_from_env
 
-# S3 クライアントの設定
-s3 = boto3.client('s3', region_name='ap-northeast-1')
-
-# UUIDのパターン（8-4-4-4-12の16進数）
-uuid_pattern = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', re.IGNORECASE)
-
-# Lambda クライアントの設定
-LAMBDA_CLIENT = boto3.client('lambda')
-CHECK_HOLIDAY_LAMBDA_NAME = os.environ.get("CHECK_HOLIDAY_LAMBDA_NAME")
+# S3 クライアントの設定（ウォームコンテナでは作成済みのクライアントを再利用する）
+s3 = get_client('s3', region_name='ap-northeast-1')
 
 # ロガーの設定
 logger = logging.getLogger()
@@ -22,46 +18,44 @@ logger.setLevel(logging.INFO)
 # S3 からJSONファイルを読み込む
 def read_json_file(bucket_name, file_name):
     try:
-        response = s3.get_object(Bucket=bucket_name, Key=file_name)
-        content = response['Body'].read().decode('utf-8')
-        return json.loads(content)
+        return read_s3_json(s3, bucket_name, file_name)
     except Exception as e:
         logger.error(f"Error reading JSON file: {e}")
         return None
 
-# メンバー ID を再分類してグループを再編成
-def regroup_json_data(input_data):
+# メンバー ID を再分類してグループを再編成（Theme のリストを返す）
+# snapshot を指定した場合は、ユーザースナップショットに存在するIDのみを有効とする
+def regroup_json_data(input_data, snapshot=None):
     if not input_data or "groups" not in input_data:
         logger.warning("Invalid input data structure")
         return []
-    
+    return regroup_group_set(GroupSet.from_json(input_data.get("groups", [])), snapshot)
+
+# GroupSet のグループを再編成（パイプライン実行では前段の GroupSet をそのまま受け取る）
+def regroup_group_set(group_set, snapshot=None):
     groups_data = {}
     discarded_members = []
     
     # 入力データからグループ情報を抽出
-    for group in input_data.get("groups", []):
-        group_name = group.get("group_name", "")
-        reason = group.get("reason", "")
-        member_ids = group.get("member_ids", [])
-        
-        # UUIDパターンに一致するIDのみをフィルタリング
+    for group in group_set:
+        # UUIDパターンに一致するIDのみをフィルタリング（同じIDの判定はキャッシュされる）
         valid_ids = []
-        for member_id in member_ids:
-            if member_id and isinstance(member_id, str):
-                clean_id = member_id.strip()
-                if uuid_pattern.match(clean_id):
-                    valid_ids.append(clean_id)
-                else:
-                    logger.warning(f"Invalid UUID format: {member_id}")
+        for member_id in group.member_ids or ():
+            if not (isinstance(member_id, str) and is_uuid(member_id)):
+                logger.warning(f"Invalid UUID format: {member_id}")
+            elif snapshot is not None and not snapshot.contains(member_id):
+                logger.warning(f"Unknown user ID: {member_id}")
+            else:
+                valid_ids.append(member_id)
         
         if valid_ids:
-            groups_data[group_name] = {
-                "reason": reason,
+            groups_data[group.name] = {
+                "reason": group.reason,
                 "ids": valid_ids
             }
     
-    # 結果のJSONデータ構造
-    json_data = []
+    # 結果のデータ構造
+    themes = []
     
     # グループの再編成
     for group_name, group_data in groups_data.items():
@@ -74,11 +68,7 @@ def regroup_json_data(input_data):
             discarded_members.extend(ids)
             logger.info(f"Group '{group_name}' with {len(ids)} members moved to discarded list")
         elif len(ids) <= 10:  # 8人以上10人以下はそのまま
-            json_data.append({
-                "theme": group_name,
-                "reason": reason,
-                "group_list": [{"id_list": ids}]
-            })
+            themes.append(Theme(group_name, reason, [ids]))
             logger.info(f"Group '{group_name}' kept as single group with {len(ids)} members")
         else:  # 11人以上は10人ずつのグループに分ける
             secondary_groups = []
@@ -90,45 +80,45 @@ def regroup_json_data(input_data):
                     discarded_members.extend(secondary_group)
                     logger.info(f"Last subgroup of '{group_name}' with {len(secondary_group)} members moved to discarded list")
                 else:
-                    secondary_groups.append({"id_list": secondary_group})
+                    secondary_groups.append(secondary_group)
             
             if secondary_groups:  # 空でない場合のみ追加
-                json_data.append({
-                    "theme": group_name,
-                    "reason": reason,
-                    "group_list": secondary_groups
-                })
+                themes.append(Theme(group_name, reason, secondary_groups))
                 logger.info(f"Group '{group_name}' split into {len(secondary_groups)} subgroups")
     
     # 切り捨てられたメンバー一覧を追加
     if discarded_members:
         # 切り捨てメンバーも10人ずつのグループに分ける
-        discarded_groups = []
         random.shuffle(discarded_members)  # 切り捨てメンバーもシャッフル
+        discarded_groups = [discarded_members[i:i+10] for i in range(0, len(discarded_members), 10)]
         
-        for i in range(0, len(discarded_members), 10):
-            discarded_group = discarded_members[i:i+10]
-            discarded_groups.append({"id_list": discarded_group})
-        
-        json_data.append({
-            "theme": "切り捨てられたメンバー一覧",
-            "reason": "7人以下のグループから集められたメンバーです",
-            "group_list": discarded_groups
-        })
+        themes.append(Theme(DISCARDED_THEME, "7人以下のグループから集められたメンバーです", discarded_groups))
         logger.info(f"Created discarded members group with {len(discarded_members)} total members in {len(discarded_groups)} subgroups")
     
-    return json_data
+    return themes
+
+# グループ再編成を行い、(Theme のリスト, 出力するJSONデータ) を返す（S3への読み書きは呼び出し側で行う）
+def build_grouping_output(input_data, snapshot=None):
+    return _grouping_output(regroup_json_data(input_data, snapshot))
+
+# GroupSet からグループ再編成を行い、(Theme のリスト, 出力するJSONデータ) を返す
+def build_grouping_output_from_group_set(group_set, snapshot=None):
+    return _grouping_output(regroup_group_set(group_set, snapshot))
+
+def _grouping_output(themes):
+    if not themes:
+        logger.warning("No valid groups were created")
+        return themes, [{
+            "theme": "処理結果なし",
+            "reason": "有効なグループが作成されませんでした",
+            "group_list": []
+        }]
+    return themes, themes_to_json(themes)
 
 # JSON データを保存し、S3 にアップロード
 def save_and_upload_json(json_data, bucket_name, file_name):
     try:
-        json_content = json.dumps(json_data, indent=4, ensure_ascii=False)
-        s3.put_object(
-            Body=json_content, 
-            Bucket=bucket_name, 
-            Key=file_name,
-            ContentType='application/json'
-        )
+        write_s3_json(s3, bucket_name, file_name, json_data, indent=4)
         logger.info(f"JSON data successfully uploaded to s3://{bucket_name}/{file_name}")
         return True
     except Exception as e:
@@ -136,6 +126,7 @@ def save_and_upload_json(json_data, bucket_name, file_name):
         return False
 
 # Lambda ハンドラー関数
+@instrument_handler("grouping")
 def lambda_handler(event, context):
     bucket_name = os.environ.get("BUCKET_NAME")
     file_name = os.environ.get("OBJECT_KEY")
@@ -169,7 +160,8 @@ def lambda_handler(event, context):
     
     try:
         # JSONファイルを読み込み
-        input_data = read_json_file(bucket_name, file_name)
+        with metrics.stage("read_input"):
+            input_data = read_json_file(bucket_name, file_name)
         
         if input_data is None:
             return {
@@ -177,18 +169,13 @@ def lambda_handler(event, context):
                 "body": json.dumps({"message": "Failed to read input JSON file"})
             }
         
-        # グループ再編成処理
-        regrouped_data = regroup_json_data(input_data)
+        # グループ再編成処理（ユーザースナップショットが設定されている場合は存在しないユーザーも除外する）
+        with metrics.stage("regroup"):
+            themes, regrouped_data = build_grouping_output(input_data, load_user_snapshot_from_env(s3))
         
-        if not regrouped_data:
-            logger.warning("No valid groups were created")
+        if not themes:
             # 空の結果でも正常終了
-            empty_result = [{
-                "theme": "処理結果なし",
-                "reason": "有効なグループが作成されませんでした",
-                "group_list": []
-            }]
-            save_and_upload_json(empty_result, bucket_name, output_file_name)
+            save_and_upload_json(regrouped_data, bucket_name, output_file_name)
             return {
                 "statusCode": 200,
                 "body": json.dumps({
@@ -197,22 +184,19 @@ def lambda_handler(event, context):
                 })
             }
         
-        # 結果をログ出力（デバッグ用）
-        logger.info("Regrouped data structure:")
-        logger.info(json.dumps(regrouped_data, indent=2, ensure_ascii=False))
+        # 結果をログ出力（デバッグ用。DEBUG レベルの場合のみ整形する）
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Regrouped data structure: {json.dumps(regrouped_data, ensure_ascii=False)}")
         
         # S3にアップロード
-        upload_success = save_and_upload_json(regrouped_data, bucket_name, output_file_name)
+        with metrics.stage("write_output"):
+            upload_success = save_and_upload_json(regrouped_data, bucket_name, output_file_name)
         
         if upload_success:
             # 統計情報を計算
-            total_groups = len(regrouped_data)
-            total_subgroups = sum(len(group.get("group_list", [])) for group in regrouped_data)
-            total_members = sum(
-                len(subgroup.get("id_list", [])) 
-                for group in regrouped_data 
-                for subgroup in group.get("group_list", [])
-            )
+            total_groups = len(themes)
+            total_subgroups = sum(theme.subgroup_count for theme in themes)
+            total_members = sum(theme.member_count for theme in themes)
             
             return {
                 "statusCode": 200,
@@ -239,25 +223,3 @@ def lambda_handler(event, context):
                 "error": str(e)
             })
         }
-
-def is_today_holiday():
-    """祝日判定Lambdaを呼び出す"""
-    try:
-        response = LAMBDA_CLIENT.invoke(
-            FunctionName=CHECK_HOLIDAY_LAMBDA_NAME,
-            InvocationType='RequestResponse',
-        )
-        payload_str = response['Payload'].read().decode('utf-8')
-        logger.info(f"祝日Lambda応答: {payload_str}")
-        payload = json.loads(payload_str)
-
-        if response['StatusCode'] != 200:
-            logger.info(f"祝日判定Lambdaのステータスコード: {response['StatusCode']}")
-            return True  # 念のため、祝日とみなして処理スキップ
-
-        body = json.loads(payload.get("body", "{}"))
-        return body.get("is_holiday", True)  # デフォルト True = 安全優先でスキップ
-
-    except Exception as e:
-        logger.error(f"祝日判定Lambdaの呼び出しに失敗: {str(e)}", exc_info=True)
-        return True  # エラー時は祝日扱いにしてスキップ
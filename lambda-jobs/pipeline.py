@@ -0,0 +1,120 @@
+import importlib.machinery
+import importlib.util
+import json
+import logging
+import os
+import time
+from matching_common.aws_clients import write_s3_json
+from matching_common.holiday import is_today_holiday
+from matching_common.metrics import instrument_handler, metrics
+from matching_common.user_snapshot import load_user_snapshot_from_env
+
+import few
+import grouping
+
+# ロガーの設定
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+def _load_source_module(name, file_name):
+    """拡張子のない Lambda のソースファイルをモジュールとして読み込む"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), file_name)
+    loader = importlib.machinery.SourceFileLoader(name, path)
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader(name, loader))
+    loader.exec_module(module)
+    return module
+
+userid_check = _load_source_module("userid_check", "secondary-userid-check")
+
+# few.py → secondary-userid-check → grouping.py を1つのプロセスで実行するパイプライン
+# 各段の結果はS3やJSONを経由せず GroupSet のまま次の段に渡し、最終結果（grouping.py の出力）のみS3に保存する
+# ユーザースナップショットは1回だけ読み込み、存在確認と再編成の両方で使う
+# 社員データの入力とチェックポイント・バッチ推論の設定は few.py と同じ環境変数（S3_BUCKET_NAME / INPUT_S3_BUCKET_NAME / S3_FILE_KEY 等）を使う
+PIPELINE_OUTPUT_BUCKET_NAME = os.environ.get("PIPELINE_OUTPUT_BUCKET_NAME") or os.environ.get("S3_BUCKET_NAME")
+PIPELINE_OUTPUT_KEY = os.environ.get("PIPELINE_OUTPUT_KEY")
+
+# 途中の結果もS3に保存する（"true" の場合。デバッグ用）
+# few.py の結果は S3_OUTPUT_KEY / S3_SUMMARY_OUTPUT_KEY、secondary-userid-check の結果は PIPELINE_USERID_CHECK_OUTPUT_KEY に保存する
+PIPELINE_MATERIALIZE_INTERMEDIATE = os.environ.get("PIPELINE_MATERIALIZE_INTERMEDIATE", "false").lower() == "true"
+PIPELINE_USERID_CHECK_OUTPUT_KEY = os.environ.get("PIPELINE_USERID_CHECK_OUTPUT_KEY")
+
+@instrument_handler("pipeline")
+def lambda_handler(event, context):
+    s3, bedrock = few.create_clients()
+
+    # 祝日判定はパイプライン全体で1回だけ行う
+    if is_today_holiday():
+        logger.info("今日は祝日です。処理をスキップします。")
+        write_s3_json(s3, PIPELINE_OUTPUT_BUCKET_NAME, PIPELINE_OUTPUT_KEY, [{
+            "theme": "処理スキップ",
+            "reason": "今日は祝日なので処理をスキップしました",
+            "group_list": []
+        }], indent=4)
+        return {
+            'statusCode': 200,
+            'body': json.dumps({'message': '今日は祝日なので処理をスキップしました'})
+        }
+
+    return run_pipeline(event, s3, bedrock)
+
+def run_pipeline(event, s3, bedrock):
+    """グルーピング → ユーザーの存在確認 → グループ再編成を順に実行し、最終結果をS3に保存する関数"""
+    bucket_name = os.environ.get('S3_BUCKET_NAME')
+    stage_seconds = {}
+
+    def record_stage(name, started):
+        stage_seconds[name] = time.monotonic() - started
+        metrics.observe(f"StageDuration.{name}", stage_seconds[name] * 1000)
+
+    # 1. 社員データのグルーピング（few.py）
+    started = time.monotonic()
+    materialize_to = None
+    if PIPELINE_MATERIALIZE_INTERMEDIATE:
+        materialize_to = few.S3ResultSink(s3, bucket_name, os.environ.get('S3_OUTPUT_KEY'), os.environ.get('S3_SUMMARY_OUTPUT_KEY'))
+    sink = few.MemoryResultSink(materialize_to)
+    grouping_response = few.run_grouping(
+        event, s3, bedrock, sink, bucket_name, os.environ.get('INPUT_S3_BUCKET_NAME'), os.environ.get('S3_FILE_KEY')
+    )
+    record_stage("grouping", started)
+
+    if not sink.written:
+        # バッチ推論ジョブの完了待ち（202）等、結果がまだない場合は few.py の応答をそのまま返す
+        return grouping_response
+
+    try:
+        # 2. ユーザーテーブルに存在しないメンバーの除外（secondary-userid-check）
+        started = time.monotonic()
+        snapshot = load_user_snapshot_from_env(s3)
+        group_set, validation = userid_check.validate_group_set(sink.group_set, snapshot)
+        if PIPELINE_MATERIALIZE_INTERMEDIATE and PIPELINE_USERID_CHECK_OUTPUT_KEY:
+            validated_data, _ = userid_check.apply_validation(sink.document, group_set, validation)
+            write_s3_json(s3, bucket_name, PIPELINE_USERID_CHECK_OUTPUT_KEY, validated_data)
+        record_stage("userid_check", started)
+
+        # 3. 10人程度のサブグループへの再編成（grouping.py）
+        started = time.monotonic()
+        themes, regrouped_data = grouping.build_grouping_output_from_group_set(group_set, snapshot)
+        write_s3_json(s3, PIPELINE_OUTPUT_BUCKET_NAME, PIPELINE_OUTPUT_KEY, regrouped_data, indent=4)
+        record_stage("regrouping", started)
+    except Exception as e:
+        logger.error(f"パイプラインの後段でエラーが発生しました: {str(e)}", exc_info=True)
+        return {
+            'statusCode': 500,
+            'body': json.dumps({'message': 'Pipeline failed', 'error': str(e)}, ensure_ascii=False)
+        }
+
+    logger.info(f"パイプラインの各段の処理時間（秒）: {json.dumps({name: round(seconds, 3) for name, seconds in stage_seconds.items()})}")
+
+    # グルーピングでエラーが発生した場合も後段は実行し（個別のLambdaで実行した場合と同じ結果）、ステータスコードは引き継ぐ
+    return {
+        'statusCode': grouping_response['statusCode'],
+        'body': json.dumps({
+            'message': 'Pipeline completed' if grouping_response['statusCode'] == 200 else 'Pipeline completed with grouping errors',
+            'excluded_members_count': validation["excluded_members_count"],
+            'total_themes': len(themes),
+            'total_subgroups': sum(theme.subgroup_count for theme in themes),
+            'total_members': sum(theme.member_count for theme in themes),
+            'stage_seconds': {name: round(seconds, 3) for name, seconds in stage_seconds.items()},
+            'output_location': f"s3://{PIPELINE_OUTPUT_BUCKET_NAME}/{PIPELINE_OUTPUT_KEY}"
+        })
+    }
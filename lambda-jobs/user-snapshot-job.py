@@ -0,0 +1,68 @@
+import json
+import logging
+import os
+import time
+from matching_common.aws_clients import get_client, pool_size_for
+from matching_common.metrics import instrument_handler, metrics
+from matching_common.user_snapshot import DEFAULT_BLOOM_BITS_PER_KEY, DEFAULT_SCAN_SEGMENTS, scan_user_ids, upload_user_snapshot
+
+# ログ設定
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+USER_TABLE_NAME = os.environ.get("USER_TABLE_NAME")
+USER_SNAPSHOT_S3_BUCKET = os.environ.get("USER_SNAPSHOT_S3_BUCKET")
+USER_SNAPSHOT_S3_PREFIX = os.environ.get("USER_SNAPSHOT_S3_PREFIX", "user-snapshot/")
+
+# 並列Scanのセグメント数（セグメントごとに1スレッド）
+USER_SNAPSHOT_SCAN_SEGMENTS = int(os.environ.get("USER_SNAPSHOT_SCAN_SEGMENTS", DEFAULT_SCAN_SEGMENTS))
+# ブルームフィルターの1IDあたりのビット数（0 の場合はブルームフィルターを作成しない）
+USER_SNAPSHOT_BLOOM_BITS_PER_KEY = int(os.environ.get("USER_SNAPSHOT_BLOOM_BITS_PER_KEY", DEFAULT_BLOOM_BITS_PER_KEY))
+
+dynamodb = get_client("dynamodb", max_pool_connections=pool_size_for(USER_SNAPSHOT_SCAN_SEGMENTS))
+
+@instrument_handler("user-snapshot-job")
+def lambda_handler(event, context):
+    """ユーザーテーブルのIDを並列Scanで読み込み、存在確認用のスナップショットを S3 に保存する（1日1回の実行を想定）"""
+    if not all([USER_TABLE_NAME, USER_SNAPSHOT_S3_BUCKET]):
+        logger.error("Required environment variables are missing")
+        return {
+            'statusCode': 400,
+            'body': json.dumps({'message': 'Required environment variables are missing', 'required': ['USER_TABLE_NAME', 'USER_SNAPSHOT_S3_BUCKET']})
+        }
+
+    try:
+        started = time.monotonic()
+        with metrics.stage("scan_user_table"):
+            user_ids = scan_user_ids(dynamodb, USER_TABLE_NAME, total_segments=USER_SNAPSHOT_SCAN_SEGMENTS)
+        scan_seconds = time.monotonic() - started
+        metrics.count("ScannedUserIds", len(user_ids))
+        logger.info(f"ユーザーテーブルのScan完了: {len(user_ids)}件（{USER_SNAPSHOT_SCAN_SEGMENTS}セグメント、{scan_seconds:.2f}秒）")
+
+        with metrics.stage("write_snapshot"):
+            manifest = upload_user_snapshot(
+                get_client("s3"),
+                USER_SNAPSHOT_S3_BUCKET,
+                USER_SNAPSHOT_S3_PREFIX,
+                user_ids,
+                table_name=USER_TABLE_NAME,
+                bloom_bits_per_key=USER_SNAPSHOT_BLOOM_BITS_PER_KEY
+            )
+
+        return {
+            'statusCode': 200,
+            'body': json.dumps({
+                'message': 'User snapshot created successfully',
+                'scanned_ids': len(user_ids),
+                'uuid_ids': manifest['id_count'],
+                'other_ids': len(manifest['extra_ids']),
+                'scan_seconds': round(scan_seconds, 3),
+                'manifest': f"s3://{USER_SNAPSHOT_S3_BUCKET}/{USER_SNAPSHOT_S3_PREFIX}manifest.json"
+            })
+        }
+    except Exception as e:
+        logger.error(f"Error creating user snapshot: {str(e)}", exc_info=True)
+        return {
+            'statusCode': 500,
+            'body': json.dumps({'error': str(e)})
+        }
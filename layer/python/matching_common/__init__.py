@@ -0,0 +1 @@
+"""lambda-jobs / serverless の各Lambdaで共有するユーティリティ（Lambdaレイヤーとして配布）"""
@@ -0,0 +1,90 @@
+import json
+import logging
+import threading
+
+import boto3
+from botocore.config import Config
+
+from matching_common.metrics import metrics
+
+# ロガーの設定
+logger = logging.getLogger()
+
+# botocore のデフォルトのコネクションプールサイズ
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+
+# 作成済みのクライアント・リソース（ウォームコンテナ間で再利用する）
+_clients = {}
+_resources = {}
+_lock = threading.Lock()
+
+def pool_size_for(concurrency):
+    """同時実行数に合わせたコネクションプールサイズ（デフォルトの10未満にはしない）"""
+    return max(DEFAULT_MAX_POOL_CONNECTIONS, concurrency or 0)
+
+def _registry_key(service_name, region_name, config_kwargs):
+    # retries 等の辞書を含むため、JSON文字列にしてキーにする
+    return service_name, region_name, json.dumps(config_kwargs, sort_keys=True, default=str)
+
+def _build_config(config_kwargs):
+    return Config(**config_kwargs) if config_kwargs else None
+
+def get_client(service_name, region_name=None, **config_kwargs):
+    """(サービス, リージョン, Config の設定) ごとに boto3 クライアントを1つだけ作成して再利用する関数
+
+    config_kwargs は botocore.config.Config の引数（max_pool_connections, read_timeout, retries など）。
+    Lambda のウォームコンテナでは2回目以降の呼び出しで作成済みのクライアントを返す。
+    """
+    key = _registry_key(service_name, region_name, config_kwargs)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = boto3.client(service_name, region_name=region_name, config=_build_config(config_kwargs))
+            _clients[key] = client
+        return client
+
+def get_resource(service_name, region_name=None, **config_kwargs):
+    """get_client と同様に boto3 リソース（DynamoDB の Table 等）を作成して再利用する関数"""
+    key = _registry_key(service_name, region_name, config_kwargs)
+    resource = _resources.get(key)
+    if resource is not None:
+        return resource
+
+    with _lock:
+        resource = _resources.get(key)
+        if resource is None:
+            resource = boto3.resource(service_name, region_name=region_name, config=_build_config(config_kwargs))
+            _resources[key] = resource
+        return resource
+
+def clear_clients():
+    """作成済みのクライアント・リソースを破棄する（ベンチマーク・動作確認用）"""
+    with _lock:
+        _clients.clear()
+        _resources.clear()
+
+def read_s3_json(s3, bucket, key):
+    """S3 上の JSON オブジェクトを読み込んで返す関数（例外はそのまま送出する）"""
+    response = s3.get_object(Bucket=bucket, Key=key)
+    body = response["Body"]
+    try:
+        data = body.read()
+    finally:
+        body.close()
+    metrics.count("S3BytesRead", len(data), unit="Bytes")
+    return json.loads(data.decode("utf-8"))
+
+def write_s3_json(s3, bucket, key, data, indent=2):
+    """データを JSON にして S3 にアップロードする関数（例外はそのまま送出する）"""
+    body = json.dumps(data, ensure_ascii=False, indent=indent).encode("utf-8")
+    s3.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=body,
+        ContentType="application/json"
+    )
+    metrics.count("S3BytesWritten", len(body), unit="Bytes")
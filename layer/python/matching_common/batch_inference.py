@@ -0,0 +1,191 @@
+import json
+import logging
+import os
+import time
+
+# ロガーの設定
+logger = logging.getLogger()
+
+# バッチ推論ジョブのステータス
+SUCCEEDED_STATUSES = ("Completed", "PartiallyCompleted")
+FAILED_STATUSES = ("Failed", "Stopped", "Expired")
+
+class BatchJobFailedError(RuntimeError):
+    """バッチ推論ジョブが失敗・停止・期限切れで終了した場合の例外"""
+
+    def __init__(self, job, status):
+        super().__init__(f"バッチ推論ジョブが失敗しました: {job['job_arn']} ({status})")
+        self.job_arn = job["job_arn"]
+        self.status = status
+
+# 1ジョブあたりの最小レコード数（Bedrockのクォータ。これ未満のジョブは投入できない）
+DEFAULT_MIN_RECORDS = 100
+
+def build_batch_record(record_id, prompt, inference_config):
+    """バッチ推論の入力レコード（recordId / modelInput）を作成する関数
+
+    datasource/sample-batch-quetion.jsonl と同じ Anthropic Messages API 形式。
+    """
+    model_input = {
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": inference_config.get("maxTokens", 4096),
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": prompt
+                    }
+                ]
+            }
+        ]
+    }
+    if "temperature" in inference_config:
+        model_input["temperature"] = inference_config["temperature"]
+    return {"recordId": record_id, "modelInput": model_input}
+
+def parse_batch_output_lines(lines):
+    """バッチ推論の出力JSONLを解析し、recordId -> 回答テキストの辞書を返す関数
+
+    エラーになったレコードの値は None とする。
+    """
+    results = {}
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        if not line.strip():
+            continue
+
+        record = json.loads(line)
+        record_id = record.get("recordId")
+        if "error" in record or "modelOutput" not in record:
+            logger.warning(f"バッチ推論レコードがエラー: {record_id} {record.get('error')}")
+            results[record_id] = None
+            continue
+
+        content = record["modelOutput"].get("content", [])
+        results[record_id] = "".join(block.get("text", "") for block in content if block.get("type") == "text")
+    return results
+
+class BedrockBatchExecutor:
+    """Bedrock のバッチ推論ジョブ（CreateModelInvocationJob）で入力レコードを処理するクラス
+
+    ジョブ情報は JSON にできる辞書で返すため、S3 に保存して後続の実行で結果を取り込める。
+    """
+
+    def __init__(self, bedrock, s3, bucket, prefix, role_arn, model_id, poll_interval=60):
+        self.bedrock = bedrock  # boto3.client('bedrock')
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix if prefix.endswith("/") else f"{prefix}/"
+        self.role_arn = role_arn
+        self.model_id = model_id
+        self.poll_interval = poll_interval
+
+    def submit(self, records, job_name):
+        """入力JSONLをS3に書き込み、バッチ推論ジョブを投入する"""
+        input_key = f"{self.prefix}{job_name}/input.jsonl"
+        output_prefix = f"{self.prefix}{job_name}/output/"
+
+        body = "\n".join(json.dumps(record, ensure_ascii=False) for record in records)
+        self.s3.put_object(Bucket=self.bucket, Key=input_key, Body=body.encode("utf-8"), ContentType="application/jsonl")
+
+        response = self.bedrock.create_model_invocation_job(
+            jobName=job_name,
+            roleArn=self.role_arn,
+            modelId=self.model_id,
+            inputDataConfig={
+                "s3InputDataConfig": {
+                    "s3Uri": f"s3://{self.bucket}/{input_key}",
+                    "s3InputFormat": "JSONL"
+                }
+            },
+            outputDataConfig={
+                "s3OutputDataConfig": {
+                    "s3Uri": f"s3://{self.bucket}/{output_prefix}"
+                }
+            }
+        )
+        logger.info(f"バッチ推論ジョブを投入: {response['jobArn']} ({len(records)}件)")
+        return {
+            "job_arn": response["jobArn"],
+            "job_name": job_name,
+            "output_prefix": output_prefix,
+            "record_count": len(records)
+        }
+
+    def status(self, job):
+        response = self.bedrock.get_model_invocation_job(jobIdentifier=job["job_arn"])
+        return response["status"]
+
+    def wait(self, job, timeout_seconds):
+        """ジョブが終了するか timeout_seconds が経過するまでポーリングし、最後のステータスを返す"""
+        deadline = time.monotonic() + timeout_seconds
+        while True:
+            status = self.status(job)
+            if status in SUCCEEDED_STATUSES or status in FAILED_STATUSES:
+                return status
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return status
+            logger.info(f"バッチ推論ジョブの完了待ち: {status}")
+            time.sleep(min(self.poll_interval, remaining))
+
+    def fetch_results(self, job):
+        """出力プレフィックス配下の *.jsonl.out を読み込み、recordId -> 回答テキストを返す"""
+        results = {}
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=job["output_prefix"]):
+            for obj in page.get("Contents", []):
+                if not obj["Key"].endswith(".jsonl.out"):
+                    continue
+                response = self.s3.get_object(Bucket=self.bucket, Key=obj["Key"])
+                results.update(parse_batch_output_lines(response["Body"].iter_lines()))
+        return results
+
+class LocalBatchExecutor:
+    """バッチ推論ジョブのローカル代替（オフラインでの動作確認用）
+
+    入力・出力をBedrockと同じJSONL形式でローカルに書き出し、responder(modelInput) の戻り値を回答テキストとする。
+    """
+
+    def __init__(self, responder, directory="/tmp/bedrock-batch-local"):
+        self.responder = responder
+        self.directory = directory
+
+    def submit(self, records, job_name):
+        job_dir = os.path.join(self.directory, job_name)
+        os.makedirs(job_dir, exist_ok=True)
+        input_path = os.path.join(job_dir, "input.jsonl")
+        with open(input_path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+        # 投入と同時に全レコードを処理し、Bedrockと同じ形式の出力ファイルを作成する
+        with open(input_path, encoding="utf-8") as f_in, open(f"{input_path}.out", "w", encoding="utf-8") as f_out:
+            for line in f_in:
+                record = json.loads(line)
+                try:
+                    text = self.responder(record["modelInput"])
+                    record["modelOutput"] = {"content": [{"type": "text", "text": text}], "stop_reason": "end_turn"}
+                except Exception as e:
+                    record["error"] = {"errorMessage": str(e)}
+                f_out.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+        return {
+            "job_arn": f"local:{job_name}",
+            "job_name": job_name,
+            "output_prefix": job_dir,
+            "record_count": len(records)
+        }
+
+    def status(self, job):
+        return "Completed"
+
+    def wait(self, job, timeout_seconds):
+        return self.status(job)
+
+    def fetch_results(self, job):
+        with open(os.path.join(job["output_prefix"], "input.jsonl.out"), encoding="utf-8") as f:
+            return parse_batch_output_lines(f)
@@ -0,0 +1,144 @@
+import json
+import logging
+import time
+
+from matching_common.metrics import metrics
+from matching_common.rate_limiter import call_with_limiter, estimate_request_tokens
+from matching_common.response_cache import is_cacheable, make_cache_key
+
+# ロガーの設定
+logger = logging.getLogger()
+
+class IncrementalGroupParser:
+    """ストリーミングで届く回答テキストから、JSON配列の要素オブジェクトを閉じ括弧の到着ごとに取り出すクラス
+
+    回答全体を待たずに、完成したグループ（{"グループ名": ..., "メンバーID": [...]}）から順に処理できる。
+    配列より前の説明文や ```json のフェンスは読み飛ばす。
+    """
+
+    def __init__(self):
+        self.depth = 0  # 配列の外側を0とした括弧の深さ
+        self.in_string = False
+        self.escaped = False
+        self.object_chars = None  # 解析中のオブジェクトの文字（配列直下のオブジェクト内のみ保持）
+        self.parsed_count = 0
+        self.error_count = 0
+
+    def feed(self, text):
+        """テキストの断片を追加し、完成したオブジェクトのリストを返す"""
+        completed = []
+        for ch in text:
+            if self.object_chars is not None:
+                self.object_chars.append(ch)
+
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+                continue
+
+            if self.depth == 0:
+                # 配列の開始を待つ（配列外の文字列リテラルは考慮しない）
+                if ch == "[":
+                    self.depth = 1
+                continue
+
+            if ch == '"':
+                self.in_string = True
+            elif ch in "[{":
+                if self.depth == 1 and ch == "{":
+                    self.object_chars = [ch]
+                self.depth += 1
+            elif ch in "]}":
+                self.depth -= 1
+                if self.depth == 1 and ch == "}" and self.object_chars is not None:
+                    obj = self._load_object("".join(self.object_chars))
+                    self.object_chars = None
+                    if obj is not None:
+                        completed.append(obj)
+        return completed
+
+    def _load_object(self, text):
+        try:
+            obj = json.loads(text)
+        except json.JSONDecodeError as e:
+            self.error_count += 1
+            logger.warning(f"ストリーミング中のグループJSONの解析に失敗: {e}")
+            return None
+        self.parsed_count += 1
+        return obj
+
+def _feed_and_emit(parser, text, on_group):
+    for group in parser.feed(text):
+        if on_group is not None:
+            on_group(group)
+
+def converse_stream_groups(bedrock, model_id, prompt, inference_config, on_group=None, cache=None, limiter=None, return_stop_reason=False):
+    """converse_stream で回答を受信しながら、完成したグループごとに on_group を呼び出す関数
+
+    戻り値は回答テキスト全体。cache を指定した場合、ヒット時はキャッシュの回答を同じパーサーに通して on_group を呼び出す。
+    limiter を指定した場合、ストリームの開始（converse_stream の呼び出し）を流量制限と再試行の対象にする。
+    受信途中のエラーは、on_group を呼び出し済みのグループと重複しないよう再試行しない。
+    return_stop_reason を指定した場合は (回答テキスト, stopReason) を返す（キャッシュから取得した場合の stopReason は None）。
+    """
+    parser = IncrementalGroupParser()
+
+    cacheable = cache is not None and is_cacheable(inference_config)
+    if cache is not None and not cacheable:
+        cache.record_bypass()
+
+    if cacheable:
+        key = make_cache_key(model_id, inference_config, prompt)
+        cached_text = cache.get(key)
+        if cached_text is not None:
+            metrics.count("ResponseCacheHits")
+            _feed_and_emit(parser, cached_text, on_group)
+            return (cached_text, None) if return_stop_reason else cached_text
+        metrics.count("ResponseCacheMisses")
+
+    # 最後に開始したストリームの開始時刻（再試行の待ち時間はレイテンシに含めない）
+    started = [None]
+
+    def send():
+        metrics.count("BedrockCalls")
+        started[0] = time.perf_counter()
+        return bedrock.converse_stream(
+            modelId=model_id,
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "text": prompt
+                        }
+                    ]
+                }
+            ],
+            inferenceConfig=inference_config
+        )
+
+    response = call_with_limiter(limiter, send, estimate_request_tokens(prompt, inference_config))
+
+    text_parts = []
+    stop_reason = None
+    for event in response["stream"]:
+        if "contentBlockDelta" in event:
+            delta_text = event["contentBlockDelta"]["delta"].get("text", "")
+            text_parts.append(delta_text)
+            _feed_and_emit(parser, delta_text, on_group)
+        elif "messageStop" in event:
+            stop_reason = event["messageStop"].get("stopReason")
+        elif "metadata" in event:
+            metrics.record_bedrock_usage(event["metadata"].get("usage"))
+    metrics.observe("BedrockLatency", (time.perf_counter() - started[0]) * 1000)
+
+    text = "".join(text_parts)
+    if stop_reason == "max_tokens":
+        # 途中で打ち切られた回答はキャッシュしない
+        logger.warning("回答が出力トークン上限で打ち切られました")
+    elif cacheable:
+        cache.put(key, text, model_id=model_id)
+    return (text, stop_reason) if return_stop_reason else text
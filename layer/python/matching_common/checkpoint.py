@@ -0,0 +1,118 @@
+import json
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+
+from botocore.exceptions import ClientError
+
+from matching_common.metrics import metrics
+
+# ロガーの設定
+logger = logging.getLogger()
+
+JST = timezone(timedelta(hours=9))
+
+def default_run_id():
+    """デフォルトの実行ID（日本時間の日付。同じ日の再実行は同じチェックポイントを使う）"""
+    return datetime.now(JST).strftime("%Y-%m-%d")
+
+class ChunkCheckpointStore:
+    """完了したチャンクの回答と解析済みグループを S3 に保存し、再実行時に再利用するクラス
+
+    キーは {prefix}{run_id}/{roster_etag}/chunk-00001.json。
+    名簿（ETag）が変わった場合は別の場所になるため、古いチェックポイントは使われない。
+    保存時のチャンクの社員IDと一致しない場合も使わない（チャンク分割の設定が変わった場合など）。
+    結果ファイルの出力に成功した実行のチェックポイントは delete_run で削除する。
+    """
+
+    def __init__(self, s3, bucket, prefix, run_id, roster_etag):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix if prefix.endswith("/") else f"{prefix}/"
+        self.run_id = run_id
+        self.roster_etag = (roster_etag or "no-etag").strip('"')
+        self.restored_count = 0
+        self.saved_count = 0
+        self.deleted_count = 0
+        self._lock = threading.Lock()  # 並列実行時のカウンター更新用
+
+    @property
+    def seed(self):
+        """チャンク構成を再現するためのシャッフル用シード"""
+        return f"{self.run_id}:{self.roster_etag}"
+
+    @property
+    def run_prefix(self):
+        return f"{self.prefix}{self.run_id}/{self.roster_etag}/"
+
+    def _key(self, chunk_id):
+        return f"{self.run_prefix}chunk-{chunk_id:05d}.json"
+
+    def load(self, chunk_id, chunk):
+        """保存済みのチャンク結果を (回答テキスト, グループ情報) で返す（存在しない・一致しない場合は None）"""
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=self._key(chunk_id))
+            data = response["Body"].read()
+            metrics.count("S3BytesRead", len(data), unit="Bytes")
+            checkpoint = json.loads(data.decode("utf-8"))
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in ("NoSuchKey", "404"):
+                logger.warning(f"チェックポイントの読み込みに失敗: {e}")
+            return None
+        except json.JSONDecodeError:
+            return None
+
+        if checkpoint.get("employee_ids") != [employee.get("employee_id") for employee in chunk]:
+            logger.info(f"チャンク {chunk_id} のチェックポイントはチャンク構成が異なるため使用しません")
+            return None
+
+        with self._lock:
+            self.restored_count += 1
+        return checkpoint["claude_response"], checkpoint["groups"]
+
+    def save(self, chunk_id, chunk, result, groups):
+        """チャンクの回答と解析済みグループを保存する（失敗しても処理は継続する）"""
+        checkpoint = {
+            "chunk_id": chunk_id,
+            "employee_ids": [employee.get("employee_id") for employee in chunk],
+            "claude_response": result,
+            "groups": groups
+        }
+        body = json.dumps(checkpoint, ensure_ascii=False).encode("utf-8")
+        try:
+            self.s3.put_object(
+                Bucket=self.bucket,
+                Key=self._key(chunk_id),
+                Body=body,
+                ContentType="application/json"
+            )
+            metrics.count("S3BytesWritten", len(body), unit="Bytes")
+            with self._lock:
+                self.saved_count += 1
+        except ClientError as e:
+            logger.warning(f"チェックポイントの保存に失敗: {e}")
+
+    def delete_run(self):
+        """この実行のチェックポイントをすべて削除する（失敗しても処理は継続する）"""
+        try:
+            paginator = self.s3.get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=self.run_prefix):
+                # list_objects_v2 の1ページは最大1000件で、delete_objects の上限と同じ
+                objects = [{"Key": obj["Key"]} for obj in page.get("Contents", [])]
+                if not objects:
+                    continue
+                response = self.s3.delete_objects(Bucket=self.bucket, Delete={"Objects": objects, "Quiet": True})
+                for error in response.get("Errors", []):
+                    logger.warning(f"チェックポイントの削除に失敗: {error.get('Key')} ({error.get('Code')})")
+                self.deleted_count += len(objects) - len(response.get("Errors", []))
+        except ClientError as e:
+            logger.warning(f"チェックポイントの削除に失敗: {e}")
+
+    def stats(self):
+        return {
+            "run_id": self.run_id,
+            "roster_etag": self.roster_etag,
+            "restored_chunks": self.restored_count,
+            "saved_chunks": self.saved_count,
+            "deleted_chunks": self.deleted_count
+        }
@@ -0,0 +1,142 @@
+import json
+import math
+
+# トークン数の概算に使う係数（Claudeのトークナイザーに対して安全側に見積もる）
+ASCII_CHARS_PER_TOKEN = 2.0  # UUID等の英数字記号は2文字で1トークンと見積もる
+NON_ASCII_TOKENS_PER_CHAR = 1.0  # 日本語は1文字1トークンと見積もる
+
+# デフォルトの予算（Claude 3.5 Sonnet: コンテキスト200kトークン、出力上限8192トークン）
+DEFAULT_MAX_INPUT_TOKENS = 100000
+DEFAULT_MAX_OUTPUT_TOKENS = 8192
+DEFAULT_OUTPUT_SAFETY_RATIO = 0.8  # 見積もり誤差に備えて出力上限の8割までに抑える
+
+# 1グループあたりの出力（グループ名・理由・JSONの括弧等）の概算トークン数と最小人数
+GROUP_OUTPUT_OVERHEAD_TOKENS = 120
+MIN_GROUP_SIZE = 8
+
+def estimate_tokens(text):
+    """文字列のトークン数を概算する関数"""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    non_ascii_chars = len(text) - ascii_chars
+    return math.ceil(ascii_chars / ASCII_CHARS_PER_TOKEN + non_ascii_chars * NON_ASCII_TOKENS_PER_CHAR)
+
+def estimate_input_tokens(employee):
+    """社員1人分のプロンプト入力トークン数を概算する関数（create_prompt の json.dumps 形式）"""
+    return estimate_tokens(json.dumps(employee, ensure_ascii=False)) + 1  # 区切りのカンマ分
+
+def estimate_output_tokens(employee):
+    """社員1人分の回答出力トークン数を概算する関数
+
+    メンバーIDの出力に加え、グループのヘッダー（グループ名・理由）を最小人数で按分した分を含める。
+    """
+    member_id = str(employee.get("employee_id", ""))
+    return estimate_tokens(f'"{member_id}", ') + math.ceil(GROUP_OUTPUT_OVERHEAD_TOKENS / MIN_GROUP_SIZE)
+
+class ChunkPlan:
+    """チャンク分割の計画（各チャンクの社員リストと見積もりトークン数）を保持するクラス"""
+
+    def __init__(self, chunks, input_estimates, output_estimates, prompt_overhead_tokens, max_input_tokens, output_budget):
+        self.chunks = chunks
+        self.input_estimates = input_estimates
+        self.output_estimates = output_estimates
+        self.prompt_overhead_tokens = prompt_overhead_tokens
+        self.max_input_tokens = max_input_tokens
+        self.output_budget = output_budget
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def to_dict(self):
+        """計画のサマリー（チャンク数・見積もりトークン数）を返す"""
+        return {
+            "chunk_count": len(self.chunks),
+            "chunk_sizes": [len(chunk) for chunk in self.chunks],
+            "estimated_input_tokens": sum(self.input_estimates),
+            "estimated_output_tokens": sum(self.output_estimates),
+            "max_chunk_input_tokens": max(self.input_estimates, default=0),
+            "max_chunk_output_tokens": max(self.output_estimates, default=0),
+            "input_budget": self.max_input_tokens,
+            "output_budget": self.output_budget
+        }
+
+def _split_by_cumulative_cost(costs, chunk_count):
+    """コストの累積がほぼ均等になるよう、順序を保ったまま chunk_count 個の区間に分割する"""
+    total = sum(costs)
+    boundaries = []
+    cumulative = 0
+    next_target = 1
+    for i, cost in enumerate(costs):
+        cumulative += cost
+        if next_target < chunk_count and cumulative >= total * next_target / chunk_count and i + 1 < len(costs):
+            boundaries.append(i + 1)
+            next_target += 1
+    starts = [0] + boundaries
+    ends = boundaries + [len(costs)]
+    return list(zip(starts, ends))
+
+def _split_greedily(input_costs, output_costs, input_budget, output_budget, max_chunk_size):
+    """予算を超える直前で区切りながら、順序を保ったまま先頭から詰めて分割する"""
+    ranges = []
+    start = 0
+    input_total = output_total = 0
+    for i, (input_tokens, output_tokens) in enumerate(zip(input_costs, output_costs)):
+        if i > start and (
+            input_total + input_tokens > input_budget
+            or output_total + output_tokens > output_budget
+            or (max_chunk_size and i - start >= max_chunk_size)
+        ):
+            ranges.append((start, i))
+            start = i
+            input_total = output_total = 0
+        input_total += input_tokens
+        output_total += output_tokens
+    ranges.append((start, len(input_costs)))
+    return ranges
+
+def plan_chunks(
+    employees,
+    prompt_overhead_tokens=0,
+    max_input_tokens=DEFAULT_MAX_INPUT_TOKENS,
+    max_output_tokens=DEFAULT_MAX_OUTPUT_TOKENS,
+    output_safety_ratio=DEFAULT_OUTPUT_SAFETY_RATIO,
+    max_chunk_size=None,
+    input_cost=estimate_input_tokens,
+    output_cost=estimate_output_tokens
+):
+    """入力・出力のトークン予算に収まる最少のチャンク数で社員リストを分割する関数
+
+    prompt_overhead_tokens は社員データ以外のプロンプト部分のトークン数。
+    社員の順序は保ったまま、見積もりトークン数がほぼ均等になるよう分割する。
+    1人分でも予算を超える場合は ValueError を送出する。
+    """
+    input_budget = max_input_tokens - prompt_overhead_tokens
+    output_budget = int(max_output_tokens * output_safety_ratio)
+    if input_budget <= 0:
+        raise ValueError("プロンプトの固定部分だけで入力トークン予算を超えています")
+
+    if not employees:
+        return ChunkPlan([], [], [], prompt_overhead_tokens, max_input_tokens, output_budget)
+
+    input_costs = [input_cost(employee) for employee in employees]
+    output_costs = [output_cost(employee) for employee in employees]
+    if max(input_costs) > input_budget or max(output_costs) > output_budget:
+        raise ValueError("社員1人分のデータがトークン予算を超えています")
+
+    # 先頭から予算いっぱいまで詰める分割は、順序を保った分割の中でチャンク数が最少になる
+    ranges = _split_greedily(input_costs, output_costs, input_budget, output_budget, max_chunk_size)
+
+    # 同じチャンク数でコストが均等になる分割が予算に収まれば、そちらを採用する（最後のチャンクだけ小さくなるのを避ける）
+    # 出力が制約になることが多いため、出力コストで均等に分割する
+    balanced_ranges = _split_by_cumulative_cost(output_costs, len(ranges))
+    if all(
+        sum(input_costs[start:end]) <= input_budget
+        and sum(output_costs[start:end]) <= output_budget
+        and (not max_chunk_size or end - start <= max_chunk_size)
+        for start, end in balanced_ranges
+    ):
+        ranges = balanced_ranges
+
+    input_estimates = [prompt_overhead_tokens + sum(input_costs[start:end]) for start, end in ranges]
+    output_estimates = [sum(output_costs[start:end]) for start, end in ranges]
+    chunks = [employees[start:end] for start, end in ranges]
+    return ChunkPlan(chunks, input_estimates, output_estimates, prompt_overhead_tokens, max_input_tokens, output_budget)
@@ -0,0 +1,79 @@
+import numpy as np
+
+# 一度に正規化・集計する行数（1024次元の float64 で1ブロック約128MB）
+DEFAULT_BLOCK_SIZE = 16384
+
+class CosineEvaluation:
+    """クラスター内のコサイン類似度の評価結果を保持するクラス
+
+    average    : 2人以上のクラスターの「クラスター内の全ペアの平均コサイン類似度」の平均（該当なしの場合は0）
+    per_cluster: クラスター番号 -> {"size": 人数, "mean_cosine": 全ペアの平均（1人の場合は None）}
+    per_member : 各行と同じクラスターの他のメンバーとの平均コサイン類似度（1人のクラスターは NaN）
+    """
+
+    def __init__(self, average, per_cluster=None, per_member=None):
+        self.average = average
+        self.per_cluster = per_cluster
+        self.per_member = per_member
+
+def _normalized_blocks(embeddings, labels, block_size):
+    """行を L2 正規化した float64 のブロックと、対応するクラスターの添字を順に返す（長さ0の行は0のまま）"""
+    for start in range(0, len(embeddings), block_size):
+        block = np.asarray(embeddings[start:start + block_size], dtype=np.float64)
+        norms = np.linalg.norm(block, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        yield start, block / norms, labels[start:start + block_size]
+
+def evaluate_cosine(embeddings, cluster_labels, block_size=DEFAULT_BLOCK_SIZE, per_cluster=False, per_member=False):
+    """クラスター内の平均コサイン類似度を、類似度行列を作らずに O(n·d) で計算する関数
+
+    正規化したベクトル u の和を S とすると、クラスター内の全ペアの内積の合計は (|S|^2 - Σ|u|^2) / 2 になる。
+    行はブロックごとに正規化して集計するため、追加のメモリはブロックとクラスターごとの和のみ。
+    per_member を指定した場合は、各行について (u・S - |u|^2) / (人数 - 1) をもう1回の走査で計算する。
+    正規化と集計は float64 で行う。float32 の埋め込みに対する sklearn の cosine_similarity（float32 で計算）とは
+    float32 の丸め誤差の範囲（約1.2e-7）で異なり、float64 の入力では約1e-16 で一致する。
+    """
+    cluster_ids, labels = np.unique(np.asarray(cluster_labels), return_inverse=True)
+    labels = labels.reshape(-1)
+    cluster_count = len(cluster_ids)
+    dimension = embeddings.shape[1]
+
+    sums = np.zeros((cluster_count, dimension), dtype=np.float64)
+    squared_norms = np.zeros(cluster_count, dtype=np.float64)
+    sizes = np.bincount(labels, minlength=cluster_count)
+    for _, block, block_labels in _normalized_blocks(embeddings, labels, block_size):
+        # クラスター番号順に並べ替え、クラスターごとの和をまとめて計算する
+        order = np.argsort(block_labels, kind="stable")
+        sorted_labels = block_labels[order]
+        starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+        present = sorted_labels[starts]
+        sums[present] += np.add.reduceat(block[order], starts, axis=0)
+        squared_norms[present] += np.add.reduceat(np.einsum("ij,ij->i", block, block)[order], starts)
+
+    pair_counts = sizes * (sizes - 1)
+    multi = pair_counts > 0
+    means = np.full(cluster_count, np.nan)
+    means[multi] = (np.einsum("ij,ij->i", sums[multi], sums[multi]) - squared_norms[multi]) / pair_counts[multi]
+    average = float(np.mean(means[multi])) if multi.any() else 0
+
+    cluster_breakdown = None
+    if per_cluster:
+        cluster_breakdown = {
+            cluster_id.item(): {"size": int(size), "mean_cosine": float(mean) if has_pairs else None}
+            for cluster_id, size, mean, has_pairs in zip(cluster_ids, sizes, means, multi)
+        }
+
+    member_breakdown = None
+    if per_member:
+        member_breakdown = np.full(len(labels), np.nan)
+        for start, block, block_labels in _normalized_blocks(embeddings, labels, block_size):
+            others = sizes[block_labels] - 1
+            similarity = np.einsum("ij,ij->i", block, sums[block_labels]) - np.einsum("ij,ij->i", block, block)
+            valid = others > 0
+            member_breakdown[start:start + len(block)][valid] = similarity[valid] / others[valid]
+
+    return CosineEvaluation(average, cluster_breakdown, member_breakdown)
+
+def evaluate_clustering_cosine(embeddings, cluster_labels, block_size=DEFAULT_BLOCK_SIZE):
+    """クラスター内の平均コサイン類似度（2人以上のクラスターごとの全ペアの平均の平均）を返す関数"""
+    return evaluate_cosine(embeddings, cluster_labels, block_size).average
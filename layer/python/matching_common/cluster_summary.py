@@ -0,0 +1,127 @@
+import threading
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+
+from matching_common.chunk_planner import DEFAULT_MAX_INPUT_TOKENS, DEFAULT_MAX_OUTPUT_TOKENS, estimate_tokens, plan_chunks
+from matching_common.metrics import metrics
+
+# クラスターの要約を同時に実行する数（Bedrock クライアントの接続プールのデフォルト10以下にする）
+DEFAULT_SUMMARY_MAX_WORKERS = 8
+
+class ClusterPrompt:
+    """クラスター（またはその一部）を要約するプロンプト"""
+
+    __slots__ = ("cluster", "part", "parts", "member_ids", "prompt")
+
+    def __init__(self, cluster, part, parts, member_ids, prompt):
+        self.cluster = cluster
+        self.part = part  # 1から始まる番号（プロンプトに収まらないクラスターは parts 個に分割する）
+        self.parts = parts
+        self.member_ids = member_ids
+        self.prompt = prompt
+
+class ClusterSummary:
+    """クラスター（またはその一部）の要約結果"""
+
+    __slots__ = ("cluster", "part", "parts", "member_count", "text")
+
+    def __init__(self, cluster, part, parts, member_count, text):
+        self.cluster = cluster
+        self.part = part
+        self.parts = parts
+        self.member_count = member_count
+        self.text = text
+
+    @property
+    def title(self):
+        """結果ファイルの見出し（分割したクラスターは何番目かを付ける）"""
+        if self.parts == 1:
+            return f"Cluster {self.cluster} 特性"
+        return f"Cluster {self.cluster} 特性（{self.part}/{self.parts}）"
+
+def _member_input_tokens(member):
+    return estimate_tokens(member["chunks"]) + 1  # 区切りの空白分
+
+def plan_cluster_prompts(cluster, member_ids, chunks_by_id, build_prompt, max_input_tokens=DEFAULT_MAX_INPUT_TOKENS,
+                         max_output_tokens=DEFAULT_MAX_OUTPUT_TOKENS):
+    """クラスターのメンバーを、入力・出力のトークン予算に収まるプロンプトに分割する関数
+
+    build_prompt(cluster_chunks) はメンバーの chunks を空白でつないだ文字列からプロンプトを作る関数。
+    分割は chunk_planner.plan_chunks と同じく、メンバーの順序を保ったまま最少の数で均等に行う。
+    chunks を取得できなかった（または NULL の）メンバーは含めない。
+    """
+    members = [
+        {"employee_id": member_id, "chunks": chunks_by_id[member_id]}
+        for member_id in member_ids
+        if chunks_by_id.get(member_id) is not None
+    ]
+    plan = plan_chunks(
+        members,
+        prompt_overhead_tokens=estimate_tokens(build_prompt("")),
+        max_input_tokens=max_input_tokens,
+        max_output_tokens=max_output_tokens,
+        input_cost=_member_input_tokens
+    )
+    return [
+        ClusterPrompt(
+            cluster,
+            part,
+            len(plan.chunks),
+            [member["employee_id"] for member in chunk],
+            build_prompt(" ".join(member["chunks"] for member in chunk))
+        )
+        for part, chunk in enumerate(plan.chunks, start=1)
+    ]
+
+def summarize_clusters(cluster_member_ids, load_chunks, build_prompt, summarize, max_input_tokens=DEFAULT_MAX_INPUT_TOKENS,
+                       max_output_tokens=DEFAULT_MAX_OUTPUT_TOKENS, max_workers=DEFAULT_SUMMARY_MAX_WORKERS):
+    """全クラスターを並列に要約し、ClusterSummary をクラスター順（分割した場合はその順）のリストで返す関数
+
+    cluster_member_ids はクラスター番号順のメンバーIDのリスト、load_chunks(member_ids) は id -> chunks の辞書を返す関数、
+    summarize(prompt) は要約テキストを返す関数。
+    chunks はクラスターごとに読み込みながら順にプロンプトを投入し、投入済みで未完了のプロンプトは max_workers の2倍までに抑える
+    （メモリに保持する chunks はその分のみ）。いずれかの要約で例外が発生した場合は、以降の読み込みと投入を止め、
+    未着手のプロンプトはキャンセルして例外を送出する。
+    """
+    slots = threading.BoundedSemaphore(max(1, max_workers) * 2)
+    failures = []  # 失敗した要約の例外（発生順）
+
+    def run(cluster_prompt):
+        try:
+            text = summarize(cluster_prompt.prompt)
+            return ClusterSummary(cluster_prompt.cluster, cluster_prompt.part, cluster_prompt.parts, len(cluster_prompt.member_ids), text)
+        except Exception as e:
+            failures.append(e)
+            raise
+        finally:
+            slots.release()
+
+    executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+    try:
+        futures = []
+        for cluster, member_ids in enumerate(cluster_member_ids):
+            if failures:
+                break
+            with metrics.stage("fetch_chunks"):
+                chunks_by_id = load_chunks(member_ids)
+            cluster_prompts = plan_cluster_prompts(cluster, member_ids, chunks_by_id, build_prompt, max_input_tokens, max_output_tokens)
+            del chunks_by_id
+            metrics.count("SummaryPrompts", len(cluster_prompts))
+            while cluster_prompts:
+                slots.acquire()
+                if failures:
+                    slots.release()
+                    break
+                futures.append(executor.submit(run, cluster_prompts.pop(0)))
+        if failures:
+            raise failures[0]
+
+        # 失敗があればその時点で中断し、なければ投入順に結果を取り出してクラスター順を保つ
+        wait(futures, return_when=FIRST_EXCEPTION)
+        if failures:
+            raise failures[0]
+        return [future.result() for future in futures]
+    except Exception:
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    finally:
+        executor.shutdown(wait=True)
@@ -0,0 +1,191 @@
+import io
+import logging
+import os
+import time
+
+import numpy as np
+from botocore.exceptions import ClientError
+
+from matching_common.aws_clients import get_client
+from matching_common.metrics import metrics
+
+# ロガーの設定
+logger = logging.getLogger()
+
+DEFAULT_RANDOM_STATE = 42
+
+# ミニバッチ KMeans の設定（max_iter はデータ全体を何周するかの上限）
+DEFAULT_BATCH_SIZE = 4096
+DEFAULT_MAX_ITER = 20
+DEFAULT_MAX_NO_IMPROVEMENT = 5
+# 前回の重心から開始した場合は初期値が収束点に近いため、早めに打ち切る
+DEFAULT_WARM_MAX_NO_IMPROVEMENT = 2
+
+DEFAULT_CENTROIDS_S3_PREFIX = "clustering-centroids/"
+
+class ClusteringResult:
+    """クラスタリングの結果（各行のクラスター番号・重心）と、エンジン比較用の評価値を保持するクラス"""
+
+    def __init__(self, labels, centroids, inertia, n_iter, engine, n_steps=None, warm_started=False, seconds=0.0):
+        self.labels = labels
+        self.centroids = centroids
+        self.inertia = inertia  # 各点から所属クラスターの重心までの二乗距離の合計（全データで計算）
+        self.n_iter = n_iter
+        self.n_steps = n_steps  # ミニバッチの更新回数（ミニバッチ KMeans のみ）
+        self.engine = engine
+        self.warm_started = warm_started
+        self.seconds = seconds
+
+    def summary(self):
+        """ログ出力用の辞書"""
+        return {
+            "engine": self.engine,
+            "n_clusters": len(self.centroids),
+            "inertia": float(self.inertia),
+            "n_iter": int(self.n_iter),
+            "n_steps": None if self.n_steps is None else int(self.n_steps),
+            "warm_started": self.warm_started,
+            "seconds": round(self.seconds, 3)
+        }
+
+class S3CentroidStore:
+    """前回の実行の重心を S3 に .npy 形式で保存・読み込みするクラス"""
+
+    def __init__(self, s3, bucket, key):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+
+    def load(self, n_clusters, dimension):
+        """保存済みの重心を返す（存在しない・クラスター数や次元数が異なる場合は None）"""
+        try:
+            data = self.s3.get_object(Bucket=self.bucket, Key=self.key)["Body"].read()
+            metrics.count("S3BytesRead", len(data), unit="Bytes")
+            centroids = np.load(io.BytesIO(data), allow_pickle=False)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in ("NoSuchKey", "404"):
+                logger.warning(f"重心の読み込みに失敗: {e}")
+            return None
+        except ValueError as e:
+            logger.warning(f"保存済みの重心を読み込めないため使用しません: {e}")
+            return None
+
+        if centroids.shape != (n_clusters, dimension):
+            logger.info(f"保存済みの重心の形状 {centroids.shape} が ({n_clusters}, {dimension}) と異なるため使用しません")
+            return None
+        return centroids.astype(np.float32, copy=False)
+
+    def save(self, centroids):
+        """重心を保存する（失敗しても処理は継続する）"""
+        buffer = io.BytesIO()
+        np.save(buffer, np.asarray(centroids, dtype=np.float32), allow_pickle=False)
+        body = buffer.getvalue()
+        try:
+            self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=body, ContentType="application/octet-stream")
+            metrics.count("S3BytesWritten", len(body), unit="Bytes")
+        except ClientError as e:
+            logger.warning(f"重心の保存に失敗: {e}")
+
+class KMeansEngine:
+    """全データ・k-means++ の初期化で毎回クラスタリングするエンジン（従来の処理）"""
+
+    name = "kmeans"
+
+    def __init__(self, random_state=DEFAULT_RANDOM_STATE):
+        self.random_state = random_state
+
+    def fit(self, embeddings, n_clusters):
+        from sklearn.cluster import KMeans
+
+        started = time.perf_counter()
+        model = KMeans(n_clusters=n_clusters, random_state=self.random_state)
+        labels = model.fit_predict(embeddings)
+        return ClusteringResult(labels, model.cluster_centers_, model.inertia_, model.n_iter_, self.name, seconds=time.perf_counter() - started)
+
+class MiniBatchKMeansEngine:
+    """float32 のデータをミニバッチで更新するエンジン
+
+    centroid_store がある場合は前回の重心から開始し、終了後に今回の重心を保存する。
+    前日から社員の構成が大きく変わらなければ数回の更新で収束し、クラスター番号も前日と対応する。
+    """
+
+    name = "minibatch"
+
+    def __init__(self, centroid_store=None, batch_size=DEFAULT_BATCH_SIZE, max_iter=DEFAULT_MAX_ITER,
+                 max_no_improvement=DEFAULT_MAX_NO_IMPROVEMENT, warm_max_no_improvement=DEFAULT_WARM_MAX_NO_IMPROVEMENT,
+                 random_state=DEFAULT_RANDOM_STATE):
+        self.centroid_store = centroid_store
+        self.batch_size = batch_size
+        self.max_iter = max_iter
+        self.max_no_improvement = max_no_improvement
+        self.warm_max_no_improvement = warm_max_no_improvement
+        self.random_state = random_state
+
+    def fit(self, embeddings, n_clusters):
+        from sklearn.cluster import MiniBatchKMeans
+
+        started = time.perf_counter()
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        initial_centroids = None
+        if self.centroid_store:
+            initial_centroids = self.centroid_store.load(n_clusters, embeddings.shape[1])
+
+        model = MiniBatchKMeans(
+            n_clusters=n_clusters,
+            init="k-means++" if initial_centroids is None else initial_centroids,
+            n_init=1,
+            batch_size=min(self.batch_size, len(embeddings)),
+            max_iter=self.max_iter,
+            max_no_improvement=self.max_no_improvement if initial_centroids is None else self.warm_max_no_improvement,
+            random_state=self.random_state
+        )
+        labels = model.fit_predict(embeddings)
+
+        if self.centroid_store:
+            self.centroid_store.save(model.cluster_centers_)
+        return ClusteringResult(
+            labels,
+            model.cluster_centers_,
+            model.inertia_,
+            model.n_iter_,
+            self.name,
+            n_steps=model.n_steps_,
+            warm_started=initial_centroids is not None,
+            seconds=time.perf_counter() - started
+        )
+
+def build_clustering_engine_from_env(name, s3=None, warm_start=True):
+    """環境変数からクラスタリングのエンジンを構成する関数
+
+    CLUSTERING_ENGINE              : "kmeans"（デフォルト、従来の処理）/ "minibatch"
+    CLUSTERING_BATCH_SIZE          : ミニバッチの行数
+    CLUSTERING_MAX_ITER            : データ全体を何周するかの上限
+    CLUSTERING_CENTROIDS_S3_BUCKET : 指定した場合、重心を {CLUSTERING_CENTROIDS_S3_PREFIX}{name}.npy に保存し、次回の初期値にする
+
+    warm_start=False の場合は重心の保存・読み込みを行わない（クラスター数の候補の評価用）。
+    """
+    engine = os.environ.get("CLUSTERING_ENGINE", KMeansEngine.name).lower()
+    if engine == KMeansEngine.name:
+        return KMeansEngine()
+    if engine != MiniBatchKMeansEngine.name:
+        raise ValueError(f"CLUSTERING_ENGINE は kmeans / minibatch のいずれかを指定してください: {engine}")
+
+    centroid_store = None
+    bucket = os.environ.get("CLUSTERING_CENTROIDS_S3_BUCKET")
+    if bucket and warm_start:
+        if s3 is None:
+            s3 = get_client("s3")
+        prefix = os.environ.get("CLUSTERING_CENTROIDS_S3_PREFIX", DEFAULT_CENTROIDS_S3_PREFIX)
+        centroid_store = S3CentroidStore(s3, bucket, f"{prefix}{name}.npy")
+    return MiniBatchKMeansEngine(
+        centroid_store,
+        batch_size=int(os.environ.get("CLUSTERING_BATCH_SIZE", DEFAULT_BATCH_SIZE)),
+        max_iter=int(os.environ.get("CLUSTERING_MAX_ITER", DEFAULT_MAX_ITER))
+    )
+
+def cluster_embeddings(engine, embeddings, n_clusters):
+    """engine でクラスタリングし、評価値（inertia・反復回数）をメトリクスに記録する関数"""
+    result = engine.fit(embeddings, n_clusters)
+    metrics.observe("ClusteringInertia", float(result.inertia), unit="None")
+    metrics.observe("ClusteringIterations", int(result.n_iter), unit="Count")
+    return result
@@ -0,0 +1,86 @@
+import logging
+import math
+
+from matching_common.chunk_planner import GROUP_OUTPUT_OVERHEAD_TOKENS, MIN_GROUP_SIZE, estimate_tokens
+
+# ロガーの設定
+logger = logging.getLogger()
+
+# 表のヘッダーに使う項目名
+FIELD_LABELS = {
+    "hobby": "趣味",
+    "favourite_food_drink_cuisine": "好きな食べ物・飲み物",
+    "keywords": "キーワード",
+    "nearest_station": "最寄り駅",
+    "departments": "部署",
+    "age": "年代",
+    "gender": "性別"
+}
+
+# グルーピングルールで使用する項目（趣味でグルーピングするため、デフォルトは趣味のみ）
+DEFAULT_FIELDS = ("hobby",)
+
+# 表の区切り文字
+COLUMN_SEPARATOR = "|"
+VALUE_SEPARATOR = ","
+
+def _format_value(value):
+    """表のセルに入れる値を整形する（リストはカンマ区切り、区切り文字は除去）"""
+    if isinstance(value, list):
+        value = VALUE_SEPARATOR.join(str(v) for v in value)
+    elif value is None:
+        value = ""
+    return str(value).replace(COLUMN_SEPARATOR, " ").replace("\n", " ")
+
+def encode_compact_table(employees, fields=DEFAULT_FIELDS):
+    """社員リストを「連番ID|項目...」形式の表に変換する関数
+
+    IDはチャンク内で1から始まる連番で、employees の並び順に対応する。
+    """
+    header = COLUMN_SEPARATOR.join(["ID"] + [FIELD_LABELS.get(field, field) for field in fields])
+    rows = [header]
+    for index, employee in enumerate(employees, start=1):
+        rows.append(COLUMN_SEPARATOR.join([str(index)] + [_format_value(employee.get(field)) for field in fields]))
+    return "\n".join(rows)
+
+def decode_member_ids(groups, employees):
+    """連番IDで回答されたグループのメンバーを employee_id に戻す関数
+
+    groups は parse_groups_from_json の戻り値の形式（グループ名 -> {"members", "reason"}）。
+    範囲外や数値でないIDは除外し、件数をログに出力する。
+    """
+    decoded_groups = {}
+    invalid_count = 0
+
+    for group_name, group_info in groups.items():
+        member_ids = []
+        for member in group_info.get("members", []):
+            try:
+                index = int(str(member).strip())
+            except ValueError:
+                invalid_count += 1
+                continue
+            if 1 <= index <= len(employees):
+                member_ids.append(employees[index - 1].get("employee_id"))
+            else:
+                invalid_count += 1
+
+        decoded_groups[group_name] = dict(group_info, members=member_ids)
+
+    if invalid_count:
+        logger.warning(f"連番IDとして解釈できないメンバーを除外しました: {invalid_count}件")
+    return decoded_groups
+
+def make_compact_cost_functions(fields=DEFAULT_FIELDS, max_index=9999):
+    """コンパクト形式でのトークン見積もり関数（入力・出力）を返す関数（chunk_planner.plan_chunks 用）"""
+    # 連番IDは最大桁数で見積もる
+    id_tokens = estimate_tokens(f"{max_index}, ")
+
+    def input_cost(employee):
+        row = COLUMN_SEPARATOR.join([str(max_index)] + [_format_value(employee.get(field)) for field in fields])
+        return estimate_tokens(row) + 1  # 改行分
+
+    def output_cost(employee):
+        return id_tokens + math.ceil(GROUP_OUTPUT_OVERHEAD_TOKENS / MIN_GROUP_SIZE)
+
+    return input_cost, output_cost
@@ -0,0 +1,291 @@
+import os
+import struct
+
+import numpy as np
+
+# Bedrock ナレッジベース（Aurora PostgreSQL + pgvector）のテーブル
+KNOWLEDGE_BASE_TABLE = "bedrock_integration.bedrock_knowledge_base"
+
+# COPY ... (FORMAT binary) のヘッダー（署名11バイト + フラグ4バイト + ヘッダー拡張領域の長さ4バイト）
+COPY_BINARY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+_HEADER_SIZE = len(COPY_BINARY_SIGNATURE) + 8
+
+# 受け取ったデータをまとめて解析する単位（COPY の出力は1行ずつ write されるため、ある程度溜めてから変換する）
+PARSE_BATCH_BYTES = 1024 * 1024
+
+# 名前付きカーソルで1回に取得する行数（1024次元の場合、1000行あたり約4MB）
+DEFAULT_CURSOR_ITERSIZE = 2000
+
+# 1行のフィールド数（id・embedding）と終端を表すフィールド数
+_FIELD_COUNT = 2
+_TRAILER = -1
+
+class CopyBinaryEmbeddingParser:
+    """COPY (SELECT id::text, embedding::vector ...) TO STDOUT (FORMAT binary) の出力を解析する file-like オブジェクト
+
+    cursor.copy_expert の出力先に渡すと、PARSE_BATCH_BYTES ごとに float32 の配列へ直接書き込む。
+    vector 型のバイナリ表現は「次元数 int16・予備 int16・float4 × 次元数」（ビッグエンディアン）。
+    id の長さが1行目と同じ行（uuid の文字列表現等）は numpy の構造化配列としてまとめて変換し、
+    それ以外の行と終端は1行ずつ解析する。
+    """
+
+    def __init__(self, expected_rows=0):
+        self.expected_rows = expected_rows
+        self.ids = []
+        self.embeddings = None
+        self.row_count = 0
+        self.dimension = None
+        self.finished = False
+        self._pending = b""
+        self._received = []
+        self._received_bytes = 0
+        self._header_done = False
+        self._row_dtype = None
+
+    def write(self, data):
+        self._received.append(bytes(data))
+        self._received_bytes += len(data)
+        if self._received_bytes >= PARSE_BATCH_BYTES:
+            self._drain()
+        return len(data)
+
+    def result(self):
+        """(ids, embeddings) を返す。embeddings は (行数, 次元数) の C 連続な float32 配列"""
+        self._drain()
+        if not self.finished or self._pending:
+            raise ValueError("COPY のバイナリ出力が途中で終わっています")
+        if self.embeddings is None:
+            return [], np.empty((0, 0), dtype=np.float32)
+        embeddings = self.embeddings[:self.row_count]
+        if len(self.embeddings) != self.row_count:
+            # 見込みより行数が少なかった場合は余りの領域を解放する
+            embeddings = embeddings.copy()
+        return self.ids, embeddings
+
+    def _drain(self):
+        """受け取ったデータを解析し、行の途中で終わる残りを次回に回す"""
+        if not self._received:
+            return
+        buffer = b"".join([self._pending] + self._received)
+        self._received = []
+        self._received_bytes = 0
+        self._pending = buffer[self._parse(buffer):]
+
+    def _parse(self, buffer):
+        """buffer を解析し、処理したバイト数を返す（行の途中で終わる場合はその行の先頭まで）"""
+        pos = 0
+        if not self._header_done:
+            if len(buffer) < _HEADER_SIZE:
+                return 0
+            if not buffer.startswith(COPY_BINARY_SIGNATURE):
+                raise ValueError("COPY のバイナリ形式ではありません")
+            extension_length = struct.unpack_from(">i", buffer, _HEADER_SIZE - 4)[0]
+            if len(buffer) < _HEADER_SIZE + extension_length:
+                return 0
+            pos = _HEADER_SIZE + extension_length
+            self._header_done = True
+
+        while pos < len(buffer) and not self.finished:
+            if self._row_dtype is not None:
+                pos = self._parse_fixed_rows(buffer, pos)
+            next_pos = self._parse_row(buffer, pos)
+            if next_pos is None:
+                break
+            pos = next_pos
+        if self.finished and pos < len(buffer):
+            raise ValueError("COPY の終端の後にデータがあります")
+        return pos
+
+    def _parse_fixed_rows(self, buffer, pos):
+        """1行目と同じ長さの行を構造化配列としてまとめて変換し、次の位置を返す"""
+        count = (len(buffer) - pos) // self._row_dtype.itemsize
+        if count == 0:
+            return pos
+        rows = np.frombuffer(buffer, dtype=self._row_dtype, count=count, offset=pos)
+        valid = (
+            (rows["fields"] == _FIELD_COUNT)
+            & (rows["id_length"] == self._row_dtype["id"].itemsize)
+            & (rows["vector_length"] == 4 + 4 * self.dimension)
+            & (rows["dimension"] == self.dimension)
+        )
+        if not valid.all():
+            # 長さの異なる行・終端以降は1行ずつ解析する
+            count = int(np.argmin(valid))
+            rows = rows[:count]
+        if count:
+            self._reserve(count)
+            self.embeddings[self.row_count:self.row_count + count] = rows["vector"]
+            self.ids.extend(row_id.decode("utf-8") for row_id in rows["id"].tolist())
+            self.row_count += count
+        return pos + count * self._row_dtype.itemsize
+
+    def _parse_row(self, buffer, pos):
+        """1行（または終端）を解析して次の位置を返す（データが足りない場合は None）"""
+        end = len(buffer)
+        if pos + 2 > end:
+            return None
+        field_count = struct.unpack_from(">h", buffer, pos)[0]
+        if field_count == _TRAILER:
+            self.finished = True
+            return pos + 2
+        if field_count != _FIELD_COUNT:
+            raise ValueError(f"想定外のフィールド数です: {field_count}")
+
+        if pos + 6 > end:
+            return None
+        id_length = struct.unpack_from(">i", buffer, pos + 2)[0]
+        if id_length < 0:
+            raise ValueError("id が NULL の行があります")
+        vector_pos = pos + 6 + id_length
+        if vector_pos + 8 > end:
+            return None
+        vector_length, dimension = struct.unpack_from(">ih", buffer, vector_pos)
+        if vector_length < 0:
+            raise ValueError("embedding が NULL の行があります")
+        if vector_length != 4 + 4 * dimension:
+            raise ValueError(f"vector 型のバイナリ表現ではありません（長さ {vector_length}、次元数 {dimension}）")
+        next_pos = vector_pos + 4 + vector_length
+        if next_pos > end:
+            return None
+
+        if self.dimension is None:
+            self._start(dimension, id_length)
+        elif dimension != self.dimension:
+            raise ValueError(f"次元数の異なる embedding があります（{self.dimension} と {dimension}）")
+
+        self._reserve(1)
+        self.embeddings[self.row_count] = np.frombuffer(buffer, dtype=">f4", count=dimension, offset=vector_pos + 8)
+        self.ids.append(buffer[pos + 6:vector_pos].decode("utf-8"))
+        self.row_count += 1
+        return next_pos
+
+    def _start(self, dimension, id_length):
+        """1行目の次元数・id の長さから配列を確保し、まとめて変換する行の形式を決める"""
+        self.dimension = dimension
+        self.embeddings = np.empty((max(self.expected_rows, 1), dimension), dtype=np.float32)
+        self._row_dtype = np.dtype([
+            ("fields", ">i2"),
+            ("id_length", ">i4"),
+            ("id", f"S{id_length}"),
+            ("vector_length", ">i4"),
+            ("dimension", ">i2"),
+            ("unused", ">i2"),
+            ("vector", ">f4", (dimension,))
+        ])
+
+    def _reserve(self, count):
+        self.embeddings = _reserve_rows(self.embeddings, self.row_count, count)
+
+def _reserve_rows(embeddings, row_count, count):
+    """count 行を書き込めるよう配列を拡張する（見込みの行数より多かった場合のみ）"""
+    needed = row_count + count
+    if needed <= len(embeddings):
+        return embeddings
+    grown = np.empty((max(needed, len(embeddings) * 2), embeddings.shape[1]), dtype=np.float32)
+    grown[:row_count] = embeddings[:row_count]
+    return grown
+
+def _count_embeddings(conn, table, embedding_column):
+    cur = conn.cursor()
+    try:
+        cur.execute(f"SELECT count(*) FROM {table} WHERE {embedding_column} IS NOT NULL")
+        return cur.fetchone()[0]
+    finally:
+        cur.close()
+
+def load_embeddings(conn, table=KNOWLEDGE_BASE_TABLE, id_column="id", embedding_column="embedding"):
+    """ナレッジベースの embedding を COPY のバイナリ形式で取得し、(ids, embeddings) を返す関数
+
+    ids は id の文字列のリスト、embeddings は (行数, 次元数) の C 連続な float32 配列（行の順序は ids と同じ）。
+    embedding が NULL の行は含まない。テーブル名・列名は SQL に埋め込むため、固定値のみ渡すこと。
+    """
+    # 配列を1回で確保できるよう、先に行数を取得する（取得中に増えた場合は配列を拡張する）
+    parser = CopyBinaryEmbeddingParser(_count_embeddings(conn, table, embedding_column))
+    cur = conn.cursor()
+    try:
+        cur.copy_expert(
+            f"COPY (SELECT {id_column}::text, {embedding_column}::vector FROM {table} "
+            f"WHERE {embedding_column} IS NOT NULL) TO STDOUT (FORMAT binary)",
+            parser
+        )
+    finally:
+        cur.close()
+    return parser.result()
+
+def stream_embeddings(conn, itersize=DEFAULT_CURSOR_ITERSIZE, table=KNOWLEDGE_BASE_TABLE, id_column="id", embedding_column="embedding"):
+    """名前付き（サーバーサイド）カーソルで itersize 行ずつ embedding を取得し、(ids, embeddings) を返す関数
+
+    各行は vector_send のバイナリ表現（bytea）で受け取り、1回分の行をまとめて float32 の配列に書き込む。
+    クライアント側で保持する取得途中のデータは1回分（itersize 行）のみ。戻り値は load_embeddings と同じ。
+    """
+    embeddings = np.empty((0, 0), dtype=np.float32)
+    expected_rows = _count_embeddings(conn, table, embedding_column)
+    ids = []
+    row_count = 0
+    row_dtype = None
+
+    cur = conn.cursor(name="knowledge_base_embeddings")
+    cur.itersize = itersize
+    try:
+        cur.execute(
+            f"SELECT {id_column}::text, vector_send({embedding_column}::vector) FROM {table} "
+            f"WHERE {embedding_column} IS NOT NULL"
+        )
+        while True:
+            rows = cur.fetchmany(itersize)
+            if not rows:
+                break
+            payload = b"".join(bytes(row[1]) for row in rows)
+            if row_dtype is None:
+                # 1行目の次元数から配列を確保する
+                dimension = struct.unpack_from(">h", payload)[0]
+                embeddings = np.empty((max(expected_rows, 1), dimension), dtype=np.float32)
+                row_dtype = np.dtype([("dimension", ">i2"), ("unused", ">i2"), ("vector", ">f4", (dimension,))])
+            if len(payload) != len(rows) * row_dtype.itemsize:
+                raise ValueError("次元数の異なる embedding があります")
+            vectors = np.frombuffer(payload, dtype=row_dtype)
+            if not (vectors["dimension"] == embeddings.shape[1]).all():
+                raise ValueError("次元数の異なる embedding があります")
+
+            embeddings = _reserve_rows(embeddings, row_count, len(rows))
+            embeddings[row_count:row_count + len(rows)] = vectors["vector"]
+            ids.extend(row[0] for row in rows)
+            row_count += len(rows)
+    finally:
+        cur.close()
+
+    if len(embeddings) != row_count:
+        embeddings = embeddings[:row_count].copy()
+    return ids, embeddings
+
+def load_embeddings_from_env(conn):
+    """環境変数で指定した方法で embedding を取得する関数
+
+    EMBEDDING_FETCH_MODE      : "copy"（COPY のバイナリ形式、デフォルト）/ "cursor"（名前付きカーソル）
+    EMBEDDING_CURSOR_ITERSIZE : "cursor" の場合に1回に取得する行数
+    """
+    mode = os.environ.get("EMBEDDING_FETCH_MODE", "copy").lower()
+    if mode == "cursor":
+        return stream_embeddings(conn, int(os.environ.get("EMBEDDING_CURSOR_ITERSIZE", DEFAULT_CURSOR_ITERSIZE)))
+    if mode != "copy":
+        raise ValueError(f"EMBEDDING_FETCH_MODE は copy / cursor のいずれかを指定してください: {mode}")
+    return load_embeddings(conn)
+
+def fetch_chunks(conn, ids, batch_size=DEFAULT_CURSOR_ITERSIZE, table=KNOWLEDGE_BASE_TABLE, id_column="id", id_type="uuid", chunks_column="chunks"):
+    """指定した id の chunks（社員情報のテキスト）のみを取得し、id -> chunks の辞書で返す関数
+
+    クラスターごと・LLM に送るメンバーごとに呼び出し、テーブル全体の chunks をメモリに載せないようにする。
+    id は batch_size 件ずつ主キーで検索する。存在しなくなった id は辞書に含まれない。
+    """
+    chunks_by_id = {}
+    cur = conn.cursor()
+    try:
+        for start in range(0, len(ids), batch_size):
+            cur.execute(
+                f"SELECT {id_column}::text, {chunks_column} FROM {table} WHERE {id_column} = ANY(%s::{id_type}[])",
+                (list(ids[start:start + batch_size]),)
+            )
+            chunks_by_id.update(cur.fetchall())
+    finally:
+        cur.close()
+    return chunks_by_id
@@ -0,0 +1,155 @@
+import re
+import threading
+import unicodedata
+
+# グループ名の前後から取り除く括弧・引用符（NFKC正規化後の文字）
+BRACKET_CHARS = "「」『』【】[]()（）<>〈〉《》\"'“”‘’"
+
+# グループ名の末尾から取り除く接尾辞
+GROUP_NAME_SUFFIXES = ("グループ", "group", "Group", "GROUP")
+
+# レポートに含める詳細の最大件数（件数そのものは全件数える）
+MAX_REPORT_DETAILS = 1000
+
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+
+def canonicalize_group_name(name):
+    """グループ名を比較用の正規形に変換する関数
+
+    NFKC正規化（全角・半角の統一）、空白の除去、前後の括弧・引用符と末尾の「グループ」の除去を行う。
+    例: 「読書クラブグループ」、読書クラブグループ、｢読書クラブ グループ｣ はすべて "読書クラブ" になる。
+    """
+    canonical = unicodedata.normalize("NFKC", str(name))
+    canonical = _WHITESPACE_PATTERN.sub("", canonical)
+
+    while True:
+        stripped = canonical.strip(BRACKET_CHARS)
+        for suffix in GROUP_NAME_SUFFIXES:
+            if stripped.endswith(suffix) and len(stripped) > len(suffix):
+                stripped = stripped[:-len(suffix)]
+        if stripped == canonical:
+            return canonical
+        canonical = stripped
+
+class GroupMerger:
+    """複数チャンクのグループ情報を、正規化したグループ名で統合するクラス
+
+    メンバーは挿入順を保った集合（dict）で保持し、同じIDの重複を除く。
+    exclusive_members=True の場合、1人1グループのルールに従い、別のグループに既に所属しているIDは後から追加しない。
+    名前の表記ゆれ・重複ID・グループ間の競合はレポートとして記録する。処理はグループ数・ID数に対して線形。
+    """
+
+    def __init__(self, exclusive_members=False):
+        self.exclusive_members = exclusive_members
+        self._groups = {}  # 正規化名 -> {"name", "members", "reason"}
+        self._name_variants = {}  # 正規化名 -> 表記ゆれの集合（挿入順）
+        self._member_owner = {}  # メンバーID -> 最初に所属した正規化名
+        self.duplicate_member_count = 0
+        self.conflict_member_count = 0
+        self._duplicate_details = []
+        self._conflict_details = []
+
+    def add_group(self, group_name, members, reason=""):
+        key = canonicalize_group_name(group_name)
+        group = self._groups.get(key)
+        if group is None:
+            group = {"name": group_name, "members": {}, "reason": reason or ""}
+            self._groups[key] = group
+        elif not group["reason"] and reason:
+            # 理由が空の場合は新しい理由を使用
+            group["reason"] = reason
+        self._name_variants.setdefault(key, {})[group_name] = None
+
+        for member_id in members:
+            if isinstance(member_id, str):
+                member_id = member_id.strip()
+            elif not isinstance(member_id, int):
+                continue
+            if not member_id:
+                continue
+
+            owner = self._member_owner.get(member_id)
+            if owner is None:
+                self._member_owner[member_id] = key
+                group["members"][member_id] = None
+            elif owner == key:
+                self.duplicate_member_count += 1
+                if len(self._duplicate_details) < MAX_REPORT_DETAILS:
+                    self._duplicate_details.append({"member_id": member_id, "group_name": group["name"]})
+            else:
+                self.conflict_member_count += 1
+                if len(self._conflict_details) < MAX_REPORT_DETAILS:
+                    self._conflict_details.append({
+                        "member_id": member_id,
+                        "kept_in": self._groups[owner]["name"],
+                        "also_in": group["name"]
+                    })
+                if not self.exclusive_members:
+                    group["members"][member_id] = None
+
+    def add_groups(self, groups):
+        """parse_groups_from_json の戻り値の形式（グループ名 -> {"members", "reason"}）をまとめて追加する"""
+        for group_name, group_info in groups.items():
+            self.add_group(group_name, group_info.get("members", []), group_info.get("reason", ""))
+
+    def to_groups(self):
+        """merge_groups と同じ形式（グループ名 -> {"members": リスト, "reason"}）で統合結果を返す"""
+        return {
+            group["name"]: {"members": list(group["members"]), "reason": group["reason"]}
+            for group in self._groups.values()
+        }
+
+    def report(self):
+        """表記ゆれ・重複ID・グループ間の競合のレポートを返す"""
+        merged_names = [
+            {"group_name": self._groups[key]["name"], "variants": list(variants)}
+            for key, variants in self._name_variants.items()
+            if len(variants) > 1
+        ]
+        return {
+            "merged_name_variants": merged_names[:MAX_REPORT_DETAILS],
+            "merged_name_variant_count": len(merged_names),
+            "duplicate_member_count": self.duplicate_member_count,
+            "duplicate_members": self._duplicate_details,
+            "conflict_member_count": self.conflict_member_count,
+            "conflict_members": self._conflict_details,
+            "exclusive_members": self.exclusive_members
+        }
+
+class ChunkOrderedMerger:
+    """チャンクごとに届くグループを、チャンク順を保ったまま GroupMerger に逐次統合するクラス（スレッドセーフ）
+
+    先行するチャンクがすべて完了していれば、グループは届いた時点で統合する。
+    それ以外のチャンクのグループは保留し、先行するチャンクが完了した時点でチャンク順に統合する。
+    そのため並列に受信しても、全チャンクの完了後にチャンク順で add_groups した場合と同じ結果になる。
+    """
+
+    def __init__(self, merger, chunk_count):
+        self.merger = merger
+        self._pending = [[] for _ in range(chunk_count)]  # チャンク番号 -> 保留中の (グループ名, メンバー, 理由)
+        self._completed = [False] * chunk_count
+        self._current = 0  # 届いた時点で統合するチャンク（これより前のチャンクは統合済み）
+        self._lock = threading.Lock()
+
+    def add_group(self, chunk_index, group_name, members, reason=""):
+        with self._lock:
+            if chunk_index == self._current:
+                self.merger.add_group(group_name, members, reason)
+            else:
+                self._pending[chunk_index].append((group_name, members, reason))
+
+    def add_groups(self, chunk_index, groups):
+        """parse_groups_from_json の戻り値の形式のグループを、チャンク chunk_index のグループとして追加する"""
+        for group_name, group_info in groups.items():
+            self.add_group(chunk_index, group_name, group_info.get("members", []), group_info.get("reason", ""))
+
+    def complete(self, chunk_index):
+        """チャンクの受信完了を記録し、次のチャンクの保留分を統合する"""
+        with self._lock:
+            self._completed[chunk_index] = True
+            while self._current < len(self._completed) and self._completed[self._current]:
+                self._current += 1
+                if self._current < len(self._pending):
+                    for group_name, members, reason in self._pending[self._current]:
+                        self.merger.add_group(group_name, members, reason)
+                    self._pending[self._current] = []
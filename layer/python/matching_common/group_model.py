@@ -0,0 +1,190 @@
+import re
+import sys
+from functools import lru_cache
+
+# grouping.py が7人以下のグループのメンバーを集めるテーマ名
+DISCARDED_THEME = "切り捨てられたメンバー一覧"
+
+# UUIDのパターン（8-4-4-4-12の16進数）
+UUID_PATTERN = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', re.IGNORECASE)
+
+_intern = sys.intern
+
+def intern_member_id(member_id):
+    """メンバーIDを前後の空白を除いてインターンする（整数はそのまま、それ以外の型・空文字は None）"""
+    if isinstance(member_id, int) and not isinstance(member_id, bool):
+        return member_id
+    if not isinstance(member_id, str):
+        return None
+    member_id = member_id.strip()
+    return _intern(member_id) if member_id else None
+
+def intern_member_ids(member_ids):
+    """メンバーIDのリストをインターン済みのタプルに変換する（不正なIDは除く）"""
+    return tuple(member_id for member_id in map(intern_member_id, member_ids or ()) if member_id is not None)
+
+@lru_cache(maxsize=1 << 18)
+def is_uuid(member_id):
+    """UUID形式のIDかを判定する（同じIDの判定はキャッシュする）"""
+    return UUID_PATTERN.match(member_id) is not None
+
+class Group:
+    """グループ（few.py / secondary-userid-check の出力の groups の要素）
+
+    member_ids はインターン済みのIDのタプル。元のJSONにメンバーIDのリストがない場合は None。
+    group_name / reason / member_count / member_ids 以外のキーは extra にそのまま保持する。
+    """
+
+    __slots__ = ("name", "reason", "member_ids", "extra")
+
+    def __init__(self, name, reason="", member_ids=(), extra=None):
+        self.name = name
+        self.reason = reason
+        self.member_ids = member_ids
+        self.extra = extra
+
+    @property
+    def member_count(self):
+        return len(self.member_ids) if self.member_ids is not None else 0
+
+    @classmethod
+    def from_json(cls, data):
+        member_ids = data.get("member_ids")
+        extra = {key: value for key, value in data.items() if key not in ("group_name", "reason", "member_count", "member_ids")}
+        return cls(
+            data.get("group_name", ""),
+            data.get("reason", ""),
+            intern_member_ids(member_ids) if isinstance(member_ids, list) else None,
+            extra or None
+        )
+
+    def to_json(self):
+        data = {"group_name": self.name, "reason": self.reason}
+        if self.member_ids is not None:
+            data["member_count"] = len(self.member_ids)
+            data["member_ids"] = list(self.member_ids)
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def with_members(self, member_ids):
+        return Group(self.name, self.reason, tuple(member_ids), self.extra)
+
+class GroupSet:
+    """グループの集合（メンバー総数は1回だけ数えてキャッシュする）"""
+
+    __slots__ = ("groups", "_total_members")
+
+    def __init__(self, groups):
+        self.groups = tuple(groups)
+        self._total_members = None
+
+    def __len__(self):
+        return len(self.groups)
+
+    def __iter__(self):
+        return iter(self.groups)
+
+    @property
+    def total_groups(self):
+        return len(self.groups)
+
+    @property
+    def total_members(self):
+        if self._total_members is None:
+            self._total_members = sum(group.member_count for group in self.groups)
+        return self._total_members
+
+    def member_ids(self):
+        """全グループのメンバーID（重複を除き、出現順）"""
+        return list(dict.fromkeys(member_id for group in self.groups for member_id in group.member_ids or ()))
+
+    @classmethod
+    def from_json(cls, groups):
+        return cls(Group.from_json(group) for group in groups or [] if isinstance(group, dict))
+
+    @classmethod
+    def from_merged(cls, merged_groups):
+        """GroupMerger.to_groups の形式（グループ名 -> {"members", "reason"}）からメンバー数の多い順に作成する"""
+        groups = [
+            Group(name, info.get("reason", ""), intern_member_ids(info.get("members", [])))
+            for name, info in merged_groups.items()
+        ]
+        groups.sort(key=lambda group: group.member_count, reverse=True)
+        return cls(groups)
+
+    def to_json(self):
+        return [group.to_json() for group in self.groups]
+
+    def summary(self):
+        return {"total_groups": self.total_groups, "total_members_grouped": self.total_members}
+
+    def filter_members(self, keep):
+        """keep(member_id) が真のメンバーのみ残した GroupSet と、除外した (メンバーID, グループ) のリストを返す
+
+        メンバーがいなくなったグループは除く。メンバーIDのリストを持たないグループはそのまま残す。
+        """
+        groups = []
+        excluded = []
+        for group in self.groups:
+            if group.member_ids is None:
+                groups.append(group)
+                continue
+            kept = []
+            for member_id in group.member_ids:
+                if keep(member_id):
+                    kept.append(member_id)
+                else:
+                    excluded.append((member_id, group))
+            if kept:
+                groups.append(group.with_members(kept) if len(kept) != group.member_count else group)
+        return GroupSet(groups), excluded
+
+class Theme:
+    """テーマ（grouping.py の出力の要素。1つのテーマに10人程度のサブグループが複数ある）
+
+    subgroups はインターン済みのIDのタプルのタプル。
+    """
+
+    __slots__ = ("name", "reason", "subgroups", "_member_count")
+
+    def __init__(self, name, reason, subgroups):
+        self.name = name
+        self.reason = reason
+        self.subgroups = tuple(tuple(subgroup) for subgroup in subgroups)
+        self._member_count = None
+
+    @property
+    def subgroup_count(self):
+        return len(self.subgroups)
+
+    @property
+    def member_count(self):
+        if self._member_count is None:
+            self._member_count = sum(len(subgroup) for subgroup in self.subgroups)
+        return self._member_count
+
+    @property
+    def is_discarded(self):
+        return self.name == DISCARDED_THEME
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(
+            data.get("theme"),
+            data.get("reason", ""),
+            (intern_member_ids(subgroup.get("id_list", [])) for subgroup in data.get("group_list", []))
+        )
+
+    def to_json(self):
+        return {
+            "theme": self.name,
+            "reason": self.reason,
+            "group_list": [{"id_list": list(subgroup)} for subgroup in self.subgroups]
+        }
+
+def themes_from_json(themes):
+    return [Theme.from_json(theme) for theme in themes or [] if isinstance(theme, dict)]
+
+def themes_to_json(themes):
+    return [theme.to_json() for theme in themes]
@@ -0,0 +1,205 @@
+import logging
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+# ロガーの設定
+logger = logging.getLogger()
+
+# グループ人数の制約（few.py のプロンプトのルールと同じ）
+DEFAULT_MIN_GROUP_SIZE = 8
+DEFAULT_MAX_GROUP_SIZE = 100
+
+# どの趣味でもグループを作れなかった社員をまとめるグループのキー
+MIXED_GROUP_KEY = None
+
+class HobbyGroup:
+    """趣味ごとに割り当てたグループ（名前付け前）を保持するクラス"""
+
+    def __init__(self, hobby, members, part=1, parts=1, extra_members=0):
+        self.hobby = hobby  # MIXED_GROUP_KEY の場合は趣味が共通しない社員のグループ
+        self.members = members
+        self.part = part
+        self.parts = parts
+        self.extra_members = extra_members  # 人数の制約のために加えた、hobby を趣味としない社員の数
+
+def build_hobby_index(employees):
+    """趣味 -> 社員IDリストの転置インデックスを作成する関数"""
+    index = {}
+    for employee in employees:
+        for hobby in dict.fromkeys(employee.get("hobby") or []):
+            index.setdefault(hobby, []).append(employee.get("employee_id"))
+    return index
+
+def _split_evenly(members, max_size):
+    """max_size を超えるメンバーリストを、人数がほぼ均等な複数のリストに分割する"""
+    parts = math.ceil(len(members) / max_size)
+    size, remainder = divmod(len(members), parts)
+    result = []
+    start = 0
+    for i in range(parts):
+        end = start + size + (1 if i < remainder else 0)
+        result.append(members[start:end])
+        start = end
+    return result
+
+def solve_hobby_groups(employees, min_size=DEFAULT_MIN_GROUP_SIZE, max_size=DEFAULT_MAX_GROUP_SIZE):
+    """趣味で社員をグループに割り当てる関数（1人1グループ、各グループ min_size 人以上 max_size 人以下）
+
+    各社員を、自分の趣味のうち全社で最も人気のある趣味に仮に割り当て、
+    min_size に満たない趣味を少ない順に解散して、その社員を次に人気のある趣味へ移す処理を繰り返す。
+    その後、残った社員の中で共通の趣味を持つ社員が min_size 人以上いればグループにする。
+    max_size を超えた趣味は人数が均等になるよう分割する。
+    どの趣味でもグループを作れなかった社員は、max_size 未満のグループに加え、入りきらない社員が min_size 人以上いる場合のみ
+    趣味が共通しないグループ（hobby が MIXED_GROUP_KEY）にまとめる（_place_leftovers）。
+    結果は入力順に依存しない（社員ID順に処理する）。
+    """
+    if max_size < 2 * min_size - 1:
+        raise ValueError("max_size は分割後も min_size 以上になるよう 2 * min_size - 1 以上にしてください")
+
+    employees = sorted(employees, key=lambda employee: str(employee.get("employee_id")))
+    hobby_counts = {hobby: len(member_ids) for hobby, member_ids in build_hobby_index(employees).items()}
+
+    # 社員ごとの候補（人気の高い趣味順）と、現在割り当てている候補の位置
+    candidates = [
+        sorted(set(employee.get("hobby") or []), key=lambda hobby: (-hobby_counts[hobby], hobby))
+        for employee in employees
+    ]
+    positions = [0] * len(employees)
+    dissolved = set()
+
+    while True:
+        members_by_hobby = {}
+        for i, hobby_list in enumerate(candidates):
+            # 解散済みの趣味を飛ばして次の候補へ進める
+            while positions[i] < len(hobby_list) and hobby_list[positions[i]] in dissolved:
+                positions[i] += 1
+            if positions[i] < len(hobby_list):
+                members_by_hobby.setdefault(hobby_list[positions[i]], []).append(i)
+
+        # 人数の足りない趣味のうち、最も少ない趣味から解散する（解散した趣味の社員が他の趣味を補える）
+        small_sizes = [len(members) for members in members_by_hobby.values() if len(members) < min_size]
+        if not small_sizes:
+            break
+        smallest = min(small_sizes)
+        dissolved |= {hobby for hobby, members in members_by_hobby.items() if len(members) == smallest}
+
+    groups = []
+    assigned = set()
+    for hobby in sorted(members_by_hobby, key=lambda hobby: (-len(members_by_hobby[hobby]), hobby)):
+        member_ids = [employees[i].get("employee_id") for i in members_by_hobby[hobby]]
+        assigned.update(members_by_hobby[hobby])
+        parts = _split_evenly(member_ids, max_size)
+        for part_number, part_members in enumerate(parts, start=1):
+            groups.append(HobbyGroup(hobby, part_members, part_number, len(parts)))
+
+    # 残った社員の中で、共通の趣味を持つ社員が min_size 人以上いればグループにする
+    remaining = [i for i in range(len(employees)) if i not in assigned]
+    while remaining:
+        remaining_index = build_hobby_index([{"employee_id": i, "hobby": candidates[i]} for i in remaining])
+        hobby, member_indexes = max(remaining_index.items(), key=lambda item: (len(item[1]), item[0]), default=(None, []))
+        if len(member_indexes) < min_size:
+            break
+        member_ids = [employees[i].get("employee_id") for i in member_indexes]
+        parts = _split_evenly(member_ids, max_size)
+        for part_number, part_members in enumerate(parts, start=1):
+            groups.append(HobbyGroup(hobby, part_members, part_number, len(parts)))
+        assigned.update(member_indexes)
+        remaining = [i for i in remaining if i not in assigned]
+
+    leftovers = [employee.get("employee_id") for i, employee in enumerate(employees) if i not in assigned]
+    if leftovers:
+        logger.info(f"趣味でグループを作れなかった社員: {len(leftovers)}名")
+        groups = _place_leftovers(groups, leftovers, min_size, max_size)
+
+    # 人数の制約を満たせるのは社員が min_size 人以上の場合のみ
+    if len(employees) >= min_size:
+        invalid_sizes = [len(group.members) for group in groups if not min_size <= len(group.members) <= max_size]
+        if invalid_sizes:
+            raise RuntimeError(f"グループの人数が {min_size}〜{max_size} 人の範囲外です: {invalid_sizes}")
+    else:
+        logger.warning(f"社員が{len(employees)}名のため、{min_size}人以上のグループを作れません")
+
+    return groups
+
+def _place_leftovers(groups, leftovers, min_size, max_size):
+    """趣味でグループを作れなかった社員を、人数の制約を満たすようにグループへ割り当てる
+
+    まず max_size 未満のグループへ人数の少ない順に1人ずつ加える。
+    全グループが max_size に達して残った社員は、min_size 人以上なら趣味が共通しないグループにし、
+    足りない場合は最も少ないグループに加えてから均等に分割する。
+    """
+    groups = list(groups)
+    remaining = list(leftovers)
+    while remaining:
+        open_groups = [group for group in groups if len(group.members) < max_size]
+        if not open_groups:
+            break
+        group = min(open_groups, key=lambda group: len(group.members))
+        group.members.append(remaining.pop(0))
+        group.extra_members += 1
+
+    if not remaining:
+        return groups
+    if len(remaining) >= min_size or not groups:
+        parts = _split_evenly(remaining, max_size)
+        return groups + [HobbyGroup(MIXED_GROUP_KEY, part_members, part_number, len(parts))
+                         for part_number, part_members in enumerate(parts, start=1)]
+
+    smallest = min(groups, key=lambda group: len(group.members))
+    combined = smallest.members + remaining
+    parts = _split_evenly(combined, max_size)
+    # 加えた社員は末尾にあるため、分割後の各グループに含まれる人数を位置から数える
+    extra_start = len(combined) - smallest.extra_members - len(remaining)
+    resplit = []
+    start = 0
+    for part_number, part_members in enumerate(parts, start=1):
+        end = start + len(part_members)
+        resplit.append(HobbyGroup(smallest.hobby, part_members, extra_members=max(0, end - max(start, extra_start))))
+        start = end
+    index = groups.index(smallest)
+    groups = groups[:index] + resplit + groups[index + 1:]
+
+    # 同じ趣味のグループの分割番号を振り直す
+    same_hobby = [group for group in groups if group.hobby == smallest.hobby]
+    for part_number, group in enumerate(same_hobby, start=1):
+        group.part, group.parts = part_number, len(same_hobby)
+    return groups
+
+def default_group_name(group):
+    """LLMによる名前付けに失敗した場合のグループ名と理由"""
+    if group.hobby is MIXED_GROUP_KEY:
+        return "「多趣味ミックスグループ」", "共通の趣味で8人以上集まらなかったメンバーです"
+    if group.extra_members:
+        return f"「{group.hobby}グループ」", f"メンバーの多くが「{group.hobby}」を趣味としているため"
+    return f"「{group.hobby}グループ」", f"メンバー全員が「{group.hobby}」を趣味としているため"
+
+def name_groups(groups, namer, max_workers=1):
+    """各グループに名前と理由を付け、merge_groups と同じ形式（グループ名 -> {"members", "reason"}）で返す関数
+
+    namer(group) は (グループ名, 理由) を返す関数で、グループごとに1回呼び出す（max_workers で並列実行）。
+    namer が失敗した場合は趣味名から作った名前を使う。同名のグループには番号を付けて区別する。
+    """
+    def safe_namer(group):
+        try:
+            name, reason = namer(group)
+            if name:
+                return name, reason
+        except Exception as e:
+            logger.warning(f"グループ名の生成に失敗したため既定の名前を使用: {e}")
+        return default_group_name(group)
+
+    if max_workers > 1 and len(groups) > 1:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(groups))) as executor:
+            names = list(executor.map(safe_namer, groups))
+    else:
+        names = [safe_namer(group) for group in groups]
+
+    named_groups = {}
+    for group, (name, reason) in zip(groups, names):
+        unique_name = name
+        suffix = 2
+        while unique_name in named_groups:
+            unique_name = f"{name}（{suffix}）"
+            suffix += 1
+        named_groups[unique_name] = {"members": group.members, "reason": reason}
+    return named_groups
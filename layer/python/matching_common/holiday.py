@@ -0,0 +1,209 @@
+import json
+import logging
+import os
+import threading
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+
+from matching_common.aws_clients import get_client
+
+# ロガーの設定
+logger = logging.getLogger()
+
+JST = timezone(timedelta(hours=9))
+
+# ローカル計算に対応する年の範囲（春分・秋分の日の近似式が有効な範囲内）
+MIN_SUPPORTED_YEAR = 2007
+MAX_SUPPORTED_YEAR = 2099
+
+# 祝日判定Lambdaを上書き用に呼び出す場合のタイムアウト（秒）
+DEFAULT_OVERRIDE_TIMEOUT_SECONDS = 2
+
+# 日付が固定の祝日: (名前, 月, 日, 適用開始年, 適用終了年)
+FIXED_HOLIDAYS = [
+    ("元日", 1, 1, None, None),
+    ("建国記念の日", 2, 11, None, None),
+    ("天皇誕生日", 2, 23, 2020, None),
+    ("昭和の日", 4, 29, None, None),
+    ("憲法記念日", 5, 3, None, None),
+    ("みどりの日", 5, 4, None, None),
+    ("こどもの日", 5, 5, None, None),
+    ("山の日", 8, 11, 2016, None),
+    ("文化の日", 11, 3, None, None),
+    ("勤労感謝の日", 11, 23, None, None),
+    ("天皇誕生日", 12, 23, None, 2018),
+]
+
+# 第n月曜日の祝日（ハッピーマンデー）: (名前, 月, 第n週, 適用開始年, 適用終了年)
+HAPPY_MONDAY_HOLIDAYS = [
+    ("成人の日", 1, 2, None, None),
+    ("海の日", 7, 3, None, None),
+    ("敬老の日", 9, 3, None, None),
+    ("体育の日", 10, 2, None, 2019),
+    ("スポーツの日", 10, 2, 2020, None),
+]
+
+# その年限りの祝日: (名前, 年, 月, 日)
+SPECIAL_HOLIDAYS = [
+    ("天皇の即位の日", 2019, 5, 1),
+    ("即位礼正殿の儀の行われる日", 2019, 10, 22),
+]
+
+# 東京オリンピック・パラリンピックに伴う祝日の移動: 年 -> {名前: (月, 日)}
+MOVED_HOLIDAYS = {
+    2020: {"海の日": (7, 23), "スポーツの日": (7, 24), "山の日": (8, 10)},
+    2021: {"海の日": (7, 22), "スポーツの日": (7, 23), "山の日": (8, 8)},
+}
+
+def _in_range(year, first_year, last_year):
+    return (first_year is None or year >= first_year) and (last_year is None or year <= last_year)
+
+def _nth_monday(year, month, n):
+    first = date(year, month, 1)
+    return first + timedelta(days=(7 - first.weekday()) % 7 + 7 * (n - 1))
+
+def _equinox_day(year, base):
+    # 1980〜2099年に有効な近似式（春分 base=20.8431、秋分 base=23.2488）
+    return int(base + 0.242194 * (year - 1980) - (year - 1980) // 4)
+
+@lru_cache(maxsize=None)
+def japanese_holidays(year):
+    """指定した年の日本の祝日・振替休日・国民の休日を {日付: 名前} で返す関数（年ごとにメモ化）"""
+    if not MIN_SUPPORTED_YEAR <= year <= MAX_SUPPORTED_YEAR:
+        raise ValueError(f"{year}年の祝日はローカル計算に対応していません（{MIN_SUPPORTED_YEAR}〜{MAX_SUPPORTED_YEAR}年）")
+
+    moved = MOVED_HOLIDAYS.get(year, {})
+    holidays = {}
+    for name, month, day, first_year, last_year in FIXED_HOLIDAYS:
+        if _in_range(year, first_year, last_year):
+            month, day = moved.get(name, (month, day))
+            holidays[date(year, month, day)] = name
+    for name, month, n, first_year, last_year in HAPPY_MONDAY_HOLIDAYS:
+        if _in_range(year, first_year, last_year):
+            holidays[date(year, *moved[name]) if name in moved else _nth_monday(year, month, n)] = name
+    for name, special_year, month, day in SPECIAL_HOLIDAYS:
+        if special_year == year:
+            holidays[date(year, month, day)] = name
+    holidays[date(year, 3, _equinox_day(year, 20.8431))] = "春分の日"
+    holidays[date(year, 9, _equinox_day(year, 23.2488))] = "秋分の日"
+
+    # 国民の休日: 前日と翌日が祝日である平日
+    for day in sorted(holidays):
+        between = day + timedelta(days=1)
+        if between not in holidays and between + timedelta(days=1) in holidays and between.weekday() != 6:
+            holidays[between] = "国民の休日"
+
+    # 振替休日: 祝日が日曜日の場合、その後の最初の祝日でない日
+    for day in sorted(holidays):
+        if day.weekday() == 6:
+            substitute = day + timedelta(days=1)
+            while substitute in holidays:
+                substitute += timedelta(days=1)
+            if substitute.year == year:
+                holidays[substitute] = "振替休日"
+
+    return dict(sorted(holidays.items()))
+
+def holiday_name(target_date):
+    """祝日の名前を返す関数（祝日でない場合は None）"""
+    return japanese_holidays(target_date.year).get(target_date)
+
+def today_jst():
+    return datetime.now(JST).date()
+
+class HolidayResolver:
+    """祝日をローカルの規則表で判定し、日付ごとに結果をメモ化するクラス（ウォームコンテナ間で再利用）
+
+    override_function_name を指定した場合のみ、当日の判定で祝日判定Lambdaを短いタイムアウトで呼び出し、
+    その結果でローカルの判定を上書きする（会社独自の休日等）。Lambdaの呼び出しに失敗した場合はローカルの判定を使う。
+    土日は祝日として扱わない。
+    """
+
+    def __init__(self, override_function_name=None, override_timeout_seconds=DEFAULT_OVERRIDE_TIMEOUT_SECONDS):
+        self.override_function_name = override_function_name
+        self.override_timeout_seconds = override_timeout_seconds
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def is_holiday(self, target_date=None):
+        target_date = target_date or today_jst()
+        with self._lock:
+            if target_date in self._results:
+                return self._results[target_date]
+
+        result = self._resolve(target_date)
+        with self._lock:
+            self._results[target_date] = result
+        return result
+
+    def _resolve(self, target_date):
+        try:
+            name = holiday_name(target_date)
+            local_result = name is not None
+            logger.info(f"祝日判定（ローカル）: {target_date} {name or '祝日ではありません'}")
+        except ValueError as e:
+            logger.warning(str(e))
+            local_result = None
+
+        # 祝日判定Lambdaは当日の判定のみ返すため、当日以外は上書きしない
+        if self.override_function_name and target_date == today_jst():
+            remote_result = self._invoke_override()
+            if remote_result is not None:
+                return remote_result
+
+        if local_result is None:
+            return True  # 判定できない場合は安全優先で祝日扱いにしてスキップ
+        return local_result
+
+    def _invoke_override(self):
+        """祝日判定Lambdaを呼び出し、判定結果を返す（失敗した場合は None）"""
+        try:
+            lambda_client = get_client(
+                'lambda',
+                connect_timeout=self.override_timeout_seconds,
+                read_timeout=self.override_timeout_seconds,
+                retries={"mode": "standard", "total_max_attempts": 1}
+            )
+            response = lambda_client.invoke(
+                FunctionName=self.override_function_name,
+                InvocationType='RequestResponse',
+            )
+            payload_str = response['Payload'].read().decode('utf-8')
+            logger.info(f"祝日Lambda応答: {payload_str}")
+
+            if response['StatusCode'] != 200 or response.get('FunctionError'):
+                logger.warning(f"祝日判定Lambdaのステータスコード: {response['StatusCode']}（ローカルの判定を使用）")
+                return None
+
+            body = json.loads(json.loads(payload_str).get("body", "{}"))
+            if "is_holiday" not in body:
+                return None
+            return bool(body["is_holiday"])
+
+        except Exception as e:
+            logger.warning(f"祝日判定Lambdaの呼び出しに失敗（ローカルの判定を使用）: {str(e)}")
+            return None
+
+_default_resolver = None
+
+def get_default_resolver():
+    """環境変数から構成した HolidayResolver を返す関数
+
+    HOLIDAY_OVERRIDE_ENABLED          : "true" の場合のみ CHECK_HOLIDAY_LAMBDA_NAME の関数で上書きする
+    CHECK_HOLIDAY_LAMBDA_NAME         : 祝日判定Lambdaの関数名
+    HOLIDAY_OVERRIDE_TIMEOUT_SECONDS  : 祝日判定Lambdaのタイムアウト（秒）
+    """
+    global _default_resolver
+    if _default_resolver is None:
+        override_function_name = None
+        if os.environ.get("HOLIDAY_OVERRIDE_ENABLED", "false").lower() == "true":
+            override_function_name = os.environ.get("CHECK_HOLIDAY_LAMBDA_NAME")
+        _default_resolver = HolidayResolver(
+            override_function_name=override_function_name,
+            override_timeout_seconds=float(os.environ.get("HOLIDAY_OVERRIDE_TIMEOUT_SECONDS", DEFAULT_OVERRIDE_TIMEOUT_SECONDS))
+        )
+    return _default_resolver
+
+def is_today_holiday():
+    """今日（日本時間）が祝日かを判定する"""
+    return get_default_resolver().is_holiday()
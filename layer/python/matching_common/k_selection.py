@@ -0,0 +1,212 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from matching_common.aws_clients import get_client
+from matching_common.clustering import DEFAULT_RANDOM_STATE, KMeansEngine, build_clustering_engine_from_env
+from matching_common.response_cache import LocalLRUBackend, S3Backend
+
+# ロガーの設定
+logger = logging.getLogger()
+
+# デフォルト設定（環境変数で上書き可能）
+DEFAULT_K_MIN = 2
+DEFAULT_K_MAX = 10
+DEFAULT_SAMPLE_SIZE = 10000  # スコアの計算に使う行数（シルエット係数は行数の2乗の計算量のため抽出する）
+DEFAULT_CACHE_DIR = "/tmp/k-selection-cache"
+
+# スコアの種類（silhouette は大きいほど良い、davies_bouldin は小さいほど良い）
+METRICS = ("silhouette", "davies_bouldin")
+
+def snapshot_hash(embeddings):
+    """埋め込みの内容（形状・型・値）からスナップショットのハッシュを計算する関数"""
+    embeddings = np.ascontiguousarray(embeddings)
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(f"{embeddings.shape}:{embeddings.dtype.str}".encode("utf-8"))
+    hasher.update(embeddings.data)
+    return hasher.hexdigest()
+
+class KCandidate:
+    """1つのクラスター数の評価結果を保持するクラス"""
+
+    def __init__(self, k, score, max_cluster_size, feasible, seconds=0.0):
+        self.k = k
+        self.score = score
+        self.max_cluster_size = max_cluster_size
+        self.feasible = feasible  # 最大のクラスターの人数が上限以下か
+        self.seconds = seconds
+
+    def to_dict(self):
+        return {
+            "k": self.k,
+            "score": self.score,
+            "max_cluster_size": self.max_cluster_size,
+            "feasible": self.feasible,
+            "seconds": round(self.seconds, 3)
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["k"], data["score"], data["max_cluster_size"], data["feasible"], data.get("seconds", 0.0))
+
+class KSelection:
+    """クラスター数の選択結果（選んだ k と全候補の評価）を保持するクラス"""
+
+    def __init__(self, best_k, candidates, metric, cached=False):
+        self.best_k = best_k
+        self.candidates = candidates
+        self.metric = metric
+        self.cached = cached
+
+    def summary(self):
+        """ログ出力用の辞書"""
+        return {
+            "best_k": self.best_k,
+            "metric": self.metric,
+            "cached": self.cached,
+            "candidates": [candidate.to_dict() for candidate in self.candidates]
+        }
+
+class KSelector:
+    """候補のクラスター数をスレッドで並列に評価し、人数の上限を満たす中でスコアが最も良い k を選ぶクラス
+
+    各候補は engine（KMeansEngine / MiniBatchKMeansEngine）でクラスタリングし、抽出した sample_size 行でスコアを計算する。
+    選んだ k と人数の上限の判定が実際のクラスタリングと一致するよう、engine には後段で使うエンジンと同じ種類を指定する
+    （重心の保存先は持たせず、各候補は初期値から計算する）。
+    cache_backends がある場合は、埋め込みのハッシュと設定をキーに結果を保存し、同じデータの再実行では計算しない。
+    """
+
+    def __init__(self, k_min=DEFAULT_K_MIN, k_max=DEFAULT_K_MAX, metric="silhouette", sample_size=DEFAULT_SAMPLE_SIZE,
+                 max_cluster_size=None, workers=None, cache_backends=(), random_state=DEFAULT_RANDOM_STATE, engine=None):
+        if metric not in METRICS:
+            raise ValueError(f"metric は {' / '.join(METRICS)} のいずれかを指定してください: {metric}")
+        if not 2 <= k_min <= k_max:
+            raise ValueError(f"クラスター数の範囲が不正です: {k_min}〜{k_max}")
+        self.k_min = k_min
+        self.k_max = k_max
+        self.metric = metric
+        self.sample_size = sample_size
+        self.max_cluster_size = max_cluster_size
+        self.workers = workers or os.cpu_count() or 1
+        self.cache_backends = list(cache_backends)
+        self.random_state = random_state
+        self.engine = engine or KMeansEngine(random_state=random_state)
+
+    def _cache_key(self, embeddings):
+        settings = {
+            "snapshot": snapshot_hash(embeddings),
+            "k_min": self.k_min,
+            "k_max": self.k_max,
+            "metric": self.metric,
+            "sample_size": self.sample_size,
+            "max_cluster_size": self.max_cluster_size,
+            "random_state": self.random_state,
+            "engine": self.engine.name,
+            "engine_batch_size": getattr(self.engine, "batch_size", None),
+            "engine_max_iter": getattr(self.engine, "max_iter", None)
+        }
+        return hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _evaluate(self, embeddings, sample_indices, k):
+        """k でクラスタリングし、抽出した行のスコアと最大のクラスターの人数を返す"""
+        from sklearn.metrics import davies_bouldin_score, silhouette_score
+
+        started = time.perf_counter()
+        labels = self.engine.fit(embeddings, k).labels
+        max_cluster_size = int(np.bincount(labels, minlength=k).max())
+
+        sample, sample_labels = embeddings[sample_indices], labels[sample_indices]
+        if len(np.unique(sample_labels)) < 2:
+            score = None
+        elif self.metric == "silhouette":
+            score = float(silhouette_score(sample, sample_labels))
+        else:
+            score = float(davies_bouldin_score(sample, sample_labels))
+        feasible = self.max_cluster_size is None or max_cluster_size <= self.max_cluster_size
+        return KCandidate(k, score, max_cluster_size, feasible, time.perf_counter() - started)
+
+    def _choose(self, candidates):
+        """人数の上限を満たす候補の中でスコアが最も良い k を返す（満たす候補がない場合は最大のクラスターが最も小さい k）"""
+        scored = [candidate for candidate in candidates if candidate.score is not None]
+        feasible = [candidate for candidate in scored if candidate.feasible]
+        if feasible:
+            sign = 1 if self.metric == "silhouette" else -1
+            return max(feasible, key=lambda candidate: (sign * candidate.score, -candidate.k)).k
+
+        logger.warning(f"最大のクラスターの人数が {self.max_cluster_size} 人以下になるクラスター数がありません（{self.k_min}〜{self.k_max}）")
+        return min(scored or candidates, key=lambda candidate: (candidate.max_cluster_size, candidate.k)).k
+
+    def select(self, embeddings):
+        """埋め込みに対して最適なクラスター数を選ぶ"""
+        key = self._cache_key(embeddings) if self.cache_backends else None
+        for i, backend in enumerate(self.cache_backends):
+            entry = backend.get(key)
+            if entry is not None:
+                # 後段のバックエンド（S3）でヒットした場合は前段（/tmp）にも書き戻す
+                for upper in self.cache_backends[:i]:
+                    upper.put(key, entry)
+                candidates = [KCandidate.from_dict(candidate) for candidate in entry["candidates"]]
+                return KSelection(entry["best_k"], candidates, self.metric, cached=True)
+
+        embeddings = np.ascontiguousarray(embeddings)
+        k_max = min(self.k_max, len(embeddings) - 1)
+        if k_max < self.k_min:
+            raise ValueError(f"行数 {len(embeddings)} に対してクラスター数の範囲 {self.k_min}〜{self.k_max} が大きすぎます")
+        from threadpoolctl import threadpool_limits
+
+        rng = np.random.default_rng(self.random_state)
+        sample_indices = np.sort(rng.choice(len(embeddings), size=min(self.sample_size, len(embeddings)), replace=False))
+
+        ks = range(self.k_min, k_max + 1)
+        # 並列で評価する間は BLAS・OpenMP のスレッド数を1にし、CPU コア数を超えるスレッドが動かないようにする
+        limits = threadpool_limits(limits=1) if self.workers > 1 else contextlib.nullcontext()
+        with limits, ThreadPoolExecutor(max_workers=min(self.workers, len(ks))) as executor:
+            candidates = list(executor.map(lambda k: self._evaluate(embeddings, sample_indices, k), ks))
+
+        selection = KSelection(self._choose(candidates), candidates, self.metric)
+        if key is not None:
+            entry = {"created_at": time.time(), "best_k": selection.best_k, "candidates": [candidate.to_dict() for candidate in candidates]}
+            for backend in self.cache_backends:
+                backend.put(key, entry)
+        return selection
+
+def build_k_selector_from_env(s3=None):
+    """環境変数からクラスター数の自動選択を構成する関数（無効の場合は None を返す）
+
+    AUTO_K_ENABLED          : "true" の場合に有効化
+    AUTO_K_MIN / AUTO_K_MAX : 候補のクラスター数の範囲
+    AUTO_K_METRIC           : "silhouette"（デフォルト）/ "davies_bouldin"
+    AUTO_K_SAMPLE_SIZE      : スコアの計算に使う行数
+    AUTO_K_MAX_CLUSTER_SIZE : 1クラスターの人数の上限（1回のプロンプトに収まる人数）
+    AUTO_K_WORKERS          : 並列に評価する数（デフォルトは CPU コア数）
+    AUTO_K_CACHE_DIR        : 結果のキャッシュを保存する /tmp 配下のディレクトリ
+    AUTO_K_CACHE_S3_BUCKET  : 指定した場合は S3（AUTO_K_CACHE_S3_PREFIX 配下）にもキャッシュする
+
+    候補の評価には CLUSTERING_ENGINE などで構成したクラスタリングと同じエンジンを使う。
+    """
+    if os.environ.get("AUTO_K_ENABLED", "false").lower() != "true":
+        return None
+
+    cache_backends = [LocalLRUBackend(directory=os.environ.get("AUTO_K_CACHE_DIR", DEFAULT_CACHE_DIR))]
+    s3_bucket = os.environ.get("AUTO_K_CACHE_S3_BUCKET")
+    if s3_bucket:
+        cache_backends.append(S3Backend(s3_bucket, os.environ.get("AUTO_K_CACHE_S3_PREFIX", "k-selection-cache/"), s3 or get_client("s3")))
+
+    max_cluster_size = os.environ.get("AUTO_K_MAX_CLUSTER_SIZE")
+    workers = os.environ.get("AUTO_K_WORKERS")
+    return KSelector(
+        k_min=int(os.environ.get("AUTO_K_MIN", DEFAULT_K_MIN)),
+        k_max=int(os.environ.get("AUTO_K_MAX", DEFAULT_K_MAX)),
+        metric=os.environ.get("AUTO_K_METRIC", "silhouette").lower(),
+        sample_size=int(os.environ.get("AUTO_K_SAMPLE_SIZE", DEFAULT_SAMPLE_SIZE)),
+        max_cluster_size=int(max_cluster_size) if max_cluster_size else None,
+        workers=int(workers) if workers else None,
+        cache_backends=cache_backends,
+        engine=build_clustering_engine_from_env("k-selection", s3, warm_start=False)
+    )
@@ -0,0 +1,197 @@
+import functools
+import json
+import os
+import threading
+import time
+
+# CloudWatch Embedded Metric Format (EMF) の1行あたりの上限（メトリクス定義数・1メトリクスの値の数）
+MAX_METRICS_PER_LINE = 100
+MAX_VALUES_PER_METRIC = 100
+
+DEFAULT_NAMESPACE = "MatchingApp"
+
+class _Timer:
+    """with ブロックの処理時間（ミリ秒）を histogram に記録するコンテキストマネージャー"""
+
+    __slots__ = ("recorder", "name", "started")
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.recorder.observe(self.name, (time.perf_counter() - self.started) * 1000)
+        return False
+
+class _NullTimer:
+    """無効時の timer（何も記録しない）"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+class MetricsRecorder:
+    """カウンター・ヒストグラムを集計し、EMF のログ行として標準出力に書き出すクラス
+
+    counter は flush までの合計値、histogram は値のリスト（CloudWatch 側で p50/p99 等を集計）として出力する。
+    無効の場合は各メソッドが enabled の判定のみで戻るため、呼び出し側で分岐する必要はない。
+    複数スレッドから記録できる。
+    """
+
+    def __init__(self, namespace=DEFAULT_NAMESPACE, service=None, enabled=True):
+        self.namespace = namespace
+        self.service = service
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._properties = {}
+
+    def set_service(self, service):
+        """メトリクスの Service ディメンション（ハンドラー・スクリプト名）を設定する"""
+        self.service = service
+
+    def count(self, name, value=1, unit="Count"):
+        if not self.enabled:
+            return
+        with self._lock:
+            total, _ = self._counters.get(name, (0, unit))
+            self._counters[name] = (total + value, unit)
+
+    def observe(self, name, value, unit="Milliseconds"):
+        if not self.enabled:
+            return
+        with self._lock:
+            values = self._histograms.get(name)
+            if values is None:
+                values = self._histograms[name] = ([], unit)
+            values[0].append(value)
+
+    def timer(self, name):
+        """with ブロックの処理時間をミリ秒で name に記録する"""
+        return _Timer(self, name) if self.enabled else _NULL_TIMER
+
+    def stage(self, name):
+        """処理段階ごとの処理時間（StageDuration.<name>）を記録する"""
+        return _Timer(self, f"StageDuration.{name}") if self.enabled else _NULL_TIMER
+
+    def set_property(self, name, value):
+        """メトリクスではない補足情報（実行ID等）をログ行に追加する"""
+        if self.enabled:
+            with self._lock:
+                self._properties[name] = value
+
+    def record_bedrock_usage(self, usage):
+        """converse / converse_stream の usage（入力・出力トークン数）を記録する"""
+        if not self.enabled or not usage:
+            return
+        self.count("BedrockInputTokens", usage.get("inputTokens", 0))
+        self.count("BedrockOutputTokens", usage.get("outputTokens", 0))
+
+    def record_invoke_model_usage(self, response):
+        """invoke_model のレスポンスヘッダーの入力・出力トークン数を記録する"""
+        if not self.enabled:
+            return
+        headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+        self.record_bedrock_usage({
+            "inputTokens": int(headers.get("x-amzn-bedrock-input-token-count", 0)),
+            "outputTokens": int(headers.get("x-amzn-bedrock-output-token-count", 0))
+        })
+
+    def flush(self):
+        """集計したメトリクスを EMF のログ行として出力し、集計をリセットする（出力した行数を返す）"""
+        if not self.enabled:
+            return 0
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            histograms, self._histograms = self._histograms, {}
+            properties, self._properties = self._properties, {}
+
+        # (名前, 単位, 値) に展開する（histogram は1メトリクスあたりの値の上限ごとに分割する）
+        entries = [(name, unit, value) for name, (value, unit) in counters.items()]
+        for name, (values, unit) in histograms.items():
+            for i in range(0, len(values), MAX_VALUES_PER_METRIC):
+                entries.append((name, unit, values[i:i + MAX_VALUES_PER_METRIC]))
+
+        # 同じ名前のメトリクスが1行に重複しないよう、行に詰める
+        lines = []
+        for name, unit, value in entries:
+            for line in lines:
+                if name not in line and len(line) < MAX_METRICS_PER_LINE:
+                    break
+            else:
+                line = {}
+                lines.append(line)
+            line[name] = (unit, value)
+
+        timestamp = int(time.time() * 1000)
+        service = self.service or os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "unknown")
+        for line in lines:
+            document = {
+                "_aws": {
+                    "Timestamp": timestamp,
+                    "CloudWatchMetrics": [{
+                        "Namespace": self.namespace,
+                        "Dimensions": [["Service"]],
+                        "Metrics": [{"Name": name, "Unit": unit} for name, (unit, _) in line.items()]
+                    }]
+                },
+                "Service": service
+            }
+            document.update(properties)
+            document.update((name, value) for name, (_, value) in line.items())
+            # Lambda のロガーの接頭辞が付くと EMF として解釈されないため、標準出力に直接書き出す
+            print(json.dumps(document, ensure_ascii=False, separators=(",", ":")), flush=True)
+        return len(lines)
+
+def build_metrics_from_env():
+    """環境変数から MetricsRecorder を構成する関数
+
+    METRICS_ENABLED    : "true" / "false"（未指定の場合は Lambda 上でのみ有効）
+    METRICS_NAMESPACE  : CloudWatch の名前空間
+    """
+    default_enabled = "true" if os.environ.get("AWS_LAMBDA_FUNCTION_NAME") else "false"
+    return MetricsRecorder(
+        namespace=os.environ.get("METRICS_NAMESPACE", DEFAULT_NAMESPACE),
+        enabled=os.environ.get("METRICS_ENABLED", default_enabled).lower() == "true"
+    )
+
+# プロセス全体で共有するレコーダー（共通モジュールの Bedrock・S3・DynamoDB の呼び出しもここに記録する）
+metrics = build_metrics_from_env()
+
+def instrument_handler(service):
+    """lambda_handler の処理時間・エラー数を記録し、終了時にメトリクスを出力するデコレーター
+
+    メトリクスが無効の場合は元の関数をそのまま返す。statusCode が500以上の応答と例外をエラーとして数える。
+    """
+    def decorator(handler):
+        if not metrics.enabled:
+            return handler
+
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            metrics.set_service(service)
+            started = time.perf_counter()
+            try:
+                response = handler(event, context)
+                if isinstance(response, dict) and isinstance(response.get("statusCode"), int) and response["statusCode"] >= 500:
+                    metrics.count("HandlerErrors")
+                return response
+            except Exception:
+                metrics.count("HandlerErrors")
+                raise
+            finally:
+                metrics.observe("HandlerDuration", (time.perf_counter() - started) * 1000)
+                metrics.flush()
+        return wrapper
+    return decorator
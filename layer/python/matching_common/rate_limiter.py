@@ -0,0 +1,271 @@
+import logging
+import os
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError, HTTPClientError
+from botocore.exceptions import ConnectionError as BotocoreConnectionError
+
+from matching_common.chunk_planner import estimate_tokens
+from matching_common.metrics import metrics
+
+# ロガーの設定
+logger = logging.getLogger()
+
+# スロットリングとして再試行するエラーコード
+THROTTLING_ERROR_CODES = (
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceUnavailableException",
+    "ModelNotReadyException",
+)
+
+# スロットリング以外で再試行する一時的なエラーコード（HTTP ステータスが5xxのエラーも再試行する）
+TRANSIENT_ERROR_CODES = (
+    "InternalServerException",
+    "ModelErrorException",
+    "ModelTimeoutException",
+)
+
+# リミッター使用時の botocore の再試行設定（Config(retries=...) に指定する）
+# botocore 側でも再試行すると、スロットリングがリミッターに見えず同時実行数を調整できないため1回のみにする
+# （botocore が再試行していた5xx・接続エラー・タイムアウトはリミッターが再試行する）
+LIMITER_SDK_RETRIES = {"mode": "standard", "total_max_attempts": 1}
+
+# デフォルト設定（環境変数で上書き可能）
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_MAX_RETRIES = 6
+DEFAULT_RETRY_BASE_DELAY = 1.0
+DEFAULT_RETRY_MAX_DELAY = 30.0
+
+def is_throttling_error(error):
+    """スロットリング（クォータ超過・一時的な過負荷）による ClientError かを判定する関数"""
+    return error.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES
+
+def is_transient_error(error):
+    """スロットリング以外の一時的なエラー（5xx・接続エラー・タイムアウト）かを判定する関数"""
+    if isinstance(error, ClientError):
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode") or 0
+        return error.response.get("Error", {}).get("Code") in TRANSIENT_ERROR_CODES or status >= 500
+    return isinstance(error, (BotocoreConnectionError, HTTPClientError))
+
+def estimate_request_tokens(prompt, inference_config=None):
+    """1リクエストが消費するトークン数を概算する関数（入力の概算 + maxTokens）
+
+    Bedrock のトークンクォータはリクエスト開始時に maxTokens 分を確保するため、出力は上限値で見積もる。
+    """
+    return estimate_tokens(prompt) + (inference_config or {}).get("maxTokens", 0)
+
+class TokenBucket:
+    """1分あたりの上限で補充されるトークンバケット
+
+    reserve は残高を先に差し引き（負になりうる）、利用可能になるまでの待ち時間を返す。
+    先に予約した呼び出しから順に待ち時間が割り当てられるため、スレッド間で順番が守られる。
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate_per_second = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute  # 1分ぶんまでのバーストを許可
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount):
+        # 1回の要求が容量を超える場合は容量ぶんとして扱う（永久に待たないように）
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate_per_second)
+            self._updated = now
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate_per_second
+
+class AdaptiveRateLimiter:
+    """Bedrock 呼び出しの流量を制御するプロセス内リミッター
+
+    ・リクエスト数／トークン数（1分あたり）のトークンバケットで送信ペースを制限する
+    ・同時実行数を AIMD で調整する（成功で少しずつ増やし、スロットリングで半減）
+    ・スロットリング時はフルジッター付きの指数バックオフで再試行する
+    ・5xx・接続エラー・タイムアウトも同じバックオフで再試行する（同時実行数は減らさない）
+    スロットリング・一時的なエラー・再試行・待ち時間のカウンターは stats() で取得できる。
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 min_concurrency=1, max_retries=DEFAULT_MAX_RETRIES, base_delay=DEFAULT_RETRY_BASE_DELAY,
+                 max_delay=DEFAULT_RETRY_MAX_DELAY, decrease_factor=0.5):
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.decrease_factor = decrease_factor
+
+        self._limit = float(self.max_concurrency)
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+        self.calls = 0
+        self.throttles = 0
+        self.transient_errors = 0
+        self.retries = 0
+        self.gave_up = 0
+        self.queue_wait_seconds = 0.0
+        self.backoff_seconds = 0.0
+        self.concurrency_decreases = 0
+        self.lowest_concurrency = self.max_concurrency
+
+    @property
+    def concurrency_limit(self):
+        return max(self.min_concurrency, int(self._limit))
+
+    def _acquire_slot(self):
+        with self._condition:
+            while self._in_flight >= self.concurrency_limit:
+                self._condition.wait()
+            self._in_flight += 1
+
+    def _release_slot(self, throttled=False, succeeded=False):
+        with self._condition:
+            self._in_flight -= 1
+            if throttled:
+                # 同時に返ってきた複数のスロットリングで何度も半減しないよう、基準待ち時間内は1回だけ減らす
+                now = time.monotonic()
+                if now - self._last_decrease >= self.base_delay:
+                    self._limit = max(float(self.min_concurrency), self._limit * self.decrease_factor)
+                    self._last_decrease = now
+                    self.concurrency_decreases += 1
+                    self.lowest_concurrency = min(self.lowest_concurrency, self.concurrency_limit)
+                    logger.info(f"スロットリングのため同時実行数を {self.concurrency_limit} に削減")
+            elif succeeded:
+                # 現在の上限件数ぶん成功するごとに上限を1増やす
+                self._limit = min(float(self.max_concurrency), self._limit + 1.0 / self._limit)
+            self._condition.notify_all()
+
+    def _wait_for_buckets(self, estimated_tokens):
+        delay = 0.0
+        if self.request_bucket is not None:
+            delay = max(delay, self.request_bucket.reserve(1))
+        if self.token_bucket is not None and estimated_tokens:
+            delay = max(delay, self.token_bucket.reserve(estimated_tokens))
+        if delay > 0:
+            time.sleep(delay)
+
+    def call(self, send, estimated_tokens=0):
+        """send() を流量制限の下で実行し、スロットリング・一時的なエラーの場合は再試行して結果を返す
+
+        それ以外の例外、および再試行回数を超えたエラーはそのまま送出する。
+        """
+        with self._condition:
+            self.calls += 1
+
+        attempt = 0
+        while True:
+            wait_started = time.monotonic()
+            self._acquire_slot()
+            try:
+                self._wait_for_buckets(estimated_tokens)
+            except BaseException:
+                self._release_slot()
+                raise
+            waited = time.monotonic() - wait_started
+
+            try:
+                result = send()
+            except (ClientError, BotocoreConnectionError, HTTPClientError) as e:
+                throttled = isinstance(e, ClientError) and is_throttling_error(e)
+                transient = not throttled and is_transient_error(e)
+                self._release_slot(throttled=throttled)
+                self._record(queue_wait=waited, throttled=throttled, transient=transient)
+                if not (throttled or transient):
+                    raise
+                reason = "スロットリング" if throttled else "一時的なエラー"
+                if attempt >= self.max_retries:
+                    self._record(gave_up=True)
+                    logger.warning(f"{reason}が続いたため再試行を中止: {e}")
+                    raise
+            except BaseException:
+                self._release_slot()
+                self._record(queue_wait=waited)
+                raise
+            else:
+                self._release_slot(succeeded=True)
+                self._record(queue_wait=waited)
+                return result
+
+            # フルジッター付きの指数バックオフ
+            backoff = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+            attempt += 1
+            self._record(retried=True, backoff=backoff)
+            logger.info(f"{reason}のため {backoff:.1f} 秒後に再試行（{attempt}/{self.max_retries}回目）")
+            time.sleep(backoff)
+
+    def _record(self, queue_wait=0.0, throttled=False, transient=False, gave_up=False, retried=False, backoff=0.0):
+        if throttled:
+            metrics.count("BedrockThrottles")
+        if transient:
+            metrics.count("BedrockTransientErrors")
+        with self._condition:
+            self.queue_wait_seconds += queue_wait
+            self.backoff_seconds += backoff
+            if throttled:
+                self.throttles += 1
+            if transient:
+                self.transient_errors += 1
+            if gave_up:
+                self.gave_up += 1
+            if retried:
+                self.retries += 1
+
+    def stats(self):
+        with self._condition:
+            return {
+                "calls": self.calls,
+                "throttles": self.throttles,
+                "transient_errors": self.transient_errors,
+                "retries": self.retries,
+                "gave_up": self.gave_up,
+                "queue_wait_seconds": round(self.queue_wait_seconds, 3),
+                "backoff_seconds": round(self.backoff_seconds, 3),
+                "concurrency_limit": self.concurrency_limit,
+                "lowest_concurrency": self.lowest_concurrency,
+                "concurrency_decreases": self.concurrency_decreases,
+                "requests_per_minute": self.request_bucket.capacity if self.request_bucket else None,
+                "tokens_per_minute": self.token_bucket.capacity if self.token_bucket else None
+            }
+
+def call_with_limiter(limiter, send, estimated_tokens=0):
+    """limiter が None の場合はそのまま send() を実行する関数"""
+    if limiter is None:
+        return send()
+    return limiter.call(send, estimated_tokens)
+
+def build_rate_limiter_from_env(max_concurrency=None):
+    """環境変数からリミッターを構成する関数（無効の場合は None を返す）
+
+    BEDROCK_RATE_LIMIT_ENABLED   : "false" の場合は無効（デフォルトは有効）
+    BEDROCK_REQUESTS_PER_MINUTE  : 1分あたりのリクエスト数の上限（未指定の場合は制限しない）
+    BEDROCK_TOKENS_PER_MINUTE    : 1分あたりのトークン数の上限（未指定の場合は制限しない）
+    BEDROCK_MAX_CONCURRENCY      : 同時実行数の上限（未指定の場合は引数 max_concurrency）
+    BEDROCK_MAX_RETRIES          : スロットリング・一時的なエラーの最大再試行回数
+    BEDROCK_RETRY_BASE_DELAY     : バックオフの基準待ち時間（秒）
+    BEDROCK_RETRY_MAX_DELAY      : バックオフの最大待ち時間（秒）
+    """
+    if os.environ.get("BEDROCK_RATE_LIMIT_ENABLED", "true").lower() != "true":
+        return None
+
+    requests_per_minute = os.environ.get("BEDROCK_REQUESTS_PER_MINUTE")
+    tokens_per_minute = os.environ.get("BEDROCK_TOKENS_PER_MINUTE")
+    return AdaptiveRateLimiter(
+        requests_per_minute=int(requests_per_minute) if requests_per_minute else None,
+        tokens_per_minute=int(tokens_per_minute) if tokens_per_minute else None,
+        max_concurrency=int(os.environ.get("BEDROCK_MAX_CONCURRENCY", max_concurrency or DEFAULT_MAX_CONCURRENCY)),
+        max_retries=int(os.environ.get("BEDROCK_MAX_RETRIES", DEFAULT_MAX_RETRIES)),
+        base_delay=float(os.environ.get("BEDROCK_RETRY_BASE_DELAY", DEFAULT_RETRY_BASE_DELAY)),
+        max_delay=float(os.environ.get("BEDROCK_RETRY_MAX_DELAY", DEFAULT_RETRY_MAX_DELAY))
+    )
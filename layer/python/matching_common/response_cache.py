@@ -0,0 +1,295 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import boto3
+from botocore.exceptions import ClientError
+
+from matching_common.metrics import metrics
+from matching_common.rate_limiter import call_with_limiter, estimate_request_tokens
+
+# ロガーの設定
+logger = logging.getLogger()
+
+# デフォルト設定（環境変数で上書き可能）
+DEFAULT_CACHE_DIR = "/tmp/bedrock-response-cache"
+DEFAULT_TTL_SECONDS = 7 * 24 * 60 * 60  # 1週間
+DEFAULT_MAX_ENTRIES = 512
+DEFAULT_MAX_BYTES = 128 * 1024 * 1024  # 128MB（/tmp の容量を使い切らないよう制限）
+
+def make_cache_key(model_id, inference_config, prompt):
+    """(modelId, inferenceConfig, プロンプト) からキャッシュキー（SHA-256）を生成する関数"""
+    material = json.dumps(
+        {"modelId": model_id, "inferenceConfig": inference_config or {}, "prompt": prompt},
+        ensure_ascii=False,
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+def is_cacheable(inference_config):
+    """temperature 0 の決定的な呼び出しのみキャッシュ対象とする"""
+    # Claudeの temperature のデフォルトは 1 のため、未指定の場合はキャッシュしない
+    return (inference_config or {}).get("temperature", 1) == 0
+
+class LocalLRUBackend:
+    """/tmp 配下のファイルにエントリを保存するLRUバックエンド（ウォームコンテナ内での再利用向け）"""
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # キー -> ファイルサイズ（先頭が最も古く参照されたエントリ）
+        self._index = OrderedDict()
+        self._total_bytes = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _load_index(self):
+        """既存のキャッシュファイルを更新日時順にインデックスへ登録する"""
+        entries = []
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith(".json"):
+                continue
+            stat = os.stat(os.path.join(self.directory, file_name))
+            entries.append((stat.st_mtime, file_name[:-len(".json")], stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._total_bytes += size
+        self._evict()
+
+    def _evict(self):
+        """件数・合計サイズの上限を超えた分を古い順に削除する（ロック取得済みで呼び出すこと）"""
+        while self._index and (len(self._index) > self.max_entries or self._total_bytes > self.max_bytes):
+            key, size = self._index.popitem(last=False)
+            self._total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._index:
+                return None
+            try:
+                with open(self._path(key), encoding="utf-8") as f:
+                    entry = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                self._total_bytes -= self._index.pop(key)
+                return None
+            self._index.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        body = json.dumps(entry, ensure_ascii=False)
+        size = len(body.encode("utf-8"))
+        with self._lock:
+            # 一時ファイルに書き込んでから置き換え、読み込み途中のファイルを見せない
+            tmp_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(body)
+            os.replace(tmp_path, self._path(key))
+
+            if key in self._index:
+                self._total_bytes -= self._index.pop(key)
+            self._index[key] = size
+            self._total_bytes += size
+            self._evict()
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._index:
+                self._total_bytes -= self._index.pop(key)
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+class S3Backend:
+    """S3 のプレフィックス配下にエントリを保存するバックエンド（実行をまたいだ再利用向け）
+
+    S3 側の容量による削除は行わないため、プレフィックスにライフサイクルルールを設定して古いエントリを失効させること。
+    """
+
+    def __init__(self, bucket, prefix="bedrock-response-cache/", s3_client=None):
+        self.bucket = bucket
+        self.prefix = prefix if prefix.endswith("/") else f"{prefix}/"
+        self.s3 = s3_client or boto3.client("s3")
+        self.evictions = 0
+
+    def _object_key(self, key):
+        # 先頭2文字でプレフィックスを分散させる
+        return f"{self.prefix}{key[:2]}/{key}.json"
+
+    def get(self, key):
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=self._object_key(key))
+            return json.loads(response["Body"].read().decode("utf-8"))
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in ("NoSuchKey", "404"):
+                logger.warning(f"S3キャッシュの読み込みに失敗: {e}")
+            return None
+        except json.JSONDecodeError:
+            return None
+
+    def put(self, key, entry):
+        try:
+            self.s3.put_object(
+                Bucket=self.bucket,
+                Key=self._object_key(key),
+                Body=json.dumps(entry, ensure_ascii=False),
+                ContentType="application/json",
+            )
+        except ClientError as e:
+            logger.warning(f"S3キャッシュの書き込みに失敗: {e}")
+
+    def delete(self, key):
+        try:
+            self.s3.delete_object(Bucket=self.bucket, Key=self._object_key(key))
+        except ClientError as e:
+            logger.warning(f"S3キャッシュの削除に失敗: {e}")
+
+class ResponseCache:
+    """Bedrock の回答テキストを内容アドレス（プロンプト等のハッシュ）でキャッシュするクラス
+
+    backends は先頭から順に参照し、後段でヒットした場合は前段にも書き戻す。
+    """
+
+    def __init__(self, backends, ttl_seconds=DEFAULT_TTL_SECONDS):
+        self.backends = list(backends)
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "expired": 0, "puts": 0, "bypassed": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _is_expired(self, entry):
+        return self.ttl_seconds is not None and time.time() - entry.get("created_at", 0) > self.ttl_seconds
+
+    def get(self, key):
+        """キャッシュから回答テキストを取得する（存在しない・期限切れの場合は None）"""
+        for i, backend in enumerate(self.backends):
+            entry = backend.get(key)
+            if entry is None:
+                continue
+            if self._is_expired(entry):
+                self._count("expired")
+                backend.delete(key)
+                continue
+
+            # 後段のバックエンドでヒットした場合は前段に書き戻す
+            for upper in self.backends[:i]:
+                upper.put(key, entry)
+            self._count("hits")
+            return entry["text"]
+
+        self._count("misses")
+        return None
+
+    def put(self, key, text, model_id=None):
+        entry = {"created_at": time.time(), "model_id": model_id, "text": text}
+        for backend in self.backends:
+            backend.put(key, entry)
+        self._count("puts")
+
+    def record_bypass(self):
+        """キャッシュ対象外（temperature が0以外）の呼び出しを記録する"""
+        self._count("bypassed")
+
+    def stats(self):
+        """ヒット・ミス等のカウンターを返す"""
+        with self._lock:
+            stats = dict(self._counters)
+        stats["evictions"] = sum(getattr(backend, "evictions", 0) for backend in self.backends)
+        return stats
+
+def build_response_cache_from_env():
+    """環境変数からレスポンスキャッシュを構成する関数（無効の場合は None を返す）
+
+    RESPONSE_CACHE_ENABLED      : "true" の場合に有効化
+    RESPONSE_CACHE_TTL_SECONDS  : エントリの有効期間（秒）
+    RESPONSE_CACHE_MAX_ENTRIES  : /tmp に保持する最大件数
+    RESPONSE_CACHE_MAX_BYTES    : /tmp に保持する最大バイト数
+    RESPONSE_CACHE_S3_BUCKET    : 指定した場合は S3 バックエンドも使用
+    RESPONSE_CACHE_S3_PREFIX    : S3 バックエンドのプレフィックス
+    """
+    if os.environ.get("RESPONSE_CACHE_ENABLED", "false").lower() != "true":
+        return None
+
+    backends = [
+        LocalLRUBackend(
+            directory=os.environ.get("RESPONSE_CACHE_DIR", DEFAULT_CACHE_DIR),
+            max_entries=int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)),
+            max_bytes=int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)),
+        )
+    ]
+
+    s3_bucket = os.environ.get("RESPONSE_CACHE_S3_BUCKET")
+    if s3_bucket:
+        backends.append(S3Backend(s3_bucket, os.environ.get("RESPONSE_CACHE_S3_PREFIX", "bedrock-response-cache/")))
+
+    return ResponseCache(backends, ttl_seconds=int(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", DEFAULT_TTL_SECONDS)))
+
+def converse_with_cache(bedrock, model_id, prompt, inference_config, cache=None, limiter=None, return_stop_reason=False):
+    """キャッシュを参照しつつ bedrock.converse を呼び出し、回答テキストを返す関数
+
+    limiter（AdaptiveRateLimiter）を指定した場合、キャッシュにない呼び出しのみ流量制限と再試行の対象にする。
+    return_stop_reason を指定した場合は (回答テキスト, stopReason) を返す（キャッシュから取得した場合の stopReason は None）。
+    出力トークン上限で打ち切られた回答はキャッシュしない。
+    """
+    cacheable = cache is not None and is_cacheable(inference_config)
+    if cache is not None and not cacheable:
+        cache.record_bypass()
+
+    if cacheable:
+        key = make_cache_key(model_id, inference_config, prompt)
+        cached_text = cache.get(key)
+        if cached_text is not None:
+            metrics.count("ResponseCacheHits")
+            return (cached_text, None) if return_stop_reason else cached_text
+        metrics.count("ResponseCacheMisses")
+
+    def send():
+        metrics.count("BedrockCalls")
+        with metrics.timer("BedrockLatency"):
+            return bedrock.converse(
+                modelId=model_id,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": [
+                            {
+                                "text": prompt
+                            }
+                        ]
+                    }
+                ],
+                inferenceConfig=inference_config
+            )
+
+    response = call_with_limiter(limiter, send, estimate_request_tokens(prompt, inference_config))
+    metrics.record_bedrock_usage(response.get("usage"))
+    text = response['output']['message']['content'][0]['text']
+    stop_reason = response.get("stopReason")
+
+    if stop_reason == "max_tokens":
+        # 途中で打ち切られた回答はキャッシュしない
+        logger.warning("回答が出力トークン上限で打ち切られました")
+    elif cacheable:
+        cache.put(key, text, model_id=model_id)
+    return (text, stop_reason) if return_stop_reason else text
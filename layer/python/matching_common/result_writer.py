@@ -0,0 +1,152 @@
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from matching_common.metrics import metrics
+
+# ロガーの設定
+logger = logging.getLogger()
+
+# マルチパートアップロードのパートサイズ（S3 の最小値は最後のパートを除き 5MB）
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+
+# 文字列を UTF-8 にまとめて変換する単位（文字数）
+ENCODE_BATCH_CHARS = 256 * 1024
+
+class S3StreamingUpload:
+    """書き込まれた文字列を S3 にストリーミングでアップロードするファイル風オブジェクト
+
+    バッファが part_size に達するたびにマルチパートアップロードのパートとして送信するため、
+    ドキュメント全体をメモリに載せない。part_size に満たない小さなドキュメントは put_object 1回で送信する。
+    """
+
+    def __init__(self, s3, bucket, key, content_type="application/json", part_size=DEFAULT_PART_SIZE):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.content_type = content_type
+        self.part_size = max(MIN_PART_SIZE, part_size)
+        self._pending = []
+        self._pending_chars = 0
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+        self.bytes_written = 0
+
+    def write(self, text):
+        self._pending.append(text)
+        self._pending_chars += len(text)
+        if self._pending_chars >= ENCODE_BATCH_CHARS:
+            self._encode_pending()
+            while len(self._buffer) >= self.part_size:
+                self._upload_part(self._buffer[:self.part_size])
+                del self._buffer[:self.part_size]
+
+    def _encode_pending(self):
+        data = "".join(self._pending).encode("utf-8")
+        self._buffer += data
+        self.bytes_written += len(data)
+        self._pending = []
+        self._pending_chars = 0
+
+    def _upload_part(self, data):
+        if self._upload_id is None:
+            response = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key, ContentType=self.content_type)
+            self._upload_id = response["UploadId"]
+        part_number = len(self._parts) + 1
+        response = self.s3.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            PartNumber=part_number,
+            UploadId=self._upload_id,
+            Body=bytes(data)
+        )
+        self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+    def close(self):
+        """残りのデータを送信してアップロードを完了する"""
+        self._encode_pending()
+        if self._upload_id is None:
+            self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer), ContentType=self.content_type)
+        else:
+            if self._buffer:
+                self._upload_part(self._buffer)
+            self.s3.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self._upload_id,
+                MultipartUpload={"Parts": self._parts}
+            )
+        self._buffer = bytearray()
+
+    def abort(self):
+        """途中まで送信したパートを破棄する（失敗しても例外は送出しない）"""
+        if self._upload_id is None:
+            return
+        try:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+        except Exception as e:
+            logger.warning(f"マルチパートアップロードの中止に失敗: s3://{self.bucket}/{self.key} {e}")
+
+def _make_encoder(indent):
+    separators = (",", ": ") if indent else (",", ":")
+    return json.JSONEncoder(ensure_ascii=False, indent=indent, separators=separators)
+
+class EncodedJSON:
+    """エンコード済みの JSON 値（複数のドキュメントで同じ値を1回のエンコードで共有する）
+
+    indent はトップレベルのキーの値として埋め込む前提で1段下げた状態で保持する。
+    """
+
+    def __init__(self, value, indent=None):
+        text = _make_encoder(indent).encode(value)
+        self.indent = indent
+        self.text = text.replace("\n", "\n" + " " * indent) if indent else text
+
+def write_json_document(writer, fields, indent=None):
+    """(キー, 値) のリストをトップレベルのオブジェクトとして writer に書き込む関数
+
+    値は iterencode で少しずつ書き込む（EncodedJSON の場合はエンコード済みの文字列をそのまま書き込む）。
+    出力は json.dumps(dict(fields), ensure_ascii=False, indent=indent) と同じ（indent なしの場合は区切りの空白も省く）。
+    """
+    encoder = _make_encoder(indent)
+    newline = "\n" + " " * indent if indent else ""
+    key_separator = ": " if indent else ":"
+
+    writer.write("{")
+    for i, (name, value) in enumerate(fields):
+        writer.write(("," if i else "") + newline + json.dumps(name, ensure_ascii=False) + key_separator)
+        if isinstance(value, EncodedJSON):
+            if value.indent != indent:
+                raise ValueError("EncodedJSON の indent がドキュメントと一致しません")
+            writer.write(value.text)
+        else:
+            for chunk in encoder.iterencode(value):
+                # JSON の文字列中の改行はエスケープされるため、チャンク中の改行はすべてインデントの改行
+                writer.write(chunk.replace("\n", newline) if indent else chunk)
+    writer.write(("\n" if indent and fields else "") + "}")
+
+def upload_json_document(s3, bucket, key, fields, indent=None, part_size=DEFAULT_PART_SIZE):
+    """1つのドキュメントを S3 にストリーミングでアップロードする関数（失敗時はマルチパートアップロードを中止して例外を送出）"""
+    upload = S3StreamingUpload(s3, bucket, key, part_size=part_size)
+    try:
+        write_json_document(upload, fields, indent=indent)
+        upload.close()
+    except BaseException:
+        upload.abort()
+        raise
+    metrics.count("S3BytesWritten", upload.bytes_written, unit="Bytes")
+    return upload.bytes_written
+
+def upload_json_documents(s3, bucket, documents, indent=None, part_size=DEFAULT_PART_SIZE):
+    """複数のドキュメント（キー -> (キー, 値) のリスト）を並行して S3 にアップロードし、キー -> バイト数を返す関数"""
+    if len(documents) <= 1:
+        return {key: upload_json_document(s3, bucket, key, fields, indent, part_size) for key, fields in documents.items()}
+
+    with ThreadPoolExecutor(max_workers=len(documents)) as executor:
+        futures = {
+            key: executor.submit(upload_json_document, s3, bucket, key, fields, indent, part_size)
+            for key, fields in documents.items()
+        }
+        return {key: future.result() for key, future in futures.items()}
@@ -0,0 +1,90 @@
+import json
+import logging
+
+from matching_common.metrics import metrics
+
+# ロガーの設定
+logger = logging.getLogger()
+
+# S3 のレスポンスボディを読み込む単位（バイト）
+READ_CHUNK_SIZE = 64 * 1024
+
+class RosterReadStats:
+    """JSONL 読み込み時の件数（有効レコード・空行・解析できなかった行）を保持するクラス"""
+
+    def __init__(self):
+        self.records = 0
+        self.blank_lines = 0
+        self.skipped_lines = 0
+        self.etag = None  # S3 から読み込んだ場合のオブジェクトの ETag
+
+    def to_dict(self):
+        return {
+            "records": self.records,
+            "blank_lines": self.blank_lines,
+            "skipped_lines": self.skipped_lines
+        }
+
+def _iter_raw_lines(body, chunk_size=READ_CHUNK_SIZE):
+    """レスポンスボディ（StreamingBody またはファイルオブジェクト）を1行ずつ返す"""
+    if hasattr(body, "iter_lines"):
+        # botocore の StreamingBody はチャンク単位で読み込み、行に分割して返す
+        yield from body.iter_lines(chunk_size=chunk_size)
+    else:
+        yield from body
+
+def iter_jsonl_records(body, stats=None, fields=None):
+    """JSONL を1行ずつ解析してレコードを返すジェネレーター
+
+    ファイル全体をメモリに載せずに処理する。解析できない行はスキップして stats に件数を記録する。
+    fields を指定した場合は、そのキーのみを持つ辞書に射影して返す。
+    """
+    if stats is None:
+        stats = RosterReadStats()
+
+    for line_number, raw_line in enumerate(_iter_raw_lines(body), start=1):
+        if isinstance(raw_line, bytes):
+            try:
+                raw_line = raw_line.decode("utf-8")
+            except UnicodeDecodeError:
+                stats.skipped_lines += 1
+                logger.warning(f"UTF-8として解釈できない行をスキップ: {line_number}行目")
+                continue
+
+        line = raw_line.strip()
+        if not line:
+            stats.blank_lines += 1
+            continue
+
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            stats.skipped_lines += 1
+            logger.warning(f"JSONとして解析できない行をスキップ: {line_number}行目")
+            continue
+
+        if fields is not None and isinstance(record, dict):
+            record = {field: record.get(field) for field in fields}
+
+        stats.records += 1
+        yield record
+
+def stream_s3_jsonl(s3, bucket, key, stats=None, fields=None):
+    """S3 上の JSONL オブジェクトをストリーミングで読み込み、レコードを1件ずつ返すジェネレーター"""
+    response = s3.get_object(Bucket=bucket, Key=key)
+    body = response["Body"]
+    metrics.count("S3BytesRead", response.get("ContentLength", 0), unit="Bytes")
+    if stats is not None:
+        stats.etag = response.get("ETag")
+    try:
+        yield from iter_jsonl_records(body, stats=stats, fields=fields)
+    finally:
+        body.close()
+
+def count_s3_jsonl_records(s3, bucket, key, stats=None):
+    """S3 上の JSONL オブジェクトの有効レコード数を数える関数（レコードは保持しない）"""
+    if stats is None:
+        stats = RosterReadStats()
+    for _ in stream_s3_jsonl(s3, bucket, key, stats=stats, fields=()):
+        pass
+    return stats.records
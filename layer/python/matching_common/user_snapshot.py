@@ -0,0 +1,276 @@
+import bisect
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from matching_common.aws_clients import read_s3_json, write_s3_json
+from matching_common.metrics import metrics
+
+# ロガーの設定
+logger = logging.getLogger()
+
+JST = timezone(timedelta(hours=9))
+
+# スナップショットファイルの形式: ヘッダー（マジック、バージョン、件数）+ 16バイトのIDを昇順に並べた配列
+SNAPSHOT_MAGIC = b"USNP"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<4sHxxQ")
+ID_BYTES = 16
+
+# ブルームフィルターの形式: ヘッダー（マジック、ハッシュ数、ビット数）+ ビット配列
+BLOOM_MAGIC = b"UBLM"
+BLOOM_HEADER = struct.Struct("<4sHxxQ")
+
+DEFAULT_SCAN_SEGMENTS = 8
+DEFAULT_BLOOM_BITS_PER_KEY = 10
+DEFAULT_CACHE_DIR = "/tmp/user-snapshot"
+DEFAULT_MAX_AGE_HOURS = 36
+
+def pack_user_id(user_id):
+    """UUID形式のIDを16バイト（ビッグエンディアン）に変換する（UUID形式でない場合は None）
+
+    DynamoDB のキーは文字列の完全一致のため、小文字・ハイフン区切りの正規形のみ変換する
+    （大文字・波括弧・urn:uuid: 付き・ハイフンなしなどは UUID形式でないIDとして扱う）。
+    """
+    try:
+        parsed = uuid.UUID(user_id)
+    except (ValueError, AttributeError, TypeError):
+        return None
+    return parsed.bytes if str(parsed) == user_id else None
+
+def _bloom_positions(packed_id, hash_count, bit_count):
+    # UUIDのバージョン・バリアントのビットは固定のため、SHA-256 の前半・後半を2つのハッシュとして二重ハッシュ法を使う
+    digest = hashlib.sha256(packed_id).digest()
+    h1 = int.from_bytes(digest[:8], "little")
+    h2 = int.from_bytes(digest[8:16], "little") | 1
+    return [(h1 + i * h2) % bit_count for i in range(hash_count)]
+
+def build_bloom_filter(packed_ids, bits_per_key=DEFAULT_BLOOM_BITS_PER_KEY):
+    """ブルームフィルターのバイト列を作成する関数（偽陽性率は bits_per_key=10 で約1%）"""
+    bit_count = max(64, len(packed_ids) * bits_per_key)
+    hash_count = max(1, round(bits_per_key * 0.693))
+    bits = bytearray((bit_count + 7) // 8)
+    for packed_id in packed_ids:
+        for position in _bloom_positions(packed_id, hash_count, bit_count):
+            bits[position >> 3] |= 1 << (position & 7)
+    return BLOOM_HEADER.pack(BLOOM_MAGIC, hash_count, bit_count) + bytes(bits)
+
+class BloomFilter:
+    """build_bloom_filter で作成したバイト列（または mmap）に対して存在の可能性を判定するクラス"""
+
+    def __init__(self, data):
+        magic, self.hash_count, self.bit_count = BLOOM_HEADER.unpack_from(data, 0)
+        if magic != BLOOM_MAGIC:
+            raise ValueError("ブルームフィルターの形式が不正です")
+        self._data = data
+        self._offset = BLOOM_HEADER.size
+
+    def might_contain(self, packed_id):
+        data = self._data
+        offset = self._offset
+        for position in _bloom_positions(packed_id, self.hash_count, self.bit_count):
+            if not data[offset + (position >> 3)] & (1 << (position & 7)):
+                return False
+        return True
+
+def scan_user_ids(dynamodb, table_name, key_name="id", total_segments=DEFAULT_SCAN_SEGMENTS):
+    """ユーザーテーブルを並列のセグメントScan（キー属性のみ）で読み込み、全IDを返す関数
+
+    dynamodb は boto3.client('dynamodb')。セグメントごとに1スレッドでページングする。
+    """
+    def scan_segment(segment):
+        ids = []
+        request = {
+            "TableName": table_name,
+            "ProjectionExpression": "#key",
+            "ExpressionAttributeNames": {"#key": key_name},
+            "Segment": segment,
+            "TotalSegments": total_segments
+        }
+        while True:
+            response = dynamodb.scan(**request)
+            metrics.count("DynamoDBCalls")
+            ids.extend(item[key_name]["S"] for item in response.get("Items", []))
+            last_key = response.get("LastEvaluatedKey")
+            if not last_key:
+                return ids
+            request["ExclusiveStartKey"] = last_key
+
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        return [user_id for ids in executor.map(scan_segment, range(total_segments)) for user_id in ids]
+
+def build_snapshot_files(user_ids, bloom_bits_per_key=DEFAULT_BLOOM_BITS_PER_KEY):
+    """IDのリストから (スナップショットのバイト列, ブルームフィルターのバイト列または None, UUID形式でないID) を作成する関数"""
+    packed_ids = set()
+    extra_ids = set()
+    for user_id in user_ids:
+        packed_id = pack_user_id(user_id)
+        if packed_id is None:
+            extra_ids.add(user_id)
+        else:
+            packed_ids.add(packed_id)
+
+    sorted_ids = sorted(packed_ids)
+    snapshot = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(sorted_ids)) + b"".join(sorted_ids)
+    bloom = build_bloom_filter(sorted_ids, bloom_bits_per_key) if bloom_bits_per_key else None
+    return snapshot, bloom, sorted(extra_ids)
+
+def upload_user_snapshot(s3, bucket, prefix, user_ids, table_name=None, bloom_bits_per_key=DEFAULT_BLOOM_BITS_PER_KEY):
+    """スナップショット（とブルームフィルター）を S3 に保存し、最後にマニフェストを更新する関数
+
+    ファイルは作成日時ごとのキーに保存し、マニフェスト（{prefix}manifest.json）の更新で切り替える。
+    """
+    prefix = prefix if prefix.endswith("/") else f"{prefix}/"
+    created_at = datetime.now(JST)
+    version_prefix = f"{prefix}{created_at.strftime('%Y%m%dT%H%M%S')}/"
+    snapshot, bloom, extra_ids = build_snapshot_files(user_ids, bloom_bits_per_key)
+
+    s3.put_object(Bucket=bucket, Key=f"{version_prefix}ids.bin", Body=snapshot, ContentType="application/octet-stream")
+    if bloom is not None:
+        s3.put_object(Bucket=bucket, Key=f"{version_prefix}bloom.bin", Body=bloom, ContentType="application/octet-stream")
+    metrics.count("S3BytesWritten", len(snapshot) + len(bloom or b""), unit="Bytes")
+
+    manifest = {
+        "table_name": table_name,
+        "created_at": created_at.isoformat(),
+        "id_count": (len(snapshot) - SNAPSHOT_HEADER.size) // ID_BYTES,
+        "ids_key": f"{version_prefix}ids.bin",
+        "bloom_key": f"{version_prefix}bloom.bin" if bloom is not None else None,
+        "extra_ids": extra_ids
+    }
+    write_s3_json(s3, bucket, f"{prefix}manifest.json", manifest, indent=None)
+    logger.info(f"ユーザースナップショットを保存: s3://{bucket}/{version_prefix} ({manifest['id_count']}件)")
+    return manifest
+
+class UserSnapshot:
+    """スナップショットファイルを mmap し、IDの存在を二分探索で判定するクラス（ネットワーク呼び出しなし）"""
+
+    def __init__(self, ids_path, bloom_path=None, extra_ids=(), created_at=None):
+        self.created_at = created_at
+        self.extra_ids = frozenset(extra_ids)
+        self.paths = [path for path in (ids_path, bloom_path) if path]
+        with open(ids_path, "rb") as f:
+            self._ids = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.id_count = SNAPSHOT_HEADER.unpack_from(self._ids, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError("スナップショットの形式が不正です")
+        self._bloom = None
+        if bloom_path:
+            with open(bloom_path, "rb") as f:
+                self._bloom = BloomFilter(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __len__(self):
+        return self.id_count + len(self.extra_ids)
+
+    def __getitem__(self, index):
+        # bisect から使う: index 番目のID（16バイト）
+        offset = SNAPSHOT_HEADER.size + index * ID_BYTES
+        return self._ids[offset:offset + ID_BYTES]
+
+    def contains(self, user_id):
+        if not isinstance(user_id, str):
+            return False
+        packed_id = pack_user_id(user_id)
+        if packed_id is None:
+            return user_id in self.extra_ids
+        if self._bloom is not None and not self._bloom.might_contain(packed_id):
+            return False
+        index = bisect.bisect_left(_SnapshotView(self), packed_id)
+        return index < self.id_count and self[index] == packed_id
+
+    __contains__ = contains
+
+    def close(self, remove_files=False):
+        """mmap を閉じる（remove_files を指定した場合は /tmp のファイルも削除する）"""
+        self._ids.close()
+        if self._bloom is not None:
+            self._bloom._data.close()
+        if remove_files:
+            for path in self.paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def age_hours(self):
+        if self.created_at is None:
+            return None
+        return (datetime.now(JST) - datetime.fromisoformat(self.created_at)).total_seconds() / 3600
+
+class _SnapshotView:
+    """bisect に渡すためのシーケンス（UUID形式のIDの部分のみ）"""
+
+    __slots__ = ("snapshot",)
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __len__(self):
+        return self.snapshot.id_count
+
+    def __getitem__(self, index):
+        return self.snapshot[index]
+
+# 読み込み済みのスナップショット（ウォームコンテナ間で再利用する）: S3キー -> UserSnapshot
+_loaded_snapshots = {}
+_load_lock = threading.Lock()
+
+def load_user_snapshot(s3, bucket, prefix, cache_dir=DEFAULT_CACHE_DIR):
+    """マニフェストが指すスナップショットを /tmp にダウンロードして読み込む関数（同じスナップショットは再利用する）
+
+    新しいスナップショットに切り替えた場合、以前のスナップショットは mmap を閉じて /tmp のファイルを削除する。
+    """
+    prefix = prefix if prefix.endswith("/") else f"{prefix}/"
+    manifest = read_s3_json(s3, bucket, f"{prefix}manifest.json")
+
+    with _load_lock:
+        snapshot = _loaded_snapshots.get(manifest["ids_key"])
+        if snapshot is not None:
+            return snapshot
+
+        os.makedirs(cache_dir, exist_ok=True)
+        paths = {}
+        for name in ("ids_key", "bloom_key"):
+            key = manifest.get(name)
+            if key:
+                paths[name] = os.path.join(cache_dir, key.replace("/", "_"))
+                if not os.path.exists(paths[name]):
+                    s3.download_file(bucket, key, paths[name])
+                    metrics.count("S3BytesRead", os.path.getsize(paths[name]), unit="Bytes")
+
+        snapshot = UserSnapshot(paths["ids_key"], paths.get("bloom_key"), manifest.get("extra_ids", []), manifest.get("created_at"))
+        for previous in _loaded_snapshots.values():
+            previous.close(remove_files=True)
+        _loaded_snapshots.clear()
+        _loaded_snapshots[manifest["ids_key"]] = snapshot
+        logger.info(f"ユーザースナップショットを読み込み: {manifest['ids_key']} ({len(snapshot)}件、{manifest.get('created_at')})")
+        return snapshot
+
+def load_user_snapshot_from_env(s3):
+    """環境変数で指定されたスナップショットを読み込む関数（未設定・古い・読み込めない場合は None）
+
+    USER_SNAPSHOT_S3_BUCKET      : スナップショットのバケット（未設定の場合は使わない）
+    USER_SNAPSHOT_S3_PREFIX      : スナップショットのプレフィックス
+    USER_SNAPSHOT_MAX_AGE_HOURS  : これより古いスナップショットは使わない（時間）
+    """
+    bucket = os.environ.get("USER_SNAPSHOT_S3_BUCKET")
+    if not bucket:
+        return None
+    try:
+        snapshot = load_user_snapshot(s3, bucket, os.environ.get("USER_SNAPSHOT_S3_PREFIX", "user-snapshot/"))
+    except Exception as e:
+        logger.warning(f"ユーザースナップショットの読み込みに失敗: {e}")
+        return None
+
+    max_age_hours = float(os.environ.get("USER_SNAPSHOT_MAX_AGE_HOURS", DEFAULT_MAX_AGE_HOURS))
+    age_hours = snapshot.age_hours()
+    if age_hours is not None and age_hours > max_age_hours:
+        logger.warning(f"ユーザースナップショットが古いため使用しません（{age_hours:.1f}時間前に作成）")
+        return None
+    return snapshot
@@ -0,0 +1,125 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from matching_common.metrics import metrics
+
+# ロガーの設定
+logger = logging.getLogger()
+
+# BatchGetItem 1回あたりの最大キー数（DynamoDB の上限）
+BATCH_GET_MAX_KEYS = 100
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_MAX_RETRIES = 8
+DEFAULT_RETRY_BASE_DELAY = 0.05
+DEFAULT_RETRY_MAX_DELAY = 2.0
+
+class UserExistenceValidator:
+    """ユーザーテーブルに存在するIDを BatchGetItem でまとめて確認するクラス
+
+    IDの重複を除いてから100件ずつのバッチに分け、max_workers 並列で問い合わせる。
+    取得するのはキー属性のみ（ProjectionExpression）。UnprocessedKeys はジッター付きの指数バックオフで再試行する。
+    dynamodb は boto3.client('dynamodb')（スレッドセーフなクライアントを使う）。
+    """
+
+    def __init__(self, dynamodb, table_name, key_name="id", max_workers=DEFAULT_MAX_WORKERS,
+                 max_retries=DEFAULT_MAX_RETRIES, base_delay=DEFAULT_RETRY_BASE_DELAY, max_delay=DEFAULT_RETRY_MAX_DELAY):
+        self.dynamodb = dynamodb
+        self.table_name = table_name
+        self.key_name = key_name
+        self.max_workers = max(1, max_workers)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.unique_ids = 0
+        self.batches = 0
+        self.requests = 0
+        self.unprocessed_retries = 0
+        self.failed_ids = 0
+        self.elapsed_seconds = 0.0
+
+    def existing_ids(self, user_ids):
+        """存在するIDの集合を返す（問い合わせに失敗したIDは存在しないものとして扱う）"""
+        started = time.monotonic()
+        self._reset_stats()
+
+        # 文字列のIDのみ問い合わせる（重複を除き、出現順を保つ）
+        unique_ids = list(dict.fromkeys(user_id for user_id in user_ids if isinstance(user_id, str) and user_id))
+        self.unique_ids = len(unique_ids)
+        batches = [unique_ids[i:i + BATCH_GET_MAX_KEYS] for i in range(0, len(unique_ids), BATCH_GET_MAX_KEYS)]
+        self.batches = len(batches)
+
+        existing = set()
+        if len(batches) <= 1 or self.max_workers == 1:
+            for batch in batches:
+                existing.update(self._fetch_batch(batch))
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches))) as executor:
+                for found in executor.map(self._fetch_batch, batches):
+                    existing.update(found)
+
+        self.elapsed_seconds = time.monotonic() - started
+        logger.info(f"ユーザー存在確認: {self.unique_ids}件中 {len(existing)}件が存在（{self.batches}バッチ、{self.elapsed_seconds:.2f}秒）")
+        return existing
+
+    def _fetch_batch(self, batch):
+        """1バッチ分のIDを問い合わせ、存在するIDを返す"""
+        found = set()
+        request = {
+            self.table_name: {
+                "Keys": [{self.key_name: {"S": user_id}} for user_id in batch],
+                "ProjectionExpression": "#key",
+                "ExpressionAttributeNames": {"#key": self.key_name}
+            }
+        }
+        attempt = 0
+        while request:
+            try:
+                response = self.dynamodb.batch_get_item(RequestItems=request)
+            except Exception as e:
+                # エラーの場合は安全のため存在しないものとして扱う
+                failed = len(request[self.table_name]["Keys"])
+                logger.error(f"DynamoDB検索エラー（{failed}件を存在しないものとして扱う）: {str(e)}")
+                self._add_stats(requests=1, failed_ids=failed)
+                return found
+
+            self._add_stats(requests=1)
+            for item in response.get("Responses", {}).get(self.table_name, []):
+                found.add(item[self.key_name]["S"])
+
+            request = response.get("UnprocessedKeys") or None
+            if request:
+                if attempt >= self.max_retries:
+                    failed = len(request[self.table_name]["Keys"])
+                    logger.error(f"UnprocessedKeys の再試行回数を超過（{failed}件を存在しないものとして扱う）")
+                    self._add_stats(failed_ids=failed)
+                    return found
+                # ジッター付きの指数バックオフ
+                time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt))))
+                attempt += 1
+                self._add_stats(unprocessed_retries=1)
+        return found
+
+    def _add_stats(self, requests=0, unprocessed_retries=0, failed_ids=0):
+        metrics.count("DynamoDBCalls", requests)
+        with self._lock:
+            self.requests += requests
+            self.unprocessed_retries += unprocessed_retries
+            self.failed_ids += failed_ids
+
+    def stats(self):
+        return {
+            "unique_ids": self.unique_ids,
+            "batches": self.batches,
+            "requests": self.requests,
+            "unprocessed_retries": self.unprocessed_retries,
+            "failed_ids": self.failed_ids,
+            "elapsed_seconds": round(self.elapsed_seconds, 3)
+        }
@@ -6,10 +6,12 @@
 import boto3
 import json
 import os
+from matching_common.metrics import instrument_handler, metrics
 
 # Bedrock クライアントの作成
 bedrock = boto3.client("bedrock-runtime", region_name=os.environ.get("AWS_REGION", "ap-northeast-1"))
 
+@instrument_handler("claude-v2.1-sample")
 def lambda_handler(event, context):
     try:
         # 社員情報（リクエストボディから取得、なければデフォルトデータ）
@@ -31,10 +33,13 @@ def lambda_handler(event, context):
         """.strip()
 
         # モデルへのリクエスト
-        response = bedrock.invoke_model(
-            modelId="anthropic.claude-v2:1",  # Claude v2 モデルを指定
-            body=json.dumps({"prompt": prompt, "max_tokens_to_sample": 1000})
-        )
+        metrics.count("BedrockCalls")
+        with metrics.timer("BedrockLatency"):
+            response = bedrock.invoke_model(
+                modelId="anthropic.claude-v2:1",  # Claude v2 モデルを指定
+                body=json.dumps({"prompt": prompt, "max_tokens_to_sample": 1000})
+            )
+        metrics.record_invoke_model_usage(response)
 
         # 結果を取得
         result = json.loads(response["body"].read())
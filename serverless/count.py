@@ -2,6 +2,9 @@ import json
 import boto3
 from datetime import datetime
 from dateutil import tz
+from matching_common.roster import count_s3_jsonl_records
+from matching_common.group_model import themes_from_json
+from matching_common.user_snapshot import load_user_snapshot_from_env
 
 # AWSクライアントの初期化
 s3_client = boto3.client('s3')
@@ -36,45 +39,48 @@ def download_and_load_json(bucket, key):
         print(f"S3読み込みエラー: {e}")
         return None
 
-def download_and_load_jsonl(bucket, key):
+def count_jsonl_lines(bucket, key):
+    """JSONLの有効行数をストリーミングで数える（ファイル全体をメモリに載せない）"""
     try:
-        response = s3_client.get_object(Bucket=bucket, Key=key)
-        content = response['Body'].read().decode('utf-8').splitlines()
-        return [json.loads(line) for line in content if line.strip()]
+        return count_s3_jsonl_records(s3_client, bucket, key)
     except Exception as e:
         print(f"S3読み込みエラー: {e}")
         return None
 
 # データ処理
 sample_data = download_and_load_json(output_bucket, sample_json_path)
-hoge_data = download_and_load_jsonl(source_bucket, hoge_jsonl_path)
+hoge_line_count = count_jsonl_lines(source_bucket, hoge_jsonl_path)
+
+# ユーザースナップショット（USER_SNAPSHOT_S3_BUCKET が設定されている場合のみ）
+user_snapshot = load_user_snapshot_from_env(s3_client)
 
 total_ids = 0
 excluded_ids_count = 0
+unknown_ids_count = 0
 themes = set()
 group_count = 0
 
 if sample_data:
-    for theme_data in sample_data:
-        theme_name = theme_data.get("theme")
-        groups = theme_data.get("group_list", [])
-        
+    for theme in themes_from_json(sample_data):
         # 総ID数カウント（重複含む）
-        for group in groups:
-            total_ids += len(group.get("id_list", []))
+        total_ids += theme.member_count
+        
+        # スナップショットに存在しないID（退会済み等）のカウント
+        if user_snapshot is not None:
+            unknown_ids_count += sum(1 for subgroup in theme.subgroups for member_id in subgroup if not user_snapshot.contains(member_id))
         
         # 切り捨てられたメンバー処理
-        if theme_name == "切り捨てられたメンバー一覧":
-            excluded_ids_count += sum(len(g.get("id_list", [])) for g in groups)
+        if theme.is_discarded:
+            excluded_ids_count += theme.member_count
         else:
-            themes.add(theme_name)
-            group_count += len(groups)
+            themes.add(theme.name)
+            group_count += theme.subgroup_count
 
 remaining_ids = total_ids - excluded_ids_count
 unique_themes_count = len(themes)
 
 # マッチングユーザ数（hoge.jsonlの行数）
-matching_users = len(hoge_data) if hoge_data else 0
+matching_users = hoge_line_count or 0
 
 # 精度計算（パーセンテージ表示）
 try:
@@ -103,6 +109,8 @@ result = f"""
 マッチング対象ユーザ数: {matching_users}
 精度: {total_ids} / {matching_users} ≈ {accuracy_percentage:.2f}%
 """
+if user_snapshot is not None:
+    result += f"ユーザーテーブルに存在しないID数: {unknown_ids_count}（スナップショット: {user_snapshot.created_at}）\n"
 
 # SNS通知
 try:
@@ -3,11 +3,27 @@ import random
 import boto3
 import os
 from botocore.exceptions import ClientError
-
+from botocore.config import Config
+from matching_common.metrics import instrument_handler, metrics
+from matching_common.rate_limiter import LIMITER_SDK_RETRIES, build_rate_limiter_from_env
+from matching_common.response_cache import converse_with_cache
+from matching_common.roster import RosterReadStats, stream_s3_jsonl
+from matching_common.chunk_planner import estimate_tokens, plan_chunks
+from matching_common.group_merge import GroupMerger
+
+# Bedrock呼び出しの流量制限とスロットリング時の再試行（BEDROCK_RATE_LIMIT_ENABLED=false で無効）
+BEDROCK_LIMITER = build_rate_limiter_from_env()
+
+@instrument_handler("grouping-by-cloude")
 def lambda_handler(event, context):
     # S3クライアントとBedrockクライアントの設定
     s3 = boto3.client('s3')
-    bedrock = boto3.client(service_name='bedrock-runtime', region_name='ap-northeast-1')
+    # リミッター使用時は再試行をリミッターに任せる
+    bedrock = boto3.client(
+        service_name='bedrock-runtime',
+        region_name='ap-northeast-1',
+        config=Config(retries=LIMITER_SDK_RETRIES) if BEDROCK_LIMITER else None
+    )
 
     # S3バケットとオブジェクト情報の取得（環境変数または直接指定）
     bucket_name = os.environ.get('S3_BUCKET_NAME', 'hara-datasource')
@@ -16,19 +32,12 @@ def lambda_handler(event, context):
     summary_output_key = os.environ.get('S3_SUMMARY_OUTPUT_KEY', 'employee_grouping_summary.txt')
 
     try:
-        # S3からJSONLデータを取得
-        response = s3.get_object(Bucket=bucket_name, Key=file_key)
-        file_content = response['Body'].read().decode('utf-8')
-
-        # JSONLデータを解析（各行が独立したJSONオブジェクト）
-        employees = []
-        for line in file_content.strip().split('\n'):
-            if line.strip():
-                try:
-                    employee = json.loads(line)
-                    employees.append(employee)
-                except json.JSONDecodeError:
-                    continue
+        # S3からJSONLデータをストリーミングで取得・解析（各行が独立したJSONオブジェクト）
+        roster_stats = RosterReadStats()
+        with metrics.stage("read_roster"):
+            employees = list(stream_s3_jsonl(s3, bucket_name, file_key, stats=roster_stats))
+        if roster_stats.skipped_lines:
+            print(f"解析できなかった行をスキップしました: {roster_stats.skipped_lines}行")
 
         # データが空の場合はエラーを返す
         if not employees:
@@ -40,12 +49,18 @@ def lambda_handler(event, context):
         # データをランダムにシャッフル
         random.shuffle(employees)
 
-        # データを複数のチャンクに分割（Claudeの入力制限を考慮）
-        chunk_size = min(100, len(employees) // 5)  # 最大5チャンクに分割
-        chunks = [employees[i:i + chunk_size] for i in range(0, len(employees), chunk_size)]
+        # データを複数のチャンクに分割（入力トークン予算と出力上限8192トークンに収まる最少のチャンク数）
+        chunk_plan = plan_chunks(
+            employees,
+            prompt_overhead_tokens=estimate_tokens(create_prompt([])),
+            max_output_tokens=8192
+        )
+        chunks = chunk_plan.chunks
+        print(f"チャンク分割計画: {json.dumps(chunk_plan.to_dict(), ensure_ascii=False)}")
 
         # 各チャンクをClaudeに送信してグルーピング
-        all_groups = {}
+        # グループ名の表記ゆれを正規化して統合し、メンバーIDの重複を除く
+        merger = GroupMerger()
         all_results_text = "# 社員グルーピング結果\n\n"
 
         for i, chunk in enumerate(chunks):
@@ -54,34 +69,27 @@ def lambda_handler(event, context):
             # Claudeへのプロンプト作成
             prompt = create_prompt(chunk)
 
-            # Claudeに送信
-            response = bedrock.converse(
-                modelId='anthropic.claude-3-5-sonnet-20240620-v1:0',
-                messages=[
+            # Claudeに送信（スロットリング時はリミッターが待機して再試行する）
+            with metrics.stage("invoke_chunk"):
+                result = converse_with_cache(
+                    bedrock,
+                    'anthropic.claude-3-5-sonnet-20240620-v1:0',
+                    prompt,
                     {
-                        "role": "user",
-                        "content": [
-                            {
-                                "text": prompt
-                            }
-                        ]
-                    }
-                ],
-                inferenceConfig={
-                    "temperature": 0,
-                    "maxTokens": 8192
-                }
-            )
-
-            # レスポンスから回答を取得
-            result = response['output']['message']['content'][0]['text']
+                        "temperature": 0,
+                        "maxTokens": 8192
+                    },
+                    limiter=BEDROCK_LIMITER
+                )
 
             # 結果をテキストに追加
             all_results_text += f"## チャンク {i+1} の分析結果:\n\n{result}\n\n---\n\n"
 
             # グループ情報を解析して統合
             chunk_groups = parse_groups(result)
-            all_groups = merge_groups(all_groups, chunk_groups)
+            merger.add_groups(chunk_groups)
+
+        all_groups = merger.to_groups()
 
         # 最終的なグループ情報をテキスト形式で追加（理由部分は削除）
         all_results_text += "\n\n# 統合グループ情報\n\n"
@@ -91,23 +99,25 @@ def lambda_handler(event, context):
             all_results_text += f"メンバーID: {group_info['members']}\n\n"
 
         # 結果をS3にテキストファイルとしてアップロード（全体ファイル）
+        all_results_body = all_results_text.encode('utf-8')
         s3.put_object(
             Bucket=bucket_name,
             Key=output_key,
-            Body=all_results_text,
+            Body=all_results_body,
             ContentType='text/plain'
         )
 
         # 「統合グループ情報」以降のみを抽出してサマリーファイルとしてアップロード
         summary_start = all_results_text.find("# 統合グループ情報")
-        summary_text = all_results_text[summary_start:]
+        summary_body = all_results_text[summary_start:].encode('utf-8')
 
         s3.put_object(
             Bucket=bucket_name,
             Key=summary_output_key,
-            Body=summary_text,
+            Body=summary_body,
             ContentType='text/plain'
         )
+        metrics.count("S3BytesWritten", len(all_results_body) + len(summary_body), unit="Bytes")
 
         return {
             'statusCode': 200,
@@ -185,15 +195,3 @@ def parse_groups(result):
                 continue
 
     return groups
-
-def merge_groups(all_groups, new_groups):
-    """複数のチャンクから得られたグループ情報を統合する関数"""
-    for group_name, group_info in new_groups.items():
-        if group_name in all_groups:
-            # 既存のグループにメンバーを追加
-            all_groups[group_name]["members"].extend(group_info["members"])
-        else:
-            # 新しいグループを追加
-            all_groups[group_name] = group_info
-
-    return all_groups
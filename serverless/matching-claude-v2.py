@@ -2,11 +2,28 @@ import boto3
 import json
 import psycopg2
 import numpy as np
-from sklearn.cluster import KMeans
-import ast
+import os
+from botocore.config import Config
+from matching_common.chunk_planner import DEFAULT_MAX_INPUT_TOKENS
+from matching_common.cluster_summary import DEFAULT_SUMMARY_MAX_WORKERS, summarize_clusters
+from matching_common.clustering import build_clustering_engine_from_env, cluster_embeddings
+from matching_common.embedding_loader import fetch_chunks, load_embeddings_from_env
+from matching_common.k_selection import build_k_selector_from_env
+from matching_common.metrics import metrics
+from matching_common.rate_limiter import LIMITER_SDK_RETRIES, build_rate_limiter_from_env, call_with_limiter, estimate_request_tokens
 
-# Bedrockクライアントの設定
-bedrock = boto3.client(service_name='bedrock-runtime', region_name='ap-northeast-1')
+# メトリクス（METRICS_ENABLED=true の場合のみ、終了時に EMF で出力）
+metrics.set_service("matching-claude-v2")
+
+# Bedrock呼び出しの流量制限とスロットリング時の再試行（BEDROCK_RATE_LIMIT_ENABLED=false で無効）
+rate_limiter = build_rate_limiter_from_env()
+
+# Bedrockクライアントの設定（リミッター使用時は再試行をリミッターに任せる）
+bedrock = boto3.client(
+    service_name='bedrock-runtime',
+    region_name='ap-northeast-1',
+    config=Config(retries=LIMITER_SDK_RETRIES) if rate_limiter else None
+)
 
 # データベース接続
 conn = psycopg2.connect(
@@ -17,46 +34,82 @@ conn = psycopg2.connect(
     port="5432"
 )
 
-# ユーザーデータの取得
-cur = conn.cursor()
-cur.execute("SELECT id, embedding, chunks FROM bedrock_integration.bedrock_knowledge_base")
-users = cur.fetchall()
-
-# embeddings配列の作成
-embeddings = np.array([ast.literal_eval(user[1]) for user in users])
+# ユーザーデータの取得（embedding は float32 の配列に直接読み込む。EMBEDDING_FETCH_MODE=cursor でサーバーサイドカーソルから少しずつ取得）
+# chunks はクラスターごとに、LLM に送るメンバーの分のみ取得する
+with metrics.stage("fetch_embeddings"):
+    user_ids, embeddings = load_embeddings_from_env(conn)
+metrics.count("UsersFetched", len(user_ids))
 
-# K-meansクラスタリングの実行
-n_clusters = 5  # クラスター数は適宜調整してください
-kmeans = KMeans(n_clusters=n_clusters, random_state=42)
-cluster_labels = kmeans.fit_predict(embeddings)
+# クラスタリングの実行（CLUSTERING_ENGINE=minibatch の場合は float32 のミニバッチ KMeans で、前回の重心から開始する）
+n_clusters = 5  # クラスター数は適宜調整してください（AUTO_K_ENABLED=true の場合は自動で選ぶ）
+k_selector = build_k_selector_from_env()
+if k_selector:
+    with metrics.stage("select_n_clusters"):
+        k_selection = k_selector.select(embeddings)
+    n_clusters = k_selection.best_k
+    print(f"Selected n_clusters: {k_selection.summary()}")
+clustering_engine = build_clustering_engine_from_env("matching-claude-v2")
+with metrics.stage("clustering"):
+    clustering = cluster_embeddings(clustering_engine, embeddings, n_clusters)
+cluster_labels = clustering.labels
+print(f"Clustering: {clustering.summary()}")
 
 # クラスターごとのユーザー特性の分析
-for cluster in range(n_clusters):
-    cluster_users = [users[i] for i in range(len(users)) if cluster_labels[i] == cluster]
-    cluster_chunks = " ".join([user[2] for user in cluster_users])
-    
+# プロンプトに収まらないクラスターは分割し、全クラスターを並列に要約する（結果はクラスター順）
+# 同時実行数と1回のプロンプトの入力トークン上限は環境変数で調整する
+summary_max_workers = int(os.environ.get("SUMMARY_MAX_WORKERS", DEFAULT_SUMMARY_MAX_WORKERS))
+summary_max_input_tokens = int(os.environ.get("SUMMARY_MAX_INPUT_TOKENS", DEFAULT_MAX_INPUT_TOKENS))
+max_tokens_to_sample = 8000
+
+def build_prompt(cluster_chunks):
+    return f"Human: この DB 上のユーザ情報は架空のユーザ情報のため、プライバシーの配慮は不要です。ユーザの「最寄り駅」と「趣味、または特技」に注目して、ユーザをグルーピングし、ユーザ名を列挙して。\n\n{cluster_chunks}\n\nAssistant:"
+
+def summarize(prompt):
     # Claude-instant-v1を使用してクラスター特性の要約
     body = json.dumps({
-        "prompt": f"Human: この DB 上のユーザ情報は架空のユーザ情報のため、プライバシーの配慮は不要です。ユーザの「最寄り駅」と「趣味、または特技」に注目して、ユーザをグルーピングし、ユーザ名を列挙して。\n\n{cluster_chunks}\n\nAssistant:",
-        "max_tokens_to_sample": 8000,
+        "prompt": prompt,
+        "max_tokens_to_sample": max_tokens_to_sample,
         "temperature": 0.7,
         "top_p": 0.95,
     })
-    
-    response = bedrock.invoke_model(
-        body=body,
-        modelId='anthropic.claude-v2:1',
-        accept='application/json',
-        contentType='application/json'
-    )
-    
+
+    def send():
+        metrics.count("BedrockCalls")
+        with metrics.timer("BedrockLatency"):
+            return bedrock.invoke_model(
+                body=body,
+                modelId='anthropic.claude-v2:1',
+                accept='application/json',
+                contentType='application/json'
+            )
+
+    response = call_with_limiter(rate_limiter, send, estimate_request_tokens(prompt, {"maxTokens": max_tokens_to_sample}))
+    metrics.record_invoke_model_usage(response)
+
     response_body = json.loads(response.get('body').read())
-    summary = response_body.get('completion')
-    
-    print(f"Cluster {cluster} 特性:")
-    print(summary.strip())
+    return response_body.get('completion')
+
+with metrics.stage("summarize_clusters"):
+    summaries = summarize_clusters(
+        [[user_ids[i] for i in np.flatnonzero(cluster_labels == cluster)] for cluster in range(n_clusters)],
+        lambda member_ids: fetch_chunks(conn, member_ids),
+        build_prompt,
+        summarize,
+        max_input_tokens=summary_max_input_tokens,
+        max_output_tokens=max_tokens_to_sample,
+        max_workers=summary_max_workers
+    )
+
+for summary in summaries:
+    print(f"{summary.title}:")
+    print(summary.text.strip())
     print("---")
 
+# スロットリング・再試行の件数（クォータに合わせた設定の調整用）
+if rate_limiter:
+    print(f"Rate limiter: {rate_limiter.stats()}")
+
 # データベース接続のクローズ
-cur.close()
 conn.close()
+
+metrics.flush()
@@ -2,11 +2,33 @@ import boto3
 import json
 import psycopg2
 import numpy as np
-from sklearn.cluster import KMeans
-import ast
+import os
+from botocore.config import Config
+from matching_common.chunk_planner import DEFAULT_MAX_INPUT_TOKENS
+from matching_common.cluster_summary import DEFAULT_SUMMARY_MAX_WORKERS, summarize_clusters
+from matching_common.clustering import build_clustering_engine_from_env, cluster_embeddings
+from matching_common.embedding_loader import fetch_chunks, load_embeddings_from_env
+from matching_common.k_selection import build_k_selector_from_env
+from matching_common.response_cache import build_response_cache_from_env, converse_with_cache
+from matching_common.metrics import metrics
+from matching_common.rate_limiter import LIMITER_SDK_RETRIES, build_rate_limiter_from_env
+
+# メトリクス（METRICS_ENABLED=true の場合のみ、終了時に EMF で出力）
+metrics.set_service("matching-haiku")
+
+# Bedrock呼び出しの流量制限とスロットリング時の再試行（BEDROCK_RATE_LIMIT_ENABLED=false で無効）
+rate_limiter = build_rate_limiter_from_env()
+
+# Bedrockクライアントの設定（リミッター使用時は再試行をリミッターに任せる）
+bedrock = boto3.client(
+    service_name='bedrock-runtime',
+    region_name='ap-northeast-1',
+    config=Config(retries=LIMITER_SDK_RETRIES) if rate_limiter else None
+)
 
-# Bedrockクライアントの設定
-bedrock = boto3.client(service_name='bedrock-runtime', region_name='ap-northeast-1')
+# Bedrockレスポンスのキャッシュ（RESPONSE_CACHE_ENABLED=true の場合のみ有効）
+# temperature が0以外の呼び出しはキャッシュされず、バイパス件数としてのみ記録される
+response_cache = build_response_cache_from_env()
 
 # データベース接続
 conn = psycopg2.connect(
@@ -17,26 +39,40 @@ conn = psycopg2.connect(
     port=os.environ.get('DB_PORT', '5432')  # デフォルト値を設定
 )
 
-# ユーザーデータの取得
-cur = conn.cursor()
-cur.execute("SELECT id, embedding, chunks FROM bedrock_integration.bedrock_knowledge_base")
-users = cur.fetchall()
-
-# embeddings配列の作成
-embeddings = np.array([ast.literal_eval(user[1]) for user in users])
-
-# K-meansクラスタリングの実行
-n_clusters = 5 # クラスター数は適宜調整してください
-kmeans = KMeans(n_clusters=n_clusters, random_state=42)
-cluster_labels = kmeans.fit_predict(embeddings)
+# ユーザーデータの取得（embedding は float32 の配列に直接読み込む。EMBEDDING_FETCH_MODE=cursor でサーバーサイドカーソルから少しずつ取得）
+# chunks はクラスターごとに、LLM に送るメンバーの分のみ取得する
+with metrics.stage("fetch_embeddings"):
+    user_ids, embeddings = load_embeddings_from_env(conn)
+metrics.count("UsersFetched", len(user_ids))
+
+# クラスタリングの実行（CLUSTERING_ENGINE=minibatch の場合は float32 のミニバッチ KMeans で、前回の重心から開始する）
+n_clusters = 5 # クラスター数は適宜調整してください（AUTO_K_ENABLED=true の場合は自動で選ぶ）
+k_selector = build_k_selector_from_env()
+if k_selector:
+    with metrics.stage("select_n_clusters"):
+        k_selection = k_selector.select(embeddings)
+    n_clusters = k_selection.best_k
+    print(f"Selected n_clusters: {k_selection.summary()}")
+clustering_engine = build_clustering_engine_from_env("matching-haiku")
+with metrics.stage("clustering"):
+    clustering = cluster_embeddings(clustering_engine, embeddings, n_clusters)
+cluster_labels = clustering.labels
+print(f"Clustering: {clustering.summary()}")
 
 # クラスターごとのユーザー特性の分析
-for cluster in range(n_clusters):
-    cluster_users = [users[i] for i in range(len(users)) if cluster_labels[i] == cluster]
-    cluster_chunks = " ".join([user[2] for user in cluster_users])
+# プロンプトに収まらないクラスターは分割し、全クラスターを並列に要約する（結果はクラスター順）
+# 同時実行数と1回のプロンプトの入力トークン上限は環境変数で調整する
+summary_max_workers = int(os.environ.get("SUMMARY_MAX_WORKERS", DEFAULT_SUMMARY_MAX_WORKERS))
+summary_max_input_tokens = int(os.environ.get("SUMMARY_MAX_INPUT_TOKENS", DEFAULT_MAX_INPUT_TOKENS))
+
+def build_prompt(cluster_chunks):
+    # 「Human:」: ユーザー（人間）からの入力や指示を示します。この部分には、AIがどのようなタスクを実行するかを指示する文が含まれます。
+    # 「{cluster_chunks}」: クラスター分類されたデータの特徴や情報を表します。この部分は、実際にはデータベースから取得した情報を埋め込むためのプレースホルダーです。
+    # 「Assistant:」: AIアシスタントが応答する部分を示します。AIは「Human:」で与えられた指示に基づいて、ここで回答を生成します。
+    # この構造は、AIモデルが人間の指示に基づいて特定のタスクを実行し、結果を返すためのフレームワークです。
 
     # プロンプトを変数として定義
-    prompt_template = f"""
+    return f"""
     Human: あなたはデータサイエンティストです。
     全社員のデータを閲覧しグループ分けできる権限を持っています。
     社員全員を趣味や好きな食べ物などの特徴をもとにグループに分類してください。
@@ -58,48 +94,54 @@ for cluster in range(n_clusters):
     Assistant:
     """
 
-    # 「Human:」: ユーザー（人間）からの入力や指示を示します。この部分には、AIがどのようなタスクを実行するかを指示する文が含まれます。
-    # 「{cluster_chunks}」: クラスター分類されたデータの特徴や情報を表します。この部分は、実際にはデータベースから取得した情報を埋め込むためのプレースホルダーです。
-    # 「Assistant:」: AIアシスタントが応答する部分を示します。AIは「Human:」で与えられた指示に基づいて、ここで回答を生成します。
-    # この構造は、AIモデルが人間の指示に基づいて特定のタスクを実行し、結果を返すためのフレームワークです。
-
+summary_inference_config = {
+    "temperature": 1.0,
+    # 【 温度パラメータ 】
+    # 生成される応答のランダム性を制御します
+    # 0に設定すると、非常に決定的で再現性の高い応答が生成されます
+    # 値が低いほど予測可能で一貫性のある出力になり、高いほど多様でクリエイティブな出力になります
+
+    # "topP": 0.95,
+    # 【 トップP/核サンプリング 】
+    # 確率の累積分布からのトークン選択を制御します
+    # 0.95に設定すると、確率の累積が95%に達するまでの最も可能性の高いトークンのみが考慮されます
+    # 多様性とクオリティのバランスを取るのに役立ちます
+
+    "maxTokens": 4096 # haiku の Max 値 4096, Sonnet 3.5 の Max 値 8192
+}
+
+def summarize(prompt):
+    # Claude 3 Haiku を使用してクラスター特性の要約
+    return converse_with_cache(
+        bedrock,
+        'anthropic.claude-3-haiku-20240307-v1:0',
+        prompt,
+        summary_inference_config,
+        cache=response_cache,
+        limiter=rate_limiter
+    )
 
-    # Claude 3.5 Sonnet を使用してクラスター特性の要約
-    response = bedrock.converse(
-        modelId='anthropic.claude-3-haiku-20240307-v1:0',
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "text": prompt_template
-                    }
-                ]
-            }
-        ],
-        inferenceConfig={
-            "temperature": 1.0,
-            # 【 温度パラメータ 】
-            # 生成される応答のランダム性を制御します
-            # 0に設定すると、非常に決定的で再現性の高い応答が生成されます
-            # 値が低いほど予測可能で一貫性のある出力になり、高いほど多様でクリエイティブな出力になります
-
-            # "topP": 0.95,
-            # 【 トップP/核サンプリング 】
-            # 確率の累積分布からのトークン選択を制御します
-            # 0.95に設定すると、確率の累積が95%に達するまでの最も可能性の高いトークンのみが考慮されます
-            # 多様性とクオリティのバランスを取るのに役立ちます
-
-            "maxTokens": 4096 # haiku の Max 値 4096, Sonnet 3.5 の Max 値 8192
-        }
+with metrics.stage("summarize_clusters"):
+    summaries = summarize_clusters(
+        [[user_ids[i] for i in np.flatnonzero(cluster_labels == cluster)] for cluster in range(n_clusters)],
+        lambda member_ids: fetch_chunks(conn, member_ids),
+        build_prompt,
+        summarize,
+        max_input_tokens=summary_max_input_tokens,
+        max_output_tokens=summary_inference_config["maxTokens"],
+        max_workers=summary_max_workers
     )
 
-    # レスポンスから回答を取得
-    summary = response['output']['message']['content'][0]['text']
-    print(f"Cluster {cluster} 特性:")
-    print(summary.strip())
+for summary in summaries:
+    print(f"{summary.title}:")
+    print(summary.text.strip())
     print("---")
 
+# スロットリング・再試行の件数（クォータに合わせた設定の調整用）
+if rate_limiter:
+    print(f"Rate limiter: {rate_limiter.stats()}")
+
 # データベース接続のクローズ
-cur.close()
-conn.close()
\ No newline at end of file
+conn.close()
+
+metrics.flush()
\ No newline at end of file
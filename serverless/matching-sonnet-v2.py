@@ -2,13 +2,39 @@ import boto3
 import json
 import psycopg2
 import numpy as np
-from sklearn.cluster import KMeans
-import ast
 import os
+from botocore.config import Config
+from matching_common.chunk_planner import DEFAULT_MAX_INPUT_TOKENS
+from matching_common.cluster_summary import DEFAULT_SUMMARY_MAX_WORKERS, summarize_clusters
+from matching_common.clustering import build_clustering_engine_from_env, cluster_embeddings
+from matching_common.embedding_loader import fetch_chunks, load_embeddings_from_env
+from matching_common.k_selection import build_k_selector_from_env
+from matching_common.metrics import instrument_handler, metrics
+from matching_common.response_cache import build_response_cache_from_env, converse_with_cache
+from matching_common.rate_limiter import LIMITER_SDK_RETRIES, build_rate_limiter_from_env
 
+# Bedrockレスポンスのキャッシュ（RESPONSE_CACHE_ENABLED=true の場合のみ有効、ウォームコンテナ間で共有）
+RESPONSE_CACHE = build_response_cache_from_env()
+
+# Bedrock呼び出しの流量制限とスロットリング時の再試行（BEDROCK_RATE_LIMIT_ENABLED=false で無効）
+BEDROCK_LIMITER = build_rate_limiter_from_env()
+
+# クラスターの要約の同時実行数と、1回のプロンプトの入力トークン上限（超えるクラスターは分割する）
+SUMMARY_MAX_WORKERS = int(os.environ.get("SUMMARY_MAX_WORKERS", DEFAULT_SUMMARY_MAX_WORKERS))
+SUMMARY_MAX_INPUT_TOKENS = int(os.environ.get("SUMMARY_MAX_INPUT_TOKENS", DEFAULT_MAX_INPUT_TOKENS))
+SUMMARY_INFERENCE_CONFIG = {
+    "temperature": 0,
+    "maxTokens": 8192
+}
+
+@instrument_handler("matching-sonnet-v2")
 def lambda_handler(event, context):
-    # Bedrockクライアントの設定
-    bedrock = boto3.client(service_name='bedrock-runtime', region_name='ap-northeast-1')
+    # Bedrockクライアントの設定（リミッター使用時は再試行をリミッターに任せる）
+    bedrock = boto3.client(
+        service_name='bedrock-runtime',
+        region_name='ap-northeast-1',
+        config=Config(retries=LIMITER_SDK_RETRIES) if BEDROCK_LIMITER else None
+    )
     
     # S3 クライアントの設定
     s3 = boto3.client('s3', region_name='ap-northeast-1')
@@ -68,28 +94,30 @@ def lambda_handler(event, context):
     
     # ------------------------------------------------------------------
     
-    # ユーザーデータの取得
-    cur = conn.cursor()
-    cur.execute("SELECT id, embedding, chunks FROM bedrock_integration.bedrock_knowledge_base")
-    users = cur.fetchall()
-    
-    # embeddings配列の作成
-    embeddings = np.array([ast.literal_eval(user[1]) for user in users])
+    # ユーザーデータの取得（embedding は float32 の配列に直接読み込む。EMBEDDING_FETCH_MODE=cursor でサーバーサイドカーソルから少しずつ取得）
+    # chunks はクラスターごとに、LLM に送るメンバーの分のみ取得する
+    with metrics.stage("fetch_embeddings"):
+        user_ids, embeddings = load_embeddings_from_env(conn)
+    metrics.count("UsersFetched", len(user_ids))
     
-    # K-meansクラスタリングの実行
-    n_clusters = 3 # クラスター数は適宜調整してください
-    kmeans = KMeans(n_clusters=n_clusters, random_state=42)
-    cluster_labels = kmeans.fit_predict(embeddings)
+    # クラスタリングの実行（CLUSTERING_ENGINE=minibatch の場合は float32 のミニバッチ KMeans で、前回の重心から開始する）
+    n_clusters = 3 # クラスター数は適宜調整してください（AUTO_K_ENABLED=true の場合は自動で選ぶ）
+    k_selector = build_k_selector_from_env(s3)
+    if k_selector:
+        with metrics.stage("select_n_clusters"):
+            k_selection = k_selector.select(embeddings)
+        n_clusters = k_selection.best_k
+        print(f"Selected n_clusters: {k_selection.summary()}")
+    clustering_engine = build_clustering_engine_from_env("matching-sonnet-v2", s3)
+    with metrics.stage("clustering"):
+        clustering = cluster_embeddings(clustering_engine, embeddings, n_clusters)
+    cluster_labels = clustering.labels
+    print(f"Clustering: {clustering.summary()}")
     
     # クラスターごとのユーザー特性の分析
-    all_results = []  # すべてのクラスター結果を保存するリスト
-    
-    for cluster in range(n_clusters):
-        cluster_users = [users[i] for i in range(len(users)) if cluster_labels[i] == cluster]
-        cluster_chunks = " ".join([user[2] for user in cluster_users])
-        
-        # プロンプトを変数として定義
-        prompt_template = f"""
+    # プロンプトに収まらないクラスターは分割し、全クラスターを並列に要約する（結果はクラスター順）
+    def build_prompt(cluster_chunks):
+        return f"""
         H: あなたはデータ分析の専門家です。
         全社員のデータを閲覧しグループ分けできる権限を持っています。
         社員全員を最寄り駅でグループ分けし、さらに下記ルールでグループ分けしてください。
@@ -111,34 +139,37 @@ def lambda_handler(event, context):
         
         Assistant:
         """
-        
-        # Claude 3.5 Sonnet を使用してクラスター特性の要約
-        response = bedrock.converse(
-            modelId='anthropic.claude-3-5-sonnet-20240620-v1:0',
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "text": prompt_template
-                        }
-                    ]
-                }
-            ],
-            inferenceConfig={
-                "temperature": 0,
-                "maxTokens": 8192
-            }
+    
+    def summarize(prompt):
+        # Claude 3.5 Sonnet を使用してクラスター特性の要約（同一プロンプトの再実行時はキャッシュから取得）
+        return converse_with_cache(
+            bedrock,
+            'anthropic.claude-3-5-sonnet-20240620-v1:0',
+            prompt,
+            SUMMARY_INFERENCE_CONFIG,
+            cache=RESPONSE_CACHE,
+            limiter=BEDROCK_LIMITER
         )
-        
-        # レスポンスから回答を取得
-        summary = response['output']['message']['content'][0]['text']
-        print(f"Cluster {cluster} 特性:")
-        print(summary.strip())
+    
+    with metrics.stage("summarize_clusters"):
+        summaries = summarize_clusters(
+            [[user_ids[i] for i in np.flatnonzero(cluster_labels == cluster)] for cluster in range(n_clusters)],
+            lambda member_ids: fetch_chunks(conn, member_ids),
+            build_prompt,
+            summarize,
+            max_input_tokens=SUMMARY_MAX_INPUT_TOKENS,
+            max_output_tokens=SUMMARY_INFERENCE_CONFIG["maxTokens"],
+            max_workers=SUMMARY_MAX_WORKERS
+        )
+    
+    all_results = []  # すべてのクラスター結果を保存するリスト
+    for summary in summaries:
+        print(f"{summary.title}:")
+        print(summary.text.strip())
         print("---")
         
         # 結果をリストに追加
-        all_results.append(f"## Cluster {cluster} 特性:\n{summary.strip()}\n\n---\n\n")
+        all_results.append(f"## {summary.title}:\n{summary.text.strip()}\n\n---\n\n")
     
     # すべての結果を1つのファイルにまとめる
     combined_results = "# クラスター分析結果\n\n" + "".join(all_results)
@@ -149,7 +180,11 @@ def lambda_handler(event, context):
     
     # S3 バケットに1つのファイルとしてアップロード
     s3.upload_file("/tmp/combined_grouping_results.txt", 'hara-datasource', "combined_grouping_results.txt")
+    metrics.count("S3BytesWritten", os.path.getsize("/tmp/combined_grouping_results.txt"), unit="Bytes")
+    
+    # スロットリング・再試行の件数（クォータに合わせた設定の調整用）
+    if BEDROCK_LIMITER:
+        print(f"Rate limiter: {BEDROCK_LIMITER.stats()}")
     
     # データベース接続のクローズ
-    cur.close()
     conn.close()
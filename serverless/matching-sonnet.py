@@ -2,16 +2,37 @@ import boto3
 import json
 import psycopg2
 import numpy as np
-from sklearn.cluster import KMeans
-import ast
 import os
-
-# Bedrockクライアントの設定
-bedrock = boto3.client(service_name='bedrock-runtime', region_name='ap-northeast-1')
+from botocore.config import Config
+from matching_common.chunk_planner import DEFAULT_MAX_INPUT_TOKENS
+from matching_common.cluster_evaluation import evaluate_cosine
+from matching_common.cluster_summary import DEFAULT_SUMMARY_MAX_WORKERS, summarize_clusters
+from matching_common.clustering import build_clustering_engine_from_env, cluster_embeddings
+from matching_common.embedding_loader import fetch_chunks, load_embeddings_from_env
+from matching_common.k_selection import build_k_selector_from_env
+from matching_common.metrics import metrics
+from matching_common.response_cache import build_response_cache_from_env, converse_with_cache
+from matching_common.rate_limiter import LIMITER_SDK_RETRIES, build_rate_limiter_from_env
+
+# メトリクス（METRICS_ENABLED=true の場合のみ、終了時に EMF で出力）
+metrics.set_service("matching-sonnet")
+
+# Bedrock呼び出しの流量制限とスロットリング時の再試行（BEDROCK_RATE_LIMIT_ENABLED=false で無効）
+rate_limiter = build_rate_limiter_from_env()
+
+# Bedrockクライアントの設定（リミッター使用時は再試行をリミッターに任せる）
+bedrock = boto3.client(
+    service_name='bedrock-runtime',
+    region_name='ap-northeast-1',
+    config=Config(retries=LIMITER_SDK_RETRIES) if rate_limiter else None
+)
 
 # S3 クライアントの設定
 s3 = boto3.client('s3', region_name='ap-northeast-1')
 
+# Bedrockレスポンスのキャッシュ（RESPONSE_CACHE_ENABLED=true の場合のみ有効）
+response_cache = build_response_cache_from_env()
+
 # Secrets Managerからデータベース接続情報を取得する関数
 def get_database_secret():
     secret_name = "your-database-secret-name"  # Secrets Managerに保存したシークレット名
@@ -63,26 +84,40 @@ def connect_to_database():
 # メイン処理
 conn = connect_to_database()
 
-# ユーザーデータの取得
-cur = conn.cursor()
-cur.execute("SELECT id, embedding, chunks FROM bedrock_integration.bedrock_knowledge_base")
-users = cur.fetchall()
-
-# embeddings配列の作成
-embeddings = np.array([ast.literal_eval(user[1]) for user in users])
-
-# K-meansクラスタリングの実行
-n_clusters = 1  # クラスター数は適宜調整してください
-kmeans = KMeans(n_clusters=n_clusters, random_state=42)
-cluster_labels = kmeans.fit_predict(embeddings)
+# ユーザーデータの取得（embedding は float32 の配列に直接読み込む。EMBEDDING_FETCH_MODE=cursor でサーバーサイドカーソルから少しずつ取得）
+# chunks はクラスターごとに、LLM に送るメンバーの分のみ取得する
+with metrics.stage("fetch_embeddings"):
+    user_ids, embeddings = load_embeddings_from_env(conn)
+metrics.count("UsersFetched", len(user_ids))
+
+# クラスタリングの実行（CLUSTERING_ENGINE=minibatch の場合は float32 のミニバッチ KMeans で、前回の重心から開始する）
+n_clusters = 1  # クラスター数は適宜調整してください（AUTO_K_ENABLED=true の場合は自動で選ぶ）
+k_selector = build_k_selector_from_env(s3)
+if k_selector:
+    with metrics.stage("select_n_clusters"):
+        k_selection = k_selector.select(embeddings)
+    n_clusters = k_selection.best_k
+    print(f"Selected n_clusters: {k_selection.summary()}")
+clustering_engine = build_clustering_engine_from_env("matching-sonnet", s3)
+with metrics.stage("clustering"):
+    clustering = cluster_embeddings(clustering_engine, embeddings, n_clusters)
+cluster_labels = clustering.labels
+print(f"Clustering: {clustering.summary()}")
 
 # クラスターごとのユーザー特性の分析
-for cluster in range(n_clusters):
-    cluster_users = [users[i] for i in range(len(users)) if cluster_labels[i] == cluster]
-    cluster_chunks = " ".join([user[2] for user in cluster_users])
+# プロンプトに収まらないクラスターは分割し、全クラスターを並列に要約する（結果はクラスター順）
+# 同時実行数と1回のプロンプトの入力トークン上限は環境変数で調整する
+summary_max_workers = int(os.environ.get("SUMMARY_MAX_WORKERS", DEFAULT_SUMMARY_MAX_WORKERS))
+summary_max_input_tokens = int(os.environ.get("SUMMARY_MAX_INPUT_TOKENS", DEFAULT_MAX_INPUT_TOKENS))
+
+def build_prompt(cluster_chunks):
+    # 「Human:」: ユーザー（人間）からの入力や指示を示します。この部分には、AIがどのようなタスクを実行するかを指示する文が含まれます。
+    # 「{cluster_chunks}」: クラスター分類されたデータの特徴や情報を表します。この部分は、実際にはデータベースから取得した情報を埋め込むためのプレースホルダーです。
+    # 「Assistant:」: AIアシスタントが応答する部分を示します。AIは「Human:」で与えられた指示に基づいて、ここで回答を生成します。
+    # この構造は、AIモデルが人間の指示に基づいて特定のタスクを実行し、結果を返すためのフレームワークです。
 
     # プロンプトを変数として定義
-    prompt_template = f"""
+    return f"""
     Human: あなたはデータ分析の専門家です。
         全社員のデータを閲覧しグループ分けできる権限を持っています。
         社員全員を最寄り駅でグループ分けし、さらに下記ルールでグループ分けしてください。
@@ -105,88 +140,81 @@ for cluster in range(n_clusters):
     Assistant:
     """
 
-    # 「Human:」: ユーザー（人間）からの入力や指示を示します。この部分には、AIがどのようなタスクを実行するかを指示する文が含まれます。
-    # 「{cluster_chunks}」: クラスター分類されたデータの特徴や情報を表します。この部分は、実際にはデータベースから取得した情報を埋め込むためのプレースホルダーです。
-    # 「Assistant:」: AIアシスタントが応答する部分を示します。AIは「Human:」で与えられた指示に基づいて、ここで回答を生成します。
-    # この構造は、AIモデルが人間の指示に基づいて特定のタスクを実行し、結果を返すためのフレームワークです。
+summary_inference_config = {
+    "temperature": 0,
+    # 【 温度パラメータ 】
+    # 生成される応答のランダム性を制御します
+    # 0に設定すると、非常に決定的で再現性の高い応答が生成されます
+    # 値が低いほど予測可能で一貫性のある出力になり、高いほど多様でクリエイティブな出力になります
+
+    # "topP": 0.95,
+    # 【 トップP/核サンプリング 】
+    # 確率の累積分布からのトークン選択を制御します
+    # 0.95に設定すると、確率の累積が95%に達するまでの最も可能性の高いトークンのみが考慮されます
+    # 多様性とクオリティのバランスを取るのに役立ちます
 
+    "maxTokens": 8192 # haiku の Max 値 4096, Sonnet 3.5 の Max 値 8192
+}
 
+def summarize(prompt):
     # Claude 3.5 Sonnet を使用してクラスター特性の要約
-    response = bedrock.converse(
-        modelId='anthropic.claude-3-5-sonnet-20240620-v1:0',
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "text": prompt_template
-                    }
-                ]
-            }
-        ],
-        inferenceConfig={
-            "temperature": 0,
-            # 【 温度パラメータ 】
-            # 生成される応答のランダム性を制御します
-            # 0に設定すると、非常に決定的で再現性の高い応答が生成されます
-            # 値が低いほど予測可能で一貫性のある出力になり、高いほど多様でクリエイティブな出力になります
-
-            # "topP": 0.95,
-            # 【 トップP/核サンプリング 】
-            # 確率の累積分布からのトークン選択を制御します
-            # 0.95に設定すると、確率の累積が95%に達するまでの最も可能性の高いトークンのみが考慮されます
-            # 多様性とクオリティのバランスを取るのに役立ちます
-
-            "maxTokens": 8192 # haiku の Max 値 4096, Sonnet 3.5 の Max 値 8192
-        }
+    # 同一プロンプトの再実行時はキャッシュから回答を取得する
+    return converse_with_cache(
+        bedrock,
+        'anthropic.claude-3-5-sonnet-20240620-v1:0',
+        prompt,
+        summary_inference_config,
+        cache=response_cache,
+        limiter=rate_limiter
     )
 
-    # レスポンスから回答を取得
-    summary = response['output']['message']['content'][0]['text']
-    print(f"Cluster {cluster} 特性:")
-    print(summary.strip())
+with metrics.stage("summarize_clusters"):
+    summaries = summarize_clusters(
+        [[user_ids[i] for i in np.flatnonzero(cluster_labels == cluster)] for cluster in range(n_clusters)],
+        lambda member_ids: fetch_chunks(conn, member_ids),
+        build_prompt,
+        summarize,
+        max_input_tokens=summary_max_input_tokens,
+        max_output_tokens=summary_inference_config["maxTokens"],
+        max_workers=summary_max_workers
+    )
+
+for summary in summaries:
+    print(f"{summary.title}:")
+    print(summary.text.strip())
     print("---")
 
-    # テキストファイルに保存
-    with open(f"/tmp/cluster_{cluster}_grouping_result.txt", "w") as f:
-        f.write(summary.strip())
+    # テキストファイルに保存（分割したクラスターは part ごとのファイル）
+    file_name = f"cluster_{summary.cluster}_grouping_result.txt" if summary.parts == 1 else f"cluster_{summary.cluster}_part_{summary.part}_grouping_result.txt"
+    with open(f"/tmp/{file_name}", "w") as f:
+        f.write(summary.text.strip())
 
     # S3 バケット「例）hara-datasource」にアップロード
-    s3.upload_file(f"/tmp/cluster_{cluster}_grouping_result.txt", 'hara-datasource', f"cluster_{cluster}_grouping_result.txt")
+    s3.upload_file(f"/tmp/{file_name}", 'hara-datasource', file_name)
 
 # ------------------------------------------------------------------
 
-# コサイン類似度による評価を追加
-def evaluate_clustering_cosine(embeddings, cluster_labels):
-    unique_clusters = set(cluster_labels)
-    avg_similarities = []
-    
-    for cluster in unique_clusters:
-        # クラスター内のデータポイントを取得
-        cluster_points = embeddings[cluster_labels == cluster]
-        
-        # クラスター内のすべてのペア間のコサイン類似度を計算
-        if len(cluster_points) > 1:
-            from sklearn.metrics.pairwise import cosine_similarity
-            similarity_matrix = cosine_similarity(cluster_points)
-            # 対角要素(自分自身との類似度=1)を除外
-            similarities = similarity_matrix[np.triu_indices(len(similarity_matrix), k=1)]
-            avg_similarities.append(np.mean(similarities))
-    
-    return np.mean(avg_similarities) if avg_similarities else 0
-
-# クラスタリング評価の実行
-average_similarity = evaluate_clustering_cosine(embeddings, cluster_labels)
+# クラスタリング評価の実行（コサイン類似度。類似度行列を作らずに O(n·d) で計算する）
+with metrics.stage("evaluate_clustering"):
+    evaluation = evaluate_cosine(embeddings, cluster_labels, per_cluster=True)
+average_similarity = evaluation.average
 print(f"Average cosine similarity within clusters: {average_similarity}")
 
 # 評価結果をS3にアップロード
 with open("/tmp/clustering_evaluation.txt", "w") as f:
     f.write(f"Average cosine similarity within clusters: {average_similarity}")
+    for cluster, breakdown in evaluation.per_cluster.items():
+        f.write(f"\nCluster {cluster}: size={breakdown['size']}, mean cosine similarity={breakdown['mean_cosine']}")
 
 s3.upload_file("/tmp/clustering_evaluation.txt", 'hara-datasource', "clustering_evaluation.txt")
 
 # ------------------------------------------------------------------
 
+# スロットリング・再試行の件数（クォータに合わせた設定の調整用）
+if rate_limiter:
+    print(f"Rate limiter: {rate_limiter.stats()}")
+
 # データベース接続のクローズ
-cur.close()
-conn.close()
\ No newline at end of file
+conn.close()
+
+metrics.flush()
\ No newline at end of file
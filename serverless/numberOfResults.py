@@ -1,6 +1,8 @@
 import boto3
 import json
+from matching_common.metrics import instrument_handler, metrics
 
+@instrument_handler("numberOfResults")
 def lambda_handler(event, context):
 
     # Bedrock Agentを初期化
@@ -46,7 +48,8 @@ def lambda_handler(event, context):
         }
         
         # RetrieveAndGenerate APIを呼び出し
-        response = bedrock_agent.retrieve_and_generate(**request_params)
+        with metrics.timer("KnowledgeBaseLatency"):
+            response = bedrock_agent.retrieve_and_generate(**request_params)
         
         # 生成された回答を表示
         print("生成された回答:")
@@ -1,8 +1,19 @@
 import boto3
 import json
 import os
+from botocore.config import Config
+from matching_common.metrics import instrument_handler, metrics
+from matching_common.rate_limiter import LIMITER_SDK_RETRIES, build_rate_limiter_from_env, call_with_limiter, estimate_request_tokens
 
-bedrock = boto3.client("bedrock-runtime", region_name=os.environ.get("AWS_REGION", "ap-northeast-1"))
+# Bedrock 呼び出しの流量制限とスロットリング時の再試行（BEDROCK_RATE_LIMIT_ENABLED=false で無効）
+rate_limiter = build_rate_limiter_from_env()
+
+# リミッター使用時は再試行をリミッターに任せる
+bedrock = boto3.client(
+    "bedrock-runtime",
+    region_name=os.environ.get("AWS_REGION", "ap-northeast-1"),
+    config=Config(retries=LIMITER_SDK_RETRIES) if rate_limiter else None
+)
 s3 = boto3.client("s3")
 
 # Claude のモデル（Haiku なら claude-3-haiku-20240307）
@@ -12,8 +23,9 @@ def get_json_from_s3(bucket, key):
     """ S3 から JSON ファイルを取得 """
     try:
         response = s3.get_object(Bucket=bucket, Key=key)
-        content = response['Body'].read().decode('utf-8')
-        return json.loads(content)
+        content = response['Body'].read()
+        metrics.count("S3BytesRead", len(content), unit="Bytes")
+        return json.loads(content.decode('utf-8'))
     except Exception as e:
         print(f"S3 Error: {str(e)}")
         return None
@@ -36,14 +48,21 @@ def invoke_claude(employee_chunk):
     \n\nAssistant:
     """.strip()
 
-    response = bedrock.invoke_model(
-        modelId=MODEL_ID,
-        body=json.dumps({"prompt": prompt, "max_tokens_to_sample": 8000})
-    )
+    def send():
+        metrics.count("BedrockCalls")
+        with metrics.timer("BedrockLatency"):
+            return bedrock.invoke_model(
+                modelId=MODEL_ID,
+                body=json.dumps({"prompt": prompt, "max_tokens_to_sample": 8000})
+            )
+
+    response = call_with_limiter(rate_limiter, send, estimate_request_tokens(prompt, {"maxTokens": 8000}))
+    metrics.record_invoke_model_usage(response)
 
     result = json.loads(response["body"].read())
     return result.get("completion", "No response")
 
+@instrument_handler("read-s3-json_claude-v2-1")
 def lambda_handler(event, context):
     try:
         s3_bucket = event.get("s3_bucket")
@@ -52,20 +71,22 @@ def lambda_handler(event, context):
         if not s3_bucket or not s3_key:
             return {"statusCode": 400, "body": json.dumps({"error": "Missing s3_bucket or s3_key"})}
 
-        employee_data = get_json_from_s3(s3_bucket, s3_key)
+        with metrics.stage("read_input"):
+            employee_data = get_json_from_s3(s3_bucket, s3_key)
         if not employee_data:
             return {"statusCode": 500, "body": json.dumps({"error": "Failed to load JSON from S3"})}
 
         # データを 500 件ごとに分割して処理
         chunk_size = 500
         results = []
-        for chunk in chunk_list(employee_data, chunk_size):
-            result = invoke_claude(chunk)
-            results.append(result)
+        with metrics.stage("invoke_chunks"):
+            for chunk in chunk_list(employee_data, chunk_size):
+                result = invoke_claude(chunk)
+                results.append(result)
 
         return {
             "statusCode": 200,
-            "body": json.dumps({"results": results})
+            "body": json.dumps({"results": results, "rate_limiter": rate_limiter.stats() if rate_limiter else None})
         }
 
     except Exception as e:
@@ -2,6 +2,7 @@ import boto3
 import json
 import random
 import re
+from matching_common.metrics import instrument_handler, metrics
 
 # S3 クライアントの設定
 s3 = boto3.client('s3', region_name='ap-northeast-1')
@@ -10,8 +11,9 @@ s3 = boto3.client('s3', region_name='ap-northeast-1')
 def read_summary_file(bucket_name, file_name):
     try:
         response = s3.get_object(Bucket=bucket_name, Key=file_name)
-        content = response['Body'].read().decode('utf-8')
-        return content
+        content = response['Body'].read()
+        metrics.count("S3BytesRead", len(content), unit="Bytes")
+        return content.decode('utf-8')
     except Exception as e:
         print(f"Error reading file: {e}")
         return None
@@ -132,10 +134,12 @@ def regroup_ids(summary):
 
 # JSON データを保存し、S3 にアップロード
 def save_and_upload_json(json_data, bucket_name, file_name):
-    json_content = json.dumps(json_data, indent=4, ensure_ascii=False)
+    json_content = json.dumps(json_data, indent=4, ensure_ascii=False).encode('utf-8')
     s3.put_object(Body=json_content, Bucket=bucket_name, Key=file_name)
+    metrics.count("S3BytesWritten", len(json_content), unit="Bytes")
 
 # Lambda ハンドラー関数
+@instrument_handler("secondary-grouping")
 def lambda_handler(event, context):
     bucket_name = "hara-datasource"
     file_name = "input/cluster_0_summary.txt"
@@ -143,8 +147,9 @@ def lambda_handler(event, context):
     summary = read_summary_file(bucket_name, file_name)
     
     if summary:
-        json_data = regroup_ids(summary)
-        print(json.dumps(json_data, indent=4, ensure_ascii=False))
+        with metrics.stage("regroup"):
+            json_data = regroup_ids(summary)
+        print(f"Regrouped into {len(json_data)} themes")
         save_and_upload_json(json_data, bucket_name, "output/third_group_summary.json")
         
         return {
@@ -1,14 +1,25 @@
 import boto3
 import json
 import logging
+from botocore.config import Config
+from matching_common.metrics import instrument_handler, metrics
+from matching_common.rate_limiter import LIMITER_SDK_RETRIES, build_rate_limiter_from_env, call_with_limiter, estimate_request_tokens
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-bedrock_agent_runtime = boto3.client('bedrock-agent-runtime')
+# Bedrock呼び出しの流量制限とスロットリング時の再試行（BEDROCK_RATE_LIMIT_ENABLED=false で無効、ウォームコンテナ間で共有）
+rate_limiter = build_rate_limiter_from_env()
+
+# リミッター使用時は再試行をリミッターに任せる
+bedrock_agent_runtime = boto3.client(
+    'bedrock-agent-runtime',
+    config=Config(retries=LIMITER_SDK_RETRIES) if rate_limiter else None
+)
 knowledge_base_id = 'B2TTXCTYTP'
 model_arn = 'arn:aws:bedrock:ap-northeast-1::foundation-model/anthropic.claude-3-haiku-20240307-v1:0'
 
+@instrument_handler("self-intro")
 def lambda_handler(event, context):
     logger.info(f"Received event: {json.dumps(event, ensure_ascii=False)}")
 
@@ -38,18 +49,25 @@ def lambda_handler(event, context):
         存在しない情報は含めず、与えられた情報のみを使用してください。
         """
         
-        response = bedrock_agent_runtime.retrieve_and_generate(
-            input={
-                'text': prompt,
-            },
-            retrieveAndGenerateConfiguration={
-                'type': 'KNOWLEDGE_BASE',
-                'knowledgeBaseConfiguration': {
-                    'knowledgeBaseId': knowledge_base_id,
-                    'modelArn': model_arn
-                }
-            }
-        )
+        # ナレッジベースから取得する文脈の分はトークン数の見積もりに含まれない
+        def send():
+            with metrics.timer("KnowledgeBaseLatency"):
+                return bedrock_agent_runtime.retrieve_and_generate(
+                    input={
+                        'text': prompt,
+                    },
+                    retrieveAndGenerateConfiguration={
+                        'type': 'KNOWLEDGE_BASE',
+                        'knowledgeBaseConfiguration': {
+                            'knowledgeBaseId': knowledge_base_id,
+                            'modelArn': model_arn
+                        }
+                    }
+                )
+
+        response = call_with_limiter(rate_limiter, send, estimate_request_tokens(prompt))
+        if rate_limiter:
+            logger.info(f"Rate limiter: {rate_limiter.stats()}")
         
         generated_text = response['output']['text']
         